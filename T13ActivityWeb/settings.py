@@ -159,6 +159,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'app.middleware.member_middleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'app.middleware.disable_api_cache_middleware',
@@ -274,13 +275,32 @@ LOGGING = {
     }
 }
 
-if not DEBUG:
-    CACHES = {
-        'default': {
-            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+# 'sqlite' or 'file' share the cache between all worker processes on the host,
+# 'locmem' is per process and only suitable for development and tests
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'locmem' if DEBUG else 'sqlite')
+CACHE_LOCATION = os.getenv('CACHE_LOCATION', os.path.join(BASE_DIR, 'cache'))
+
+CACHES = {
+    'default': {
+        'sqlite': {
+            'BACKEND': 'app.caching.SQLiteCache',
+            'LOCATION': os.path.join(CACHE_LOCATION, 'cache.sqlite3'),
+        },
+        'file': {
+            'BACKEND': 'app.caching.FileCache',
+            'LOCATION': CACHE_LOCATION,
+        },
+        'locmem': {
+            'BACKEND': 'app.caching.LocMemCache',
             'LOCATION': 'unique-snowflake',
-        }
-    }
+        },
+    }[CACHE_BACKEND],
+}
+CACHES['default']['OPTIONS'] = {'MAX_ENTRIES': 10000}
+
+# relays activity changes made by other worker processes to the waiting
+# change long-polls (app.live), turned off in test_settings
+LIVE_RELAY = True
 
 # recaptcha
 
@@ -301,3 +321,23 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'app.drf_defaults.DefaultResultsSetPagination',
     'PAGE_SIZE': 100
 }
+
+# SMS, see app/sms.py
+
+SMS_BACKEND = 'app.sms.TwilioBackend'
+
+# messages per second, Twilio queues anything above the sender's rate (1/s for long codes)
+SMS_RATE_LIMIT = 1
+
+# seconds before an SMS API request is abandoned
+SMS_TIMEOUT = 10
+
+# seconds before an SMTP connection attempt or command is abandoned
+EMAIL_TIMEOUT = 10
+
+# per provider circuit breakers, see app/breaker.py
+CIRCUIT_BREAKERS = {
+    'smtp': {'failure_threshold': 5, 'reset_timeout': 60, 'latency_budget': 10},
+    'sms': {'failure_threshold': 5, 'reset_timeout': 60, 'latency_budget': 10},
+    'twilio_verify': {'failure_threshold': 3, 'reset_timeout': 30, 'latency_budget': 5},
+}
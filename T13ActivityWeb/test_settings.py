@@ -0,0 +1,21 @@
+"""
+Settings for the test suite:
+
+    python manage.py test --settings=T13ActivityWeb.test_settings
+"""
+
+from T13ActivityWeb.settings import *  # noqa: F401,F403
+
+# a per process cache, so test runs don't share entries with each other or a
+# development server
+CACHE_BACKEND = 'locmem'
+CACHES = {
+    'default': {
+        'BACKEND': 'app.caching.LocMemCache',
+        'LOCATION': 'unique-snowflake',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+# the relay thread can't see the test database, tests call relay_changes()
+LIVE_RELAY = False
@@ -4,7 +4,9 @@ from django.contrib.auth.admin import UserAdmin
 
 from django.urls import reverse
 from django.utils.html import escape, mark_safe
-from django.db.models import Q
+from django.db.models import Q, Prefetch
+
+import datetime
 
 import nested_inline.admin as nested
 import logging
@@ -117,6 +119,15 @@ class MemberAdmin(nested.NestedModelAdmin):
 
         return queryset, True
 
+    def get_queryset(self, request):
+        current_seasons = models.MemberSeason.objects \
+            .filter(year=datetime.date.today().year)
+
+        return super().get_queryset(request) \
+            .select_related('user') \
+            .prefetch_related(Prefetch('seasons', queryset=current_seasons,
+                                       to_attr='current_seasons'))
+
     user_link.short_description = 'Användare'
     user_link.admin_order_field = 'user'  # Make row sortable
 
@@ -256,6 +267,36 @@ class ActivityDelistRequestAdmin(admin.ModelAdmin):
     search_fields = ['member', 'activity']
 
 
+@admin.register(models.MemberSeason)
+class MemberSeasonAdmin(admin.ModelAdmin):
+    list_filter = ['year']
+    list_display = ('member', 'year', 'completed_weight', 'booked_weight',
+                    'pending_adr_weight', 'bias')
+    list_select_related = ['member__user']
+    readonly_fields = ['member', 'year', 'completed_weight', 'booked_weight',
+                       'pending_adr_weight', 'bias']
+
+
+@admin.register(models.OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_filter = ['status', 'kind']
+    list_display = ('idempotency_key', 'kind', 'recipients', 'status',
+                    'attempts', 'next_attempt', 'sent')
+    search_fields = ['idempotency_key', 'recipients', 'subject']
+    readonly_fields = ['kind', 'idempotency_key', 'sender', 'recipients', 'subject',
+                       'body', 'attempts', 'last_error', 'created', 'sent']
+
+
+@admin.register(models.InboundSMS)
+class InboundSMSAdmin(admin.ModelAdmin):
+    list_filter = ['result']
+    list_display = ('received', 'from_number', 'body', 'member', 'result', 'processed')
+    list_select_related = ['member__user']
+    search_fields = ['from_number', 'body']
+    readonly_fields = ['message_sid', 'from_number', 'to_number', 'body', 'payload',
+                       'received', 'processed', 'member', 'activity', 'result', 'error']
+
+
 @admin.register(models.FAQ)
 class FAQAdmin(admin.ModelAdmin):
     list_display = (
@@ -19,6 +19,9 @@ from rest_framework.authtoken.views import obtain_auth_token, ObtainAuthToken
 from rest_framework.authtoken.models import Token
 from rest_framework import mixins
 
+from app import booking
+from app.booking import EnlistResult
+from app.conditional import ConditionalGetMixin
 from app.models import Activity, ActivityType, Event, EventType, Member, \
     ActivityDelistRequest, RuleViolationException
 
@@ -33,33 +36,28 @@ class ActivityEnlist(APIView):
     authentication_classes = [authentication.SessionAuthentication]
 
     def post(self, request, id):
-        activity = Activity.objects.get(id=id)
         logger.info(
-            f"User {request.user.id} about to enlist on activity {activity.id}")
+            f"User {request.user.id} about to enlist on activity {id}")
 
-        member = Member.objects.get(user=request.user)
+        member = request.member
         if not member.email_verified or not member.phone_verified:
             return HttpResponseForbidden("Måste verifiera email och telefon innan bokning!")
 
-        if activity.assigned == member:
+        result = booking.enlist(id, member)
+        activity = result.activity
+
+        if result.status == EnlistResult.ALREADY_ENLISTED:
             return Response("Du är redan bokad på denna uppgift")
 
-        if activity.assigned is not None:
-            if activity.active_delist_request is None:
-                return HttpResponseForbidden(f"Uppgiften är redan bokad av {activity.assigned.fullname}")
-            else:
-                logger.info("Transferring activity due to active ADR.")
+        if result.status == EnlistResult.TAKEN:
+            holder = activity.assigned.fullname if activity.assigned else "någon annan"
+            return HttpResponseForbidden(f"Uppgiften är redan bokad av {holder}")
 
-        if not activity.bookable:
+        if result.status == EnlistResult.NOT_BOOKABLE:
             return HttpResponseForbidden("Aktiviteten är inte bokningsbar")
 
-        adrs = ActivityDelistRequest.objects.filter(activity=activity, approved=None)
-        if adrs:
-            logger.info("Deleting delist requests for this member/activity")
-            adrs.delete()
-
-        activity.assigned = member
-        activity.save()
+        if result.status == EnlistResult.EVENT_LIMIT:
+            return HttpResponseForbidden("Du är redan bokad på en uppgift under denna aktivitet")
 
         return Response(f"Inbokad på {activity.name}")
 
@@ -110,7 +108,8 @@ class ADRByActivityView(APIView):
 
         return Response(self.serializer.to_representation(instance=model))
 
-class ADRList(mixins.ListModelMixin, generics.GenericAPIView):
+class ADRList(ConditionalGetMixin, generics.ListAPIView):
+    etag_tables = ['events', 'activities', 'members', 'refdata:activity_types']
     permission_classes = [IsAuthenticated]
     authentication_classes = [authentication.SessionAuthentication]
     parser_classes = [parsers.JSONParser]
@@ -125,10 +124,6 @@ class ADRList(mixins.ListModelMixin, generics.GenericAPIView):
 
         return self.queryset.filter(activity__assigned__user_id=self.request.user.id)
 
-    @method_decorator(never_cache)
-    def get(self, request, *args, **kwargs):
-        return self.list(request, *args, **kwargs)
-
 ##############################################################################
 
 url_patterns = [
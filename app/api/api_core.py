@@ -7,6 +7,8 @@ from django.apps import apps
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from django.http import HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound, StreamingHttpResponse
 from django.utils.decorators import method_decorator
+from django.utils.dateparse import parse_date
+from django.utils.http import parse_etags, quote_etag
 from django.contrib.auth.models import User
 from django.db.models.aggregates import Count
 from django.db.models import Q, OuterRef, Subquery
@@ -20,6 +22,7 @@ from rest_framework import authentication, generics, parsers, renderers, status
 from rest_framework.response import Response
 from rest_framework.permissions import IsAdminUser, IsAuthenticated, IsAuthenticatedOrReadOnly, AllowAny
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import NotFound
 from rest_framework.authtoken.views import obtain_auth_token, ObtainAuthToken
 from rest_framework.authtoken.models import Token
 from rest_framework import mixins
@@ -30,7 +33,9 @@ from app import models
 from app.models import Activity, ActivityType, Event, EventType, Member, \
     ActivityDelistRequest, RuleViolationException, FAQ
 
-from app import serializers
+from app import caching, refdata, serializers
+from app.conditional import ConditionalGetMixin
+from app.drf_defaults import NormalizedListMixin
 from app.serializers import ActivitySerializer, ActivityTypeSerializer, \
     AttachmentSerializer, EventSerializer, EventTypeSerializer, MemberSerializer, \
     EventActivitySerializer, FAQSerializer, UserSerializer
@@ -38,36 +43,43 @@ from app.serializers import ActivitySerializer, ActivityTypeSerializer, \
 logger = logging.getLogger(__name__)
 
 
-class MyActivitiesList(generics.ListAPIView):
-    queryset = Activity.objects.select_related('type', 'event').prefetch_related('event__type')
+class MyActivitiesList(ConditionalGetMixin, NormalizedListMixin, generics.ListAPIView):
+    etag_tables = ['events', 'activities', 'members', 'refdata:activity_types']
+    normalizer = staticmethod(serializers.normalized_activities)
+    queryset = Activity.objects.select_related('type', 'event', 'assigned__user') \
+        .prefetch_related('event__type')
     permission_classes = [IsAuthenticated]
     serializer_class = ActivitySerializer
 
     def get_queryset(self):
-        member = Member.objects.get(user=self.request.user)
+        member = self.request.member
         return self.queryset \
             .filter(Q(assigned=member) | Q(assigned_for_proxy=member),
                     event__start_date__year=datetime.date.today().year)
 
-    @method_decorator(never_cache)
-    def get(self, request, *args, **kwargs):
-        return super().get(request, *args, **kwargs)
-
 
 class ProxyActivityList(MyActivitiesList):
     def get_queryset(self):
-        member = Member.objects.get(user=self.request.user)
+        member = self.request.member
         proxy = member.proxies.get(id=self.kwargs['proxy_id'])
         return self.queryset.filter(assigned=proxy, assigned_for_proxy=member)
 
 
-class EventList(generics.ListAPIView):
+class EventList(ConditionalGetMixin, generics.ListAPIView):
+    etag_tables = ['events', 'activities', 'refdata:event_types']
+    public_max_age = 60
     queryset = Event.objects.select_related('type') \
         .prefetch_related('coordinators', 'coordinators__user', 'attachments',
                           'activities', )
 
     permission_classes = [IsAuthenticatedOrReadOnly]
 
+    def get_etag_tables(self):
+        # only the single event lists its coordinators with member details
+        if self.request.user.is_authenticated and 'id' in self.kwargs:
+            return self.etag_tables + ['members']
+        return self.etag_tables
+
     def get_serializer_class(self):
         if not self.request.user.is_authenticated:
             return serializers.EventPublicSerializer
@@ -86,89 +98,122 @@ class EventList(generics.ListAPIView):
             else:
                 year = self.request.query_params.get('year', today.year)
                 qs = self.queryset.filter(start_date__year=year)             
-                
-            available_activities = models.Activity.objects \
-                .filter(event=OuterRef('pk')) \
-                .filter(models.Event.activities_available_count_query()) \
-                .values('id')
 
-            qs = qs.order_by('start_date', 'end_date', 'name') \
-                .annotate(_activities_available_count=Count(Subquery(available_activities)))
+            qs = qs.order_by('start_date', 'end_date', 'name')
 
         if self.request.user.is_authenticated:
-            member = models.Member.objects.get(user=self.request.user)
+            member = self.request.member
             qs = qs.annotate(current_user_assigned=Count(
                 'activities', filter=Q(activities__assigned=member)))
 
         return qs
 
-    @method_decorator(never_cache)
-    def get(self, request, *args, **kwargs):
-        return super().get(request, *args, **kwargs)
+
+def roster_rows(event, license_types):
+    '''yields the CSV rows for an event's roster, using two queries'''
+    activities = models.Activity.objects \
+        .filter(event=event) \
+        .select_related('type', 'assigned__user')
+
+    licenses = {}
+    for member_id, type_id, level in models.License.objects \
+            .filter(member__activity__event=event) \
+            .values_list('member_id', 'type_id', 'level') \
+            .distinct():
+        licenses[(member_id, type_id)] = level
+
+    yield [event.name, str(event.start_date), event.type.name if event.type else '']
+    yield ['Beskrivning', 'Typ', 'Tid', 'Tilldelad', 'Telefon', 'Email'] + \
+        [lt.name for lt in license_types]
+
+    for a in activities:
+        row = [a.name, a.type.name if a.type else '', f'{a.start_time} - {a.end_time}']
+        if a.assigned:
+            row.append(a.assigned.fullname)
+            row.append(f'tel:{a.assigned.phone_number}')
+            row.append(a.assigned.email)
+            row.extend(licenses.get((a.assigned_id, lt.id), '') for lt in license_types)
+
+        yield row
+
+
+def csv_response(rows, filename, charset='windows-1252'):
+    '''streams rows (lists of str) as a semicolon separated CSV download'''
+    def csv():
+        for row in rows:
+            yield b''.join(col.encode(charset) + b';' for col in row) + b'\r\n'
+
+    try:
+        filename.encode('ascii')
+        file_expr = 'filename="{}"'.format(filename)
+    except UnicodeEncodeError:
+        file_expr = "filename*=utf-8''{}".format(quote(filename))
+
+    resp = StreamingHttpResponse(streaming_content=csv(), content_type='text/csv')
+    resp['Content-Disposition'] = f'attachment; {file_expr}'
+    return resp
 
 
 class EventCsv(generics.GenericAPIView):
-    queryset = Event.objects.prefetch_related('activities')
+    queryset = Event.objects.select_related('type').prefetch_related('coordinators')
     permission_classes = [IsAuthenticated]
     
     def get(self, request, *args, **kwargs):
         event = self.get_object()
+        license_types = list(models.LicenseType.objects.all())
 
-        licenseTypes = models.LicenseType.objects.all()
-        charset = 'windows-1252'
-
-        def yieldRow(row):
-            for col in row:
-                yield col.encode(charset)
-                yield b';'
-            yield b'\r\n'
-
-        def csv():
-            header1 = [event.name, str(event.start_date), event.type.name]
-            header2 = ['Beskrivning', 'Typ', 'Tid', 'Tilldelad', 'Telefon', 'Email']
-            for lt in licenseTypes:
-                header2.append(lt.name)
-
-            yield from yieldRow(header1)
-            yield from yieldRow(header2)
-
-            for a in event.activities.all():
-                row = [a.name, a.type.name, f'{a.start_time} - {a.end_time}']
-                if a.assigned:
-                    row.append(a.assigned.fullname)
-                    row.append(f'tel:{a.assigned.phone_number}')
-                    row.append(a.assigned.email)                
-
-                    for lt in licenseTypes:
-                        try:
-                            l = a.assigned.license_set.get(type=lt.id)
-                            row.append(l.level)
-                        except models.License.DoesNotExist:
-                            row.append('')
-
-                yield from yieldRow(row)
-
-        filename = f'{event.name}.csv'
-        try:
-            filename.encode('ascii')
-            file_expr = 'filename="{}"'.format(filename)
-        except UnicodeEncodeError:
-            file_expr = "filename*=utf-8''{}".format(quote(filename))
-
-        resp = StreamingHttpResponse(streaming_content=csv(), content_type='text/csv')
-        resp['Content-Disposition'] = f'attachment; {file_expr}'
-        return resp
+        return csv_response(roster_rows(event, license_types), f'{event.name}.csv')
 
     def check_object_permissions(self, request, obj):
         if not self.request.user.is_staff and \
-            not self.request.user.member in obj.coordinators.all():
-            return HttpResponseForbidden('Can only download CSV if staff or coordinator')
+            not self.request.member in obj.coordinators.all():
+            raise PermissionDenied('Can only download CSV if staff or coordinator')
 
         return super().check_object_permissions(request, obj)
 
 
+class EventsCsv(generics.GenericAPIView):
+    '''rosters for all events in a date range, ?from=YYYY-MM-DD&to=YYYY-MM-DD'''
+    queryset = Event.objects.select_related('type')
+    permission_classes = [IsAuthenticated]
 
-class EventActivities(generics.ListAPIView):
+    def get(self, request, *args, **kwargs):
+        def date_param(name, default):
+            value = request.query_params.get(name)
+            if value is None:
+                return default
+            # parse_date() gives None for a malformed and raises for an invalid date
+            date = parse_date(value)
+            if date is None:
+                raise ValueError(value)
+            return date
+
+        try:
+            start = date_param('from', datetime.date.today())
+            end = date_param('to', start)
+        except ValueError:
+            return HttpResponseBadRequest('Invalid date in from/to')
+
+        events = self.queryset \
+            .filter(start_date__lte=end, end_date__gte=start) \
+            .order_by('start_date', 'name')
+
+        if not request.user.is_staff:
+            events = events.filter(coordinators__user=request.user)
+
+        license_types = list(models.LicenseType.objects.all())
+
+        def rows():
+            for event in events.iterator():
+                yield from roster_rows(event, license_types)
+                yield []
+
+        return csv_response(rows(), f'{start} - {end}.csv')
+
+
+class EventActivities(ConditionalGetMixin, NormalizedListMixin, generics.ListAPIView):
+    etag_tables = ['events', 'activities', 'members', 'refdata:activity_types']
+    normalizer = staticmethod(serializers.normalized_activities)
     queryset = Activity.objects.select_related('type', 'assigned', 'event')
     permission_classes = [IsAuthenticatedOrReadOnly]
     serializer_class = EventActivitySerializer
@@ -182,12 +227,9 @@ class EventActivities(generics.ListAPIView):
 
         return self.queryset.filter(event=id)
 
-    @method_decorator(never_cache)
-    def get(self, request, *args, **kwargs):
-        return super().get(request, *args, **kwargs)
-
 
-class ActivityList(generics.ListAPIView, mixins.UpdateModelMixin):
+class ActivityList(ConditionalGetMixin, generics.ListAPIView, mixins.UpdateModelMixin):
+    etag_tables = ['events', 'activities', 'members', 'refdata:event_types', 'refdata:activity_types']
     queryset = Activity.objects
     serializer_class = ActivitySerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
@@ -202,10 +244,6 @@ class ActivityList(generics.ListAPIView, mixins.UpdateModelMixin):
             .filter(id=pk) \
             .select_related('type', 'event', 'assigned')
 
-    @method_decorator(never_cache)
-    def get(self, request, *args, **kwargs):
-        return super().get(request, *args, **kwargs)
-
     def patch(self, request, pk):
         activity = self.get_queryset().first()
 
@@ -213,7 +251,7 @@ class ActivityList(generics.ListAPIView, mixins.UpdateModelMixin):
             raise ObjectDoesNotExist()
 
         if not self.request.user.is_staff and \
-                (not activity.assigned or activity.assigned.user != self.request.user):
+                activity.assigned_id != self.request.member.id:
             raise PermissionDenied(
                 "Can only modify comment if staff that you are assigned to")
 
@@ -225,74 +263,96 @@ class ActivityList(generics.ListAPIView, mixins.UpdateModelMixin):
         return self.partial_update(request, pk)
 
 
-class EventTypeList(generics.ListAPIView):
-    queryset = EventType.objects
-    serializer_class = EventTypeSerializer
-    permission_classes = [IsAuthenticatedOrReadOnly]
-    read_only = True
+class RefDataList(generics.ListAPIView):
+    '''
+    lists a reference table from app.refdata without touching the database,
+    an If-None-Match matching the table version gives 304 Not Modified
+    '''
+    table = None
+    lookup_kwargs = ['id', 'pk']
 
-    def get_queryset(self):
-        try:
-            id = self.kwargs['id']
-        except KeyError:
-            return self.queryset.all()
+    def get(self, request, *args, **kwargs):
+        entry = refdata.get(self.table)
+        etag = quote_etag(entry.etag)
 
-        return self.queryset.filter(id=id)
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(self.get_data(entry))
+
+        response['ETag'] = etag
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    def get_data(self, entry):
+        for kwarg in self.lookup_kwargs:
+            if kwarg in self.kwargs:
+                row = entry.by_pk.get(self.to_pk(self.kwargs[kwarg]))
+                data = [row] if row else []
+                break
+        else:
+            data = entry.data
 
-    @method_decorator(never_cache)
-    def get(self, request, *args, **kwargs):
-        return super().get(request, *args, **kwargs)
+        page = self.paginate_queryset(data)
+        if page is not None:
+            return self.get_paginated_response(page).data
+        return data
 
+    def to_pk(self, value):
+        return int(value) if value.isdigit() else value
 
-class ActivityTypeList(generics.ListAPIView):
-    queryset = ActivityType.objects
-    serializer_class = ActivityTypeSerializer
-    permission_classes = [IsAuthenticatedOrReadOnly]
-    authentication_classes = [authentication.SessionAuthentication]
-    read_only = True
 
-    def get_queryset(self):
-        try:
-            id = self.kwargs['id']
-        except KeyError:
-            return self.queryset.all()
+class EventTypeList(RefDataList):
+    table = 'event_types'
+    permission_classes = [IsAuthenticatedOrReadOnly]
 
-        return self.queryset.filter(id=id)
 
-    @method_decorator(never_cache)
-    def get(self, request, *args, **kwargs):
-        return super().get(request, *args, **kwargs)
+class ActivityTypeList(RefDataList):
+    table = 'activity_types'
+    permission_classes = [IsAuthenticatedOrReadOnly]
+    authentication_classes = [authentication.SessionAuthentication]
 
 
-class FAQList(generics.ListAPIView):
-    queryset = models.FAQ.objects.all()
-    serializer_class = FAQSerializer
+class FAQList(RefDataList):
+    table = 'faq'
     permission_classes = [AllowAny]
-    read_only = True
 
 
-class InfoTextList(generics.RetrieveAPIView):
-    queryset = models.InfoText.objects.all()
-    serializer_class = serializers.InfoTextSerializer
+class InfoTextList(RefDataList):
+    table = 'info_texts'
     permission_classes = [AllowAny]
-    read_only = True
 
-class CarClassList(generics.ListAPIView):
-    queryset = models.CarClass.objects.all()
-    serializer_class = serializers.CarClassSerializer
+    def get_data(self, entry):
+        try:
+            return entry.by_pk[self.kwargs['pk']]
+        except KeyError:
+            raise NotFound()
+
+
+class CarClassList(RefDataList):
+    table = 'car_classes'
     permission_classes = [AllowAny]
-    read_only = True
     pagination_class = None
 
-class LicenseTypeList(generics.ListAPIView):
-    queryset = models.LicenseType.objects.all()
-    serializer_class = serializers.LicenseTypeSerializer
+
+class LicenseTypeList(RefDataList):
+    table = 'license_types'
     permission_classes = [AllowAny]
-    read_only = True
     pagination_class = None
 
 
 
+class CacheStatus(APIView):
+    '''cache backend and hit/miss/invalidation counters per key prefix of this worker process'''
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response({
+            'backend': settings.CACHES['default']['BACKEND'],
+            'prefixes': caching.stats(),
+        })
+
+
 ##############################################################################
 
 
@@ -309,6 +369,7 @@ url_patterns = [
     re_path(r'events/(?P<upcoming>upcoming)', EventList.as_view()),
     re_path(r'events/(?P<id>[0-9]+)$', EventList.as_view()),
     re_path(r'events/(?P<pk>[0-9]+)/csv$', EventCsv.as_view()),
+    re_path(r'events/csv$', EventsCsv.as_view()),
 
     path('event_type', EventTypeList.as_view()),
     re_path(r'event_type/(?P<id>[0-9]+)', EventTypeList.as_view()),
@@ -322,6 +383,8 @@ url_patterns = [
     path(r'licensetype', LicenseTypeList.as_view()),
     re_path(r'licensetype/(?P<pk>[\w-]+)', LicenseTypeList.as_view()),
 
+    path('cache/status', CacheStatus.as_view()),
+
     path('faq', FAQList.as_view()),
     re_path(r'infotext/(?P<pk>[\w-]+)', InfoTextList.as_view())
 ]
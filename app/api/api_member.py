@@ -6,10 +6,12 @@ import json
 from django.urls import path, re_path
 from django.apps import apps
 from django.core.exceptions import PermissionDenied, FieldDoesNotExist
-from django.http import HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound, HttpResponse
+from django.http import HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.contrib.auth.models import User
-from django.db.models import Sum, Q, Count
+from django.db.models import Sum, Q, Count, F, Value, Exists, OuterRef, TimeField
+from django.db.models.functions import Coalesce, Concat
 from django.db import transaction
 from django.db import IntegrityError
 
@@ -23,11 +25,14 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAdminUser, IsAuthenticated, IsAuthenticatedOrReadOnly, AllowAny
 from rest_framework.decorators import api_view, permission_classes, parser_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework.authtoken.views import obtain_auth_token, ObtainAuthToken
 from rest_framework.authtoken.models import Token
 from rest_framework.parsers import JSONParser
 
-from app import models, serializers
+from app import conditional, models, serializers
+from app.conditional import ConditionalGetMixin
+from app.drf_defaults import DefaultResultsSetPagination, KeysetPagination
 
 from app.notifications import NotificationData, NotificationDataSerializer
 from http import HTTPStatus
@@ -37,7 +42,8 @@ logger = logging.getLogger(__name__)
 
 MIN_ACTIVITY_SIGNUPS = int(apps.get_app_config('app').MIN_ACTIVITY_SIGNUPS)
 
-class MemberList(generics.ListAPIView, mixins.UpdateModelMixin, mixins.CreateModelMixin):
+class MemberList(ConditionalGetMixin, generics.ListAPIView, mixins.UpdateModelMixin, mixins.CreateModelMixin):
+    etag_tables = ['members']
     queryset = models.Member.objects.select_related('user')
     permission_classes = [IsAuthenticated]
 
@@ -55,10 +61,6 @@ class MemberList(generics.ListAPIView, mixins.UpdateModelMixin, mixins.CreateMod
         else:
             return serializers.MemberSerializer
 
-    @method_decorator(never_cache)
-    def get(self, request, *args, **kwargs):
-        return super().get(request, *args, **kwargs)
-
     def patch(self, request, *args, **kwargs):
         try:
             return self.partial_update(request, *args, **kwargs)
@@ -70,7 +72,7 @@ class MemberList(generics.ListAPIView, mixins.UpdateModelMixin, mixins.CreateMod
     def check_object_permissions(self, request, obj):
         if request.method.upper() == 'PATCH' \
                 and not request.user.is_staff \
-                and request.user.member.id != obj.id:
+                and request.member.id != obj.id:
             raise PermissionDenied(
                 "Can only PATCH self, or proxies who haven't logged in themselves yet (unless is staff).")
 
@@ -128,7 +130,7 @@ class MemberList(generics.ListAPIView, mixins.UpdateModelMixin, mixins.CreateMod
             raise IntegrityError(
                 f"A user with phone number '{phone}' already exists!")
 
-        proxy_for = models.Member.objects.get(user_id=self.request.user.id)
+        proxy_for = self.request.member
 
         with transaction.atomic():
             user = User(username=email, email=email,
@@ -184,50 +186,34 @@ class DoubleBookedMembersList(generics.ListAPIView):
     serializer_class = serializers.DoubleBookedSerializer
 
     def get_queryset(self):
-        current_year = datetime.date.today().year
-
-        # does not count only non-unique assigned activities ...  :-|
-        events = models.Event.objects \
-            .filter(start_date__year=current_year) \
-            .annotate(doublebooking=Count("activities__assigned")) \
-            .filter(doublebooking__gte=2) \
-            .order_by()
-
-        print(f"Found {len(events)} event(s) with potential double booking")
-        print(events)
-        values = []
-
-        for e in events:
-            acts = e.activities.exclude(
-                assigned=None).values('assigned', 'comment')
-            aa = [a['assigned'] for a in acts]
-            dbu = set(a for a in aa if aa.count(a) >= 2)
-
-            if len(dbu) == 0:
-                continue
-
-            print(f"{e.name} has {len(dbu)} double booked user(s)")
-            print(dbu)
-
-            for m in dbu:
-                assigned_for_user = e.activities.filter(
-                    assigned=m).select_related('assigned')
-                for a in assigned_for_user:
-                    other_comments = [d['comment'] for d in assigned_for_user.exclude(
-                        id=a.id).values('comment')]
-                    if a.comment in other_comments:
-                        # print(a)
-                        values.append({
-                            'assigned_id': a.assigned.id,
-                            'assigned_fullname': a.assigned.fullname,
-                            'event_id': e.id,
-                            'event_name': e.name,
-                            'activity_id': a.id,
-                            'activity_name': a.name,
-                            'activity_comment': a.comment,
-                        })
-
-        return sorted(values, key=lambda v: (v['assigned_fullname'], v['event_id']))
+        try:
+            year = int(self.request.query_params.get('year', datetime.date.today().year))
+        except ValueError:
+            raise ValidationError({'year': "Invalid year"})
+
+        # same member on several activities in an event with the same comment
+        same_booking = models.Activity.objects \
+            .filter(event=OuterRef('event'), assigned=OuterRef('assigned'),
+                    comment=OuterRef('comment')) \
+            .order_by() \
+            .values('event', 'assigned', 'comment') \
+            .annotate(bookings=Count('id')) \
+            .filter(bookings__gt=1)
+
+        return models.Activity.objects \
+            .filter(event__start_date__year=year) \
+            .exclude(assigned=None) \
+            .annotate(double_booked=Exists(same_booking)) \
+            .filter(double_booked=True) \
+            .annotate(assigned_fullname=Concat('assigned__user__first_name', Value(' '),
+                                               'assigned__user__last_name'),
+                      event_name=F('event__name'),
+                      activity_id=F('id'),
+                      activity_name=F('name'),
+                      activity_comment=F('comment')) \
+            .values('assigned_id', 'assigned_fullname', 'event_id', 'event_name',
+                    'activity_id', 'activity_name', 'activity_comment') \
+            .order_by('assigned_fullname', 'event_id', 'activity_id')
 
 
 class MemberLicenseList(generics.ListAPIView, mixins.CreateModelMixin, mixins.UpdateModelMixin, mixins.DestroyModelMixin):
@@ -279,7 +265,7 @@ class MemberLicenseList(generics.ListAPIView, mixins.CreateModelMixin, mixins.Up
 
     def check_object_permissions(self, request, obj):
         if self.request.method.upper() in ['DELETE', 'PATCH', 'PUT'] \
-            and self.request.user.member.id != obj.member.id:
+            and self.request.member.id != obj.member_id:
             return HttpResponseForbidden('Can only modify licenses for self')
 
         return super().check_object_permissions(request, obj)
@@ -335,7 +321,7 @@ class MemberDriverList(generics.ListAPIView, mixins.CreateModelMixin, mixins.Upd
 
     def check_object_permissions(self, request, obj):
         if self.request.method.upper() in ['DELETE', 'PATCH', 'PUT'] \
-            and self.request.user.member.id != obj.member.id:
+            and self.request.member.id != obj.member_id:
             return HttpResponseForbidden('Can only modify drivers for self')
 
         return super().check_object_permissions(request, obj)
@@ -343,8 +329,26 @@ class MemberDriverList(generics.ListAPIView, mixins.CreateModelMixin, mixins.Upd
 
 
 class CompletionsList(generics.ListAPIView):
+    '''
+    Assigned activities that might need confirmation, page by page. With
+    ?cursor= (empty for the first page) it uses keyset pagination instead,
+    ?stream=1 returns the whole selection as one streamed JSON array.
+    '''
     permission_classes = [IsAdminUser]
     serializer_class = serializers.CompletionSerializer
+    ordering = ('-start_date', 'from_time', 'activity_id')
+    # plain column references, so the seek is an index range scan; rows of an
+    # event come in id order rather than by start time
+    keyset_ordering = ('-start_date', 'event_id', 'activity_id')
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if 'cursor' in self.request.query_params:
+                self._paginator = KeysetPagination(ordering=self.keyset_ordering)
+            else:
+                self._paginator = DefaultResultsSetPagination()
+        return self._paginator
 
     def get_queryset(self):
         today = datetime.date.today()
@@ -354,8 +358,7 @@ class CompletionsList(generics.ListAPIView):
             .exclude(assigned=None) \
             .exclude(cancelled=True) \
             .filter(event__start_date__year=today.year) \
-            .filter(event__start_date__lte=today) \
-            .order_by('-event__start_date', 'start_time') 
+            .filter(event__start_date__lte=today)
 
         user_filter = self.request.GET.get('filter', None)
 
@@ -366,27 +369,46 @@ class CompletionsList(generics.ListAPIView):
             acts = acts.exclude(completed=True, 
                 event__start_date__lt=last_week) 
 
-        print(f"Found {len(acts)} activities that might need confirmation")
-        #print(acts)
-        values = []
-
-        for a in acts:
-            e = a.event
-            start_date = datetime.datetime.combine(date=e.start_date, time=a.start_time or datetime.time(0, 0))
-            end_date = datetime.datetime.combine(date=e.end_date, time=a.end_time or datetime.time(0, 0))
-            values.append({
-                'assigned_id': a.assigned.id,
-                'assigned_fullname': a.assigned.fullname,
-                'event_id': e.id,
-                'event_name': e.name,
-                'activity_id': a.id,
-                'activity_name': a.name,
-                'completed': a.completed,
-                'start_date': start_date,
-                'end_date': end_date
-            })
-
-        return values
+        midnight = Value(datetime.time(0, 0), output_field=TimeField())
+
+        return acts \
+            .annotate(assigned_fullname=Concat('assigned__user__first_name', Value(' '),
+                                               'assigned__user__last_name'),
+                      event_name=F('event__name'),
+                      activity_id=F('id'),
+                      activity_name=F('name'),
+                      start_date=F('event__start_date'),
+                      end_date=F('event__end_date'),
+                      from_time=Coalesce('start_time', midnight),
+                      to_time=Coalesce('end_time', midnight)) \
+            .values('assigned_id', 'assigned_fullname', 'event_id', 'event_name',
+                    'activity_id', 'activity_name', 'completed',
+                    'start_date', 'from_time', 'end_date', 'to_time') \
+            .order_by(*self.ordering)
+
+    @staticmethod
+    def completion(row):
+        return dict(row,
+            start_date=datetime.datetime.combine(date=row['start_date'], time=row['from_time']),
+            end_date=datetime.datetime.combine(date=row['end_date'], time=row['to_time']))
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
+
+        if request.query_params.get('stream'):
+            return StreamingHttpResponse(self.stream(queryset), content_type='application/json')
+
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer([self.completion(r) for r in page], many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def stream(self, queryset):
+        serializer = self.get_serializer()
+        separator = '['
+        for row in queryset.iterator(chunk_size=500):
+            yield separator + json.dumps(serializer.to_representation(self.completion(row)))
+            separator = ',\n'
+        yield '[]' if separator == '[' else ']'
 
 
 @api_view(['PATCH'])
@@ -416,6 +438,70 @@ def set_completed(request, activity_id):
     return Response({'activity_id': activity_id, 
                      'completed': activity.completed})
 
+
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+@parser_classes([JSONParser])
+def set_completed_bulk(request):
+    '''
+    Sets completed on many activities, expects a list of
+    {activity_id, completed} and returns a result per item.
+    '''
+    if not isinstance(request.data, list):
+        return HttpResponseBadRequest("Expected a list of {activity_id, completed}")
+
+    try:
+        items = [(int(i['activity_id']), i['completed']) for i in request.data]
+    except (KeyError, TypeError, ValueError):
+        return HttpResponseBadRequest("Expected a list of {activity_id, completed}")
+
+    if any(not (c is None or isinstance(c, bool)) for _, c in items):
+        return HttpResponseBadRequest("'completed' must be true, false or null")
+
+    today = datetime.date.today()
+    activities = {
+        a['id']: a for a in models.Activity.objects
+            .filter(id__in=[i for i, _ in items])
+            .values('id', 'assigned_id', 'assigned_for_proxy_id', 'cancelled',
+                    'event__start_date')}
+
+    results = []
+    changes = {}
+
+    for activity_id, completed in items:
+        a = activities.get(activity_id)
+        if a is None:
+            error = "Activity not found"
+        elif a['event__start_date'] > today:
+            error = "Activity is in the future"
+        elif a['assigned_id'] is None:
+            error = "Activity is not assigned"
+        elif a['cancelled']:
+            error = "Activity is cancelled"
+        else:
+            error = None
+            changes[activity_id] = completed
+
+        results.append({'activity_id': activity_id, 'completed': completed,
+                        'ok': error is None, 'error': error})
+
+    with transaction.atomic():
+        for value in [True, False, None]:
+            ids = [i for i, c in changes.items() if c is value]
+            if ids:
+                models.Activity.objects.filter(id__in=ids).update(
+                    completed=value, modified=timezone.now())
+
+        # update() bypasses signals, keep the season ledger and ETags in step
+        conditional.changed('activities')
+        models.MemberSeason.refresh_many(
+            (activities[i][field], activities[i]['event__start_date'].year)
+            for i in changes
+            for field in ['assigned_id', 'assigned_for_proxy_id'])
+
+    logger.info(f"Set completed on {len(changes)} of {len(items)} activities")
+    return Response(results)
+
 ##############################################################################
 
 url_patterns = [
@@ -427,6 +513,7 @@ url_patterns = [
     re_path(r'^members/double_booked/', DoubleBookedMembersList.as_view()),
     re_path(r'^members/completions/', CompletionsList.as_view()),
     re_path(r'^members/set_completed/(?P<activity_id>\d+)', set_completed),
+    re_path(r'^members/set_completed/?$', set_completed_bulk),
 
     re_path(r'^member/((?P<member_id>\d+)/)?license/(?P<id>[0-9]+)?$', MemberLicenseList.as_view()),
     re_path(r'^member/((?P<member_id>\d+)/)?driver/(?P<id>[0-9]+)?$', MemberDriverList.as_view())
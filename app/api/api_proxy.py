@@ -20,6 +20,8 @@ from rest_framework.permissions import IsAdminUser, IsAuthenticated, IsAuthentic
 from rest_framework.decorators import api_view
 
 import app.models as models
+import app.booking as booking
+from app.booking import EnlistResult
 import app.serializers as serializers
 import app.notifications as notifications
 
@@ -51,8 +53,7 @@ class MySuperProxiesList(generics.ListAPIView):
     serializer_class = serializers.MemberSerializer
 
     def get_queryset(self):
-        member = models.Member.objects.get(user=self.request.user.id)
-        return self.queryset.filter(proxies=member.id)
+        return self.queryset.filter(proxies=self.request.member.id)
 
 
 class ProxyConnector(generics.GenericAPIView):
@@ -75,11 +76,11 @@ class ProxyConnector(generics.GenericAPIView):
 
     def delete(self, request, proxy_id):
         try:
-            proxy = models.Member.get(id=proxy_id)
+            proxy = models.Member.objects.get(id=proxy_id)
         except models.Member.DoesNotExist:
             return HttpResponseNotFound()
 
-        member = models.Member.get(user_id=self.request.user.id)
+        member = self.request.member
         member.proxies.remove(proxy)
         member.save()
 
@@ -94,7 +95,7 @@ class ActivityByProxyEnlister(APIView):
     def get(self, request, activity_id, proxy_id):
         activity = models.Activity.objects.get(id=activity_id)
         proxy = models.Member.objects.get(id=proxy_id)
-        master = models.Member.objects.get(user=self.request.user)
+        master = self.request.member
 
         return Response(
             data={'proxy_assigned': (
@@ -103,35 +104,34 @@ class ActivityByProxyEnlister(APIView):
 
     def put(self, request, activity_id, proxy_id):
         proxy = models.Member.objects.get(id=proxy_id)
-        master = models.Member.objects.get(user=self.request.user)
+        master = self.request.member
 
         if not master in proxy.proxy.all():
             raise NotYourProxy(
                 f"Proxy {proxy} not registered to act on behalf of {master}.")
 
-        activity = models.Activity.objects.select_related('event').get(id=activity_id)
+        logger.info(
+            f"Assigning activity {activity_id} to {proxy} on behalf of {master}.")
+
+        result = booking.enlist(activity_id, proxy, for_proxy=master)
+        activity = result.activity
 
-        if activity.assigned is not None:
+        if result.status in [EnlistResult.ALREADY_ENLISTED, EnlistResult.TAKEN]:
             raise PermissionDenied(
                 f"Activity {activity} already assigned to someone.")
 
-        if models.Activity.objects.filter(event=activity.event, assigned=proxy).exists():
+        if result.status == EnlistResult.NOT_BOOKABLE:
+            raise PermissionDenied(f"Activity {activity} is not bookable.")
+
+        if result.status == EnlistResult.EVENT_LIMIT:
             raise PermissionDenied(
                 f"Proxy {proxy} already assigned to event {activity.event}.")
 
-        logger.info(
-            f"Assigning activity {activity} to {proxy} on behalf of {master}.")
-
-        activity.assigned = proxy
-        activity.assigned_for_proxy = master
-        activity.assigned_at = datetime.datetime.now()
-        activity.save()
-
         return Response(f"{proxy} is now assigned for {activity} on behalf of {master}.")
 
     def delete(self, request, activity_id, proxy_id):
         proxy = models.Member.objects.get(id=proxy_id)
-        master = models.Member.objects.get(user=self.request.user)
+        master = self.request.member
 
         if not master in proxy.proxy.all():
             raise NotYourProxy(
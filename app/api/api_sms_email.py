@@ -1,4 +1,4 @@
-import datetime, logging, random, string
+import datetime, json, logging, random, string
 
 from django.conf import settings
 from django.urls import path, re_path
@@ -7,7 +7,7 @@ from django.views.decorators.cache import cache_page, cache_control, never_cache
 from django.views.decorators.vary import vary_on_cookie
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-from django.http import HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound, HttpResponseRedirect
 from django.core.mail import send_mail, send_mass_mail
 
 from rest_framework.views import APIView
@@ -19,69 +19,95 @@ from rest_framework.authtoken.views import obtain_auth_token, ObtainAuthToken
 from rest_framework.authtoken.models import Token
 from rest_framework import mixins
 
-from twilio.rest import Client as TwilioClient
+from twilio.base.exceptions import TwilioException
 
-from app import events
+from app import events, sms
+from app.models import InboundSMS
+from app import breaker as breakers
+from app.breaker import CircuitOpen, breaker, not_client_error
 
 logger = logging.getLogger(__name__)
 
 
 class ReceiveSMS(APIView):
+    '''Twilio webhook for incoming SMS.
+
+    Only stores the message and acknowledges it, the process_inbox command
+    acts on it later. Twilio retries are ignored by MessageSid.
+    '''
     parser_classes = [parsers.JSONParser,
                       parsers.MultiPartParser, parsers.FormParser]
     permission_classes = [AllowAny]
+    authentication_classes = []
+
+    EMPTY_TWIML = '<?xml version="1.0" encoding="UTF-8"?><Response></Response>'
 
     @method_decorator(csrf_exempt)
     def post(self, request, *args, **kwargs):
-        sid = self.serializer.object['AccountSid']
-        msgsid = self.serializer.object['MessagingServiceSid']
+        data = request.data
+        sid = data.get('AccountSid')
 
-        if sid != settings.TWILIO_ACCOUNT_SID:
-            logger.warning(
-                f"Got SMS via invalid SID\n{self.serializer.object}")
-            raise HttpResponseForbidden('Invalid SID')
+        if not sid or sid != settings.TWILIO_ACCOUNT_SID:
+            logger.warning(f"Got SMS via invalid SID\n{data}")
+            return HttpResponseForbidden('Invalid SID')
 
-        body = self.serializer.object['Body']
-        from_ = self.serializer.object['From']
-        to = self.serializer.object['To']
+        message_sid = data.get('MessageSid') or data.get('SmsSid')
+        if not message_sid:
+            return HttpResponseBadRequest('Missing MessageSid')
 
-        logger.info(f'Received SMS from {from_} to {to} via {msgsid}: "{body}"')
+        # a single INSERT, retried deliveries of the same message are ignored
+        InboundSMS.objects.bulk_create([InboundSMS(
+            message_sid=message_sid,
+            from_number=data.get('From', ''),
+            to_number=data.get('To', ''),
+            body=data.get('Body', ''),
+            payload=json.dumps({k: data.get(k) for k in data}))],
+            ignore_conflicts=True)
 
+        logger.info(f'Received SMS {message_sid} from {data.get("From")}: "{data.get("Body")}"')
 
-class VerifyPhone(APIView):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._client = TwilioClient(
-            settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+        return HttpResponse(self.EMPTY_TWIML, content_type='text/xml')
 
+
+class VerifyPhone(APIView):
     parser_classes = [parsers.JSONParser]
     permission_classes = [IsAuthenticated]
 
+    def _verify(self):
+        return sms.twilio_client().verify.services(settings.TWILIO_VERIFY_SID)
+
     def _start_verify(self, phone):
         logger.info(f"Creating verification for {phone}")
 
-        verification = self._client.verify \
-            .services(settings.TWILIO_VERIFY_SID) \
-            .verifications \
-            .create(to=phone, channel='sms')
-
-        return verification
+        return breaker('twilio_verify').call(
+            lambda: self._verify().verifications.create(to=phone, channel='sms'))
 
     def _check_verify(self, phone, code):
         logger.info(f"Checking verification for {phone}")
 
-        verification_check = self._client.verify \
-            .services(settings.TWILIO_VERIFY_SID) \
-            .verification_checks \
-            .create(to=phone, code=code)
-
-        return verification_check
+        return breaker('twilio_verify').call(
+            lambda: self._verify().verification_checks.create(to=phone, code=code))
 
     def post(self, request, action, code=None):
-        member = request.user.member
+        member = request.member
         if member.phone_number is None:
             return HttpResponseForbidden("Member does not have a phone number")
 
+        try:
+            return self._post(member, action, code)
+        except CircuitOpen as e:
+            logger.warning(f"Phone verification unavailable: {e}")
+            return Response("SMS-verifiering är inte tillgänglig just nu, försök igen senare.",
+                            status=503, headers={'Retry-After': f'{e.retry_after:.0f}'})
+        except (TwilioException, OSError) as e:
+            if not_client_error(e):
+                logger.error(f"Phone verification failed: {e}")
+                return Response("SMS-verifiering misslyckades, försök igen senare.", status=502)
+
+            logger.info(f"Phone verification rejected: {e}")
+            return Response("Ogiltig begäran om SMS-verifiering.", status=400)
+
+    def _post(self, member, action, code):
         if action == 'send':
             v = self._start_verify(member.phone_number)
             if v.sid is None:
@@ -130,7 +156,7 @@ class VerifyEmail(APIView):
         return True
 
     def get(self, request, action, code):
-        member = request.user.member
+        member = request.member
 
         if action == 'check':            
             ok = self._check(member, code)
@@ -142,7 +168,7 @@ class VerifyEmail(APIView):
             return HttpResponseNotFound()
 
     def post(self, request, action, code=None):
-        member = request.user.member
+        member = request.member
 
         if action == 'send':
             chars = string.ascii_letters + string.digits
@@ -161,8 +187,17 @@ class VerifyEmail(APIView):
 ##############################################################################
 
 
+class ProviderStatus(APIView):
+    '''circuit breaker states and transition counters of this worker process'''
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(breakers.stats())
+
+
 url_patterns = [
     path('sms', ReceiveSMS.as_view()),
+    path('providers/status', ProviderStatus.as_view()),
     re_path(
         r'verify/phone/(?P<action>[a-z]+)(/(?P<code>\w+))?', VerifyPhone.as_view()),
     re_path(
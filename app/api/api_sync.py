@@ -0,0 +1,151 @@
+import datetime
+import logging
+
+from django.urls import path
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.db.models import Count, Prefetch, Q
+
+from rest_framework.views import APIView
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.permissions import IsAuthenticated
+
+from app import live, serializers
+from app.models import Activity, ActivityDelistRequest, Event, Tombstone
+
+logger = logging.getLogger(__name__)
+
+# rows are looked up this far before the cursor, so that rows stamped before
+# the cursor was taken but committed after it are not missed. Clients apply
+# rows by id, receiving some of them twice does no harm.
+OVERLAP = datetime.timedelta(seconds=10)
+
+# longest wait of a long-poll, short so that no request holds a worker for
+# long, clients just ask again with the new cursor
+WAIT_SECONDS = 20
+
+
+class ChangeList(APIView):
+    '''
+    Delta sync of events, activities and delist requests.
+
+    GET changes returns just a cursor, take it before loading the full lists.
+    GET changes?since=<cursor> returns the rows modified since then, the ids
+    of deleted rows and the cursor for the next call. A cursor older than
+    Tombstone.RETENTION gives 410 Gone, the client must reload everything.
+
+    With &wait=<seconds>, at most WAIT_SECONDS, this is a long-poll: when
+    nothing changed since the cursor the answer waits for the next change
+    published by app.live, or the timeout.
+    '''
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        if 'since' not in request.query_params:
+            return Response({'cursor': timezone.now().isoformat()})
+
+        try:
+            since = parse_datetime(request.query_params['since'])
+        except ValueError:
+            since = None
+        if since is None:
+            return Response({'detail': "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+        if timezone.is_aware(since):
+            # cursors are naive local times, as USE_TZ is off
+            since = timezone.make_naive(since)
+        if since < timezone.now() - Tombstone.RETENTION:
+            return Response({'detail': "Cursor has expired, reload"}, status=status.HTTP_410_GONE)
+
+        try:
+            wait = float(request.query_params.get('wait', 0))
+        except ValueError:
+            wait = None
+        if wait is None or not wait >= 0:
+            return Response({'detail': "Invalid wait"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not wait:
+            return Response(self.changes(request, since)[0])
+
+        # subscribed before looking, so that a change committed meanwhile wakes us
+        subscription = live.broker.subscribe('all', accepts=_delist_request_filter(request))
+        try:
+            result, changed = self.changes(request, since)
+            if not changed:
+                try:
+                    woken = subscription.get(min(wait, WAIT_SECONDS)) is not None
+                except live.Overflow:
+                    woken = True
+                if woken:
+                    result, _ = self.changes(request, since)
+        finally:
+            live.broker.unsubscribe(subscription)
+
+        return Response(result)
+
+    def changes(self, request, since):
+        '''
+        the result for since, and whether anything changed after since itself
+        rather than only in the overlap before it
+        '''
+        now = timezone.now()
+        result = {'cursor': now.isoformat()}
+        member = request.member
+        context = {'request': request}
+
+        events = Event.objects \
+            .filter(modified__gte=since - OVERLAP) \
+            .annotate(current_user_assigned=Count(
+                'activities', filter=Q(activities__assigned=member))) \
+            .prefetch_related('attachments', Prefetch(
+                'activities', queryset=Activity.objects.only('id', 'event')))
+        activities = Activity.objects \
+            .filter(modified__gte=since - OVERLAP) \
+            .select_related('assigned__user', 'event') \
+            .prefetch_related('attachments', 'delist_requests',
+                              'assigned__license_set', 'assigned__driver_set')
+        delist_requests = ActivityDelistRequest.objects.filter(modified__gte=since - OVERLAP)
+        if not request.user.is_staff:
+            delist_requests = delist_requests.filter(
+                Q(member=member) | Q(activity__assigned=member))
+
+        changed = False
+        deleted = {table: [] for table, _ in Tombstone.TABLE_CHOICES}
+        for table, object_id, when in Tombstone.objects \
+                .filter(deleted__gte=since - OVERLAP) \
+                .values_list('table', 'object_id', 'deleted'):
+            deleted[table].append(object_id)
+            changed = changed or when >= since
+
+        result.update({
+            Tombstone.EVENT: serializers.EventListSerializer(
+                events, many=True, context=context).data,
+            Tombstone.ACTIVITY: serializers.EventActivitySerializer(
+                activities, many=True, context=context).data,
+            Tombstone.DELIST_REQUEST: serializers.ActivityDelistRequestSerializer(
+                delist_requests, many=True, context=context).data,
+            'deleted': deleted,
+        })
+
+        # the querysets are evaluated by now, this doesn't query again
+        changed = changed or any(row.modified >= since for rows in
+                                 (events, activities, delist_requests) for row in rows)
+        return result, changed
+
+
+def _delist_request_filter(request):
+    '''like ChangeList, members only see delist requests they made or must answer'''
+    if request.user.is_staff:
+        return None
+
+    member_id = request.member.id if request.member else None
+    return lambda message: message['kind'] != 'delist_request' or \
+        member_id in (message['member'], message['assigned'])
+
+
+##############################################################################
+
+
+url_patterns = [
+    path('changes', ChangeList.as_view()),
+]
@@ -4,7 +4,8 @@ import logging
 from django.urls import path, re_path
 from django.apps import apps
 from django.core.exceptions import PermissionDenied, FieldDoesNotExist
-from django.http import HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound
+from django.http import HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound, HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
 from django.utils.decorators import method_decorator
 from django.contrib.auth.models import User
 from django.db.models import Sum, Q
@@ -32,6 +33,7 @@ from app.serializers import ActivitySerializer, ActivityTypeSerializer, \
 
 from app import serializers
 
+from app import notifications
 from app.notifications import NotificationData, NotificationDataSerializer
 
 logger = logging.getLogger(__name__)
@@ -78,15 +80,23 @@ class IsLoggedIn(generics.GenericAPIView, mixins.RetrieveModelMixin):
     serializer_class = NotificationDataSerializer
 
     def get(self, request, *args, **kwargs):
-        return super().retrieve(request, *args, **kwargs)
+        if not request.user.is_authenticated:
+            return super().retrieve(request, *args, **kwargs)
 
-    def get_object(self):
-        if self.request.user.is_authenticated:
-            member = models.Member.objects.get(user=self.request.user)
+        etag, payload = notifications.cached_payload(request.user)
+        etag = quote_etag(etag)
+
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
         else:
-            member = None
+            response = Response(payload)
 
-        return NotificationData(member)
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def get_object(self):
+        return NotificationData(None)
 
 
 ##############################################################################
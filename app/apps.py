@@ -9,3 +9,8 @@ class ActivityListAppConfig(AppConfig):
     # app specific settings, should probably be in a db config object
     # and show on start page
     MIN_ACTIVITY_SIGNUPS = 5
+
+    def ready(self):
+        # registers signal handlers keeping cached notification data,
+        # reference tables and API ETags fresh, and waking the change long-polls
+        from app import conditional, live, notifications, refdata
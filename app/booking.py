@@ -0,0 +1,112 @@
+"""
+Race-free enlistment of members on activities.
+
+Activities are claimed with a conditional UPDATE (... WHERE assigned IS NULL,
+or still assigned to a member with a pending delist request), so when many
+members try to book the same slot the moment it opens exactly one of them
+wins. The Enlistment table's unique constraint enforces the one activity per
+event rule even for concurrent requests on different activities. Assignments
+made elsewhere (admin, staff API) are not checked against the rule, see
+Enlistment.
+"""
+
+import datetime
+import logging
+
+from django.db import IntegrityError, transaction
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from app.models import Activity, ActivityDelistRequest, Enlistment, Member
+
+logger = logging.getLogger(__name__)
+
+
+class EnlistResult:
+    '''outcome of an enlistment attempt, only the winner gets 'enlisted' '''
+
+    ENLISTED = 'enlisted'
+    ALREADY_ENLISTED = 'already_enlisted'
+    NOT_BOOKABLE = 'not_bookable'
+    TAKEN = 'taken'
+    EVENT_LIMIT = 'event_limit'
+
+    def __init__(self, status: str, activity: Activity):
+        self.status = status
+        self.activity = activity
+
+    @property
+    def enlisted(self):
+        return self.status == self.ENLISTED
+
+    def __str__(self):
+        return f"{self.status}: {self.activity}"
+
+
+def enlist(activity_id, member: Member, for_proxy: Member = None) -> EnlistResult:
+    '''Assigns an activity to member, optionally booked on behalf of for_proxy.
+
+    Returns an EnlistResult, raises Activity.DoesNotExist for unknown ids.
+    '''
+    activity = Activity.objects.select_related('event', 'assigned').get(id=activity_id)
+    previous_holder = activity.assigned_id
+
+    if previous_holder == member.id:
+        return EnlistResult(EnlistResult.ALREADY_ENLISTED, activity)
+
+    if not activity.bookable:
+        return EnlistResult(EnlistResult.NOT_BOOKABLE, activity)
+
+    claim = Activity.objects.filter(id=activity.id, assigned=previous_holder)
+
+    if previous_holder is not None:
+        # may only take over an activity if its holder has asked to be delisted
+        claim = claim.filter(delist_requests__member=previous_holder,
+                             delist_requests__approved=None)
+        if not claim.exists():
+            return EnlistResult(EnlistResult.TAKEN, activity)
+
+        logger.info("Transferring activity due to active ADR.")
+
+    if Activity.objects.filter(event=activity.event_id, assigned=member).exists():
+        return EnlistResult(EnlistResult.EVENT_LIMIT, activity)
+
+    previous = activity.snapshot()
+    assigned_at = datetime.datetime.now()
+    modified = timezone.now()
+
+    try:
+        with transaction.atomic():
+            # the first write in the transaction, so SQLite takes its write lock
+            # right away instead of failing to upgrade a read lock
+            claimed = claim.update(assigned=member, assigned_for_proxy=for_proxy,
+                                   assigned_at=assigned_at, modified=modified)
+            if claimed == 0:
+                # lost the race, report who holds it now
+                activity.refresh_from_db(fields=['assigned'])
+                return EnlistResult(EnlistResult.TAKEN, activity)
+
+            Enlistment.objects.filter(activity=activity).delete()
+            Enlistment.objects.create(event_id=activity.event_id, member=member,
+                                      activity=activity)
+
+            ActivityDelistRequest.objects \
+                .filter(activity=activity, approved=None) \
+                .delete()
+
+            activity.assigned = member
+            activity.assigned_for_proxy = for_proxy
+            activity.assigned_at = assigned_at
+            activity.modified = modified
+
+            # update() bypasses signals, let the ledger & counters catch up
+            activity._previous = previous
+            post_save.send(sender=Activity, instance=activity, created=False,
+                           update_fields=frozenset(['assigned', 'assigned_for_proxy', 'assigned_at']),
+                           raw=False, using=claim.db)
+
+    except IntegrityError:
+        return EnlistResult(EnlistResult.EVENT_LIMIT, activity)
+
+    logger.info(f"Member {member.id} enlisted on activity {activity.id}")
+    return EnlistResult(EnlistResult.ENLISTED, activity)
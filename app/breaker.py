@@ -0,0 +1,156 @@
+"""
+Circuit breakers around external providers (SMTP, SMS, Twilio Verify).
+
+After failure_threshold consecutive failures a breaker opens and calls fail
+immediately with CircuitOpen instead of waiting on a provider that is down.
+After reset_timeout seconds one probe call is let through (half-open): if it
+succeeds the breaker closes again, otherwise it stays open for another
+period. Calls that succeed but take longer than latency_budget seconds count
+as failures. Errors that is_failure rejects, e.g. a provider refusing a bad
+request, neither count as failures nor close the breaker. Hard timeouts come from the providers' socket timeouts
+(EMAIL_TIMEOUT, SMS_TIMEOUT), so no thread waits longer than those.
+
+Breakers are per process and configured in settings.CIRCUIT_BREAKERS.
+"""
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    '''raised instead of calling a provider whose breaker is open'''
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is unavailable, retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0,
+                 latency_budget=None, is_failure=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latency_budget = latency_budget
+        self.is_failure = is_failure or (lambda e: True)
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.counters = {'calls': 0, 'failures': 0, 'rejected': 0,
+                         self.OPEN: 0, self.HALF_OPEN: 0, self.CLOSED: 0}
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        if state != self.state:
+            self.state = state
+            self.counters[state] += 1
+            log.warning(f"Circuit breaker {self.name} is now {state}")
+
+    def _before(self):
+        with self._lock:
+            self.counters['calls'] += 1
+
+            if self.state == self.OPEN:
+                remaining = self.opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    self.counters['rejected'] += 1
+                    raise CircuitOpen(self.name, remaining)
+                self._transition(self.HALF_OPEN)
+
+            if self.state == self.HALF_OPEN:
+                if self.probing:
+                    # another request is already probing the provider
+                    self.counters['rejected'] += 1
+                    raise CircuitOpen(self.name, self.reset_timeout)
+                self.probing = True
+
+    def _success(self):
+        with self._lock:
+            self.probing = False
+            self.failures = 0
+            self._transition(self.CLOSED)
+
+    def _ignore(self):
+        # the provider answered, but that says nothing about its health
+        with self._lock:
+            self.probing = False
+
+    def _failure(self):
+        with self._lock:
+            self.probing = False
+            self.failures += 1
+            self.counters['failures'] += 1
+
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._transition(self.OPEN)
+
+    def call(self, fn, *args, **kwargs):
+        '''calls fn through the breaker, raises CircuitOpen without calling it when open'''
+        self._before()
+        start = time.monotonic()
+
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if self.is_failure(e):
+                self._failure()
+            else:
+                self._ignore()
+            raise
+
+        elapsed = time.monotonic() - start
+        if self.latency_budget and elapsed > self.latency_budget:
+            log.warning(f"{self.name} took {elapsed:.1f}s, budget is {self.latency_budget}s")
+            self._failure()
+        else:
+            self._success()
+
+        return result
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, state=self.state, failures_in_row=self.failures)
+
+
+def not_client_error(e):
+    '''provider errors caused by the request itself (HTTP 4xx) don't open the breaker'''
+    status = getattr(e, 'status', None)
+    return not (isinstance(status, int) and 400 <= status < 500)
+
+
+# which errors of a provider count as failures, all of them if not listed
+FAILURE_CLASSIFIERS = {
+    'sms': not_client_error,
+    'twilio_verify': not_client_error,
+}
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(name):
+    '''returns the process wide breaker for name, configured from settings.CIRCUIT_BREAKERS'''
+    if name not in _breakers:
+        with _breakers_lock:
+            if name not in _breakers:
+                config = getattr(settings, 'CIRCUIT_BREAKERS', {}).get(name, {})
+                _breakers[name] = CircuitBreaker(
+                    name, is_failure=FAILURE_CLASSIFIERS.get(name), **config)
+    return _breakers[name]
+
+
+def stats():
+    return {name: b.stats() for name, b in _breakers.items()}
@@ -0,0 +1,277 @@
+"""
+Cache backends shared by all worker processes, versioned-key invalidation
+and per key prefix statistics.
+
+LocMemCache is per process, so with several WSGI workers an invalidation in
+one worker is never seen by the others. SQLiteCache keeps entries in one
+SQLite file in WAL mode (readers don't block the writer), FileCache is
+Django's file based cache. Both are selected with settings.CACHE_BACKEND.
+All backends here count hits, misses, sets and deletes per key prefix (the
+part of the key before the first ':'), see stats().
+
+Versioned keys: version(namespace) is a token kept in the cache that bump()
+replaces. Keys built with versioned_key() change with it, so a bump makes
+every entry of the namespace unreachable in all processes at once, without
+having to know or delete the keys. invalidate_on() bumps a namespace on
+model signals.
+"""
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache as DjangoLocMemCache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+_MISSING = object()
+
+##############################################################################
+# statistics, per process
+
+COUNTERS = ['hits', 'misses', 'sets', 'deletes', 'invalidations']
+
+_stats = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+_stats_lock = threading.Lock()
+
+
+def prefix(key):
+    return str(key).split(':', 1)[0]
+
+
+def record(key, counter, n=1):
+    with _stats_lock:
+        _stats[prefix(key)][counter] += n
+
+
+def stats():
+    '''counters per key prefix in this process, with the hit rate'''
+    with _stats_lock:
+        result = {p: dict(c) for p, c in _stats.items()}
+
+    for counters in result.values():
+        lookups = counters['hits'] + counters['misses']
+        counters['hit_rate'] = round(counters['hits'] / lookups, 3) if lookups else None
+    return result
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+class StatsMixin:
+    '''counts cache operations per key prefix'''
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _MISSING, version)
+        if value is _MISSING:
+            record(key, 'misses')
+            return default
+        record(key, 'hits')
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        record(key, 'sets')
+        return super().set(key, value, timeout, version)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        record(key, 'sets')
+        return super().add(key, value, timeout, version)
+
+    def delete(self, key, version=None):
+        record(key, 'deletes')
+        return super().delete(key, version)
+
+
+##############################################################################
+# backends
+
+class LocMemCache(StatsMixin, DjangoLocMemCache):
+    '''per process, for development and tests'''
+
+
+class FileCache(StatsMixin, FileBasedCache):
+    '''one file per entry in the LOCATION directory'''
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        # FileBasedCache.add() goes through set(), which is already counted
+        return FileBasedCache.add(self, key, value, timeout, version)
+
+
+class SQLiteCache(BaseCache):
+    '''
+    entries in the SQLite database file LOCATION, shared by all processes
+    on the host. Each thread has its own connection.
+    '''
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    # check for culling every this many writes
+    CULL_EVERY = 100
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self.path = os.path.abspath(location)
+        self._local = threading.local()
+        self._writes = 0
+
+    def _connection(self):
+        # a connection must not be shared with a process forked after opening it
+        pid, connection = getattr(self._local, 'connection', (None, None))
+        if pid == os.getpid():
+            return connection
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS cache '
+                           '(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+        self._local.connection = (os.getpid(), connection)
+        return connection
+
+    def _key(self, key, version):
+        key = self.make_key(key, version)
+        self.validate_key(key)
+        return key
+
+    def _live(self, connection, key):
+        row = connection.execute('SELECT value, expires FROM cache WHERE key = ?', [key]).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return _MISSING
+        return pickle.loads(row[0])
+
+    def _write(self, connection, key, value, timeout):
+        connection.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                           [key, pickle.dumps(value, self.pickle_protocol),
+                            self.get_backend_timeout(timeout)])
+
+        self._writes += 1
+        if self._writes % self.CULL_EVERY == 0:
+            self._cull(connection)
+
+    def _cull(self, connection):
+        connection.execute('DELETE FROM cache WHERE expires <= ?', [time.time()])
+        count = connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        if count > self._max_entries and self._cull_frequency:
+            connection.execute('DELETE FROM cache WHERE key IN '
+                               '(SELECT key FROM cache ORDER BY expires IS NULL, expires LIMIT ?)',
+                               [count // self._cull_frequency])
+
+    def get(self, key, default=None, version=None):
+        value = self._live(self._connection(), self._key(key, version))
+        if value is _MISSING:
+            record(key, 'misses')
+            return default
+        record(key, 'hits')
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        record(key, 'sets')
+        self._write(self._connection(), self._key(key, version), value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        record(key, 'sets')
+        connection = self._connection()
+        key = self._key(key, version)
+
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            if self._live(connection, key) is not _MISSING:
+                return False
+            self._write(connection, key, value, timeout)
+            return True
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        cursor = self._connection().execute(
+            'UPDATE cache SET expires = ? WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            [self.get_backend_timeout(timeout), self._key(key, version), time.time()])
+        return cursor.rowcount == 1
+
+    def incr(self, key, delta=1, version=None):
+        connection = self._connection()
+        key = self._key(key, version)
+
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            value = self._live(connection, key)
+            if value is _MISSING:
+                raise ValueError(f"Key '{key}' not found")
+
+            value += delta
+            connection.execute('UPDATE cache SET value = ? WHERE key = ?',
+                               [pickle.dumps(value, self.pickle_protocol), key])
+            return value
+
+    def has_key(self, key, version=None):
+        return self._live(self._connection(), self._key(key, version)) is not _MISSING
+
+    def delete(self, key, version=None):
+        record(key, 'deletes')
+        self._connection().execute('DELETE FROM cache WHERE key = ?', [self._key(key, version)])
+
+    def clear(self):
+        self._connection().execute('DELETE FROM cache')
+
+
+##############################################################################
+# versioned keys
+
+def _version_key(namespace):
+    return f'{namespace}:version'
+
+
+def version(namespace):
+    '''current version token of namespace, created on first use'''
+    token = cache.get(_version_key(namespace))
+    if token is None:
+        cache.add(_version_key(namespace), uuid.uuid4().hex, None)
+        token = cache.get(_version_key(namespace))
+    return token
+
+
+def versioned_key(namespace, *parts):
+    return ':'.join([namespace, version(namespace)] + [str(p) for p in parts])
+
+
+def _bump(namespaces):
+    for namespace in namespaces:
+        cache.set(_version_key(namespace), uuid.uuid4().hex, None)
+        record(namespace, 'invalidations')
+
+
+def bump(*namespaces):
+    '''makes all versioned keys of namespaces stale, in every process'''
+    _bump(namespaces)
+
+    # and again on commit, as other processes may have cached the old data
+    # under the new version until then
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _bump(namespaces))
+
+
+def invalidate_on(namespace, *senders, signals=(post_save, post_delete), ignore_fields=()):
+    '''
+    bumps namespace whenever one of the signals is sent for one of senders,
+    except for saves limited to ignore_fields with update_fields
+    '''
+    ignore_fields = frozenset(ignore_fields)
+
+    def receiver(sender, update_fields=None, **kwargs):
+        if update_fields and ignore_fields.issuperset(update_fields):
+            return
+        bump(namespace)
+
+    for sender in senders:
+        for signal in signals:
+            signal.connect(receiver, sender=sender, weak=False,
+                           dispatch_uid=f'bump-{namespace}-{sender._meta.label}-{id(signal)}')
+    return receiver
@@ -0,0 +1,121 @@
+"""
+Conditional GET for the read API.
+
+ETags are derived from version tokens of the tables a view reads (see
+app.caching), not from the response, so a matching If-None-Match is answered
+with 304 Not Modified before the queryset is evaluated or serialized. The
+tokens are replaced by model signals; code changing these tables with
+queryset.update() or bulk_create() must call changed() itself. Views can
+also cache whole responses to anonymous users under the ETag, so a rush of
+visitors costs no queries after the first.
+"""
+
+import datetime
+import hashlib
+
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+
+from app import caching, models
+
+# seconds a rendered public response is kept, it is keyed by the data versions
+# and can't get stale, this only limits the space used
+PUBLIC_RESPONSE_TIMEOUT = 60 * 15
+
+TABLES = {
+    'events': [models.Event, models.Attachment],
+    'activities': [models.Activity, models.ActivityDelistRequest, models.Enlistment,
+                   models.Attachment],
+    'members': [models.Member, User, models.License, models.Driver],
+}
+
+# saves of only these fields don't change any response, e.g. the
+# User.save(update_fields=['last_login']) on every login
+IGNORED_FIELDS = {
+    User: ['last_login'],
+}
+
+M2M_TABLES = {
+    'events': [models.Event.coordinators.through, models.Event.attachments.through],
+    'activities': [models.Activity.attachments.through],
+}
+
+
+def _namespace(table):
+    # reference tables are versioned by app.refdata
+    return table if table.startswith('refdata:') else f'data:{table}'
+
+
+def changed(*tables):
+    '''makes ETags depending on tables stale'''
+    caching.bump(*[_namespace(t) for t in tables])
+
+
+def etag(request, tables):
+    parts = [caching.version(_namespace(t)) for t in tables] + [
+        request.user.id, request.get_full_path(),
+        getattr(request, 'accepted_media_type', ''),
+        # what is upcoming or bookable changes with the date
+        datetime.date.today()]
+    return quote_etag(hashlib.md5(repr(parts).encode()).hexdigest())
+
+
+class ConditionalGetMixin:
+    '''
+    for list/retrieve views, etag_tables lists the tables their responses
+    depend on, override get_etag_tables() when that depends on the request.
+    With public_max_age set, responses to anonymous users are cached whole
+    and may be cached by proxies and browsers for that many seconds.
+    '''
+    etag_tables = []
+    public_max_age = None
+
+    def get_etag_tables(self):
+        return self.etag_tables
+
+    def get(self, request, *args, **kwargs):
+        tag = etag(request, self.get_etag_tables())
+        public = self.public_max_age is not None and not request.user.is_authenticated
+
+        if tag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        elif public:
+            response = self.public_response(tag, request, *args, **kwargs)
+        else:
+            response = super().get(request, *args, **kwargs)
+
+        response['ETag'] = tag
+        if public:
+            response['Cache-Control'] = f'public, max-age={self.public_max_age}'
+            # logged in users get other content on the same URL
+            patch_vary_headers(response, ['Cookie', 'Authorization'])
+        else:
+            response['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def public_response(self, tag, request, *args, **kwargs):
+        '''the rendered response, from the cache when the data is unchanged'''
+        key = f'public-response:{tag.strip(chr(34))}'
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type)
+
+        response = super().get(request, *args, **kwargs)
+        if response.status_code == 200:
+            response = self.finalize_response(request, response, *args, **kwargs)
+            response.render()
+            cache.set(key, (response.content, response['Content-Type']), PUBLIC_RESPONSE_TIMEOUT)
+        return response
+
+for _table, _senders in TABLES.items():
+    for _sender in _senders:
+        caching.invalidate_on(_namespace(_table), _sender,
+                              ignore_fields=IGNORED_FIELDS.get(_sender, ()))
+
+for _table, _senders in M2M_TABLES.items():
+    caching.invalidate_on(_namespace(_table), *_senders, signals=[m2m_changed])
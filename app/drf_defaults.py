@@ -1,10 +1,134 @@
 """
-Django rest framework default pagination
+Django rest framework default pagination and the normalized response format
 """
-from rest_framework.pagination import PageNumberPagination
+import json
+
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 
 
 class DefaultResultsSetPagination(PageNumberPagination):
     page_size = 100
     page_size_query_param = 'page_size'
-    max_page_size = 2000
\ No newline at end of file
+    max_page_size = 2000
+
+class KeysetPagination(BasePagination):
+    '''
+    Keyset ("seek") pagination over a queryset ordered by 'ordering', a
+    tuple of field names with optional '-' prefix ending in a unique field.
+    The cursor holds the ordering values of the last row on a page, so
+    fetching any page is an indexed range scan, independent of its depth.
+    '''
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 2000
+    cursor_query_param = 'cursor'
+    ordering = ('id',)
+
+    def __init__(self, ordering=None):
+        self.ordering = ordering or self.ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*self.ordering)
+
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            queryset = queryset.filter(self.after(cursor))
+
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.rows = rows[:self.page_size]
+        return self.rows
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def after(self, cursor):
+        '''Q matching rows that come after the cursor values in ordering'''
+        q = None
+        for field, value in reversed(list(zip(self.ordering, cursor))):
+            name = field.lstrip('-')
+            beyond = Q(**{name + ('__lt' if field.startswith('-') else '__gt'): value})
+            q = beyond if q is None else beyond | (Q(**{name: value}) & q)
+        return q
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            cursor = json.loads(b64decode(encoded.encode('ascii')).decode('utf-8'))
+        except (TypeError, ValueError):
+            raise NotFound('Invalid cursor')
+
+        if not isinstance(cursor, list) or len(cursor) != len(self.ordering):
+            raise NotFound('Invalid cursor')
+        return cursor
+
+    def encode_cursor(self, row):
+        values = [row[f.lstrip('-')] if isinstance(row, dict) else getattr(row, f.lstrip('-'))
+                  for f in self.ordering]
+        encoded = b64encode(json.dumps(values, cls=DjangoJSONEncoder).encode('utf-8'))
+        return replace_query_param(self.request.build_absolute_uri(),
+                                   self.cursor_query_param, encoded.decode('ascii'))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(self.rows[-1])
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+
+class NormalizedJSONRenderer(JSONRenderer):
+    '''selected by ?format=normalized, see NormalizedListMixin'''
+    format = 'normalized'
+
+
+class NormalizedListMixin:
+    '''
+    Opt-in normalized list responses: with ?format=normalized the rows
+    reference related objects by id and each related object is serialized
+    once, in an 'included' section per type. normalizer(rows, context)
+    returns (rows data, included).
+    '''
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [NormalizedJSONRenderer]
+    normalizer = None
+
+    def list(self, request, *args, **kwargs):
+        if request.accepted_renderer.format != NormalizedJSONRenderer.format:
+            return super().list(request, *args, **kwargs)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        rows = list(queryset) if page is None else page
+
+        data, included = self.normalizer(rows, self.get_serializer_context())
+
+        if page is None:
+            response = Response(OrderedDict([('results', data)]))
+        else:
+            response = self.get_paginated_response(data)
+        response.data['included'] = included
+        return response
@@ -1,31 +1,33 @@
 import logging
 
 from django.conf import settings
-from django.core.mail import mail_managers, send_mail, send_mass_mail
 
-from twilio.rest import Client as TwilioClient
+from app import outbox, sms
 
 log = logging.getLogger(__name__)
 
-_sms_client = None
-
 def strip_lines(lines):
     return '\n'.join(line.lstrip() for line in lines.split('\n'))
 
-def sms_client():
-    global _sms_client
-    if _sms_client is None and settings.TWILIO_ACCOUNT_SID:
-        _sms_client = TwilioClient(
-            settings.TWILIO_ACCOUNT_SID,
-            settings.TWILIO_AUTH_TOKEN)
+def _queue_sms(key, member, body):
+    sms_target = member.phone_number
+    log.info(f"About to send SMS to {sms_target}: {body}")
+
+    if not sms_target:
+        log.warning(f"No phone_number set for {member}")
+    elif sms.enabled():
+        return outbox.enqueue_sms(key, sms_target, body)
+    else:
+        log.warning("SMS is disabled")
 
-    return _sms_client
+    return None
 
 
 def new_user_created(member):
     user = member.user
-    mail_managers(
-        f'New user {user.username} registered at T13 web',
+    outbox.enqueue_email(
+        f'new-user:{user.id}',
+        f'{settings.EMAIL_SUBJECT_PREFIX}New user {user.username} registered at T13 web',
         strip_lines(f'''Hej admin!
 
         '{user.first_name} {user.last_name}' har precis registrerat sig på  Team 13's webbapplikation.
@@ -35,15 +37,18 @@ def new_user_created(member):
 
         mvh,
         /Team13's aktivitetswebb
-        '''))
+        '''),
+        [a[1] for a in settings.MANAGERS],
+        sender=settings.SERVER_EMAIL)
 
 
 def adr_approved(adr):
     log.info(f"ADR {adr} has been approved")
 
     if settings.DEFAULT_FROM_EMAIL:
-        log.info("Sending email to " + adr.member.user.email)
-        send_mail('Avbokning godkänd',
+        outbox.enqueue_email(
+            f'adr-approved:{adr.id}:email',
+            'Avbokning godkänd',
             strip_lines(f'''Hej {adr.member.fullname}
 
             Din önskan om avbokning från {adr.activity}
@@ -51,31 +56,19 @@ def adr_approved(adr):
 
             mvh
             /Team13 aktivitetswebb'''),
-            settings.DEFAULT_FROM_EMAIL,
             [adr.member.user.email])
 
-    sms_target = adr.member.phone_number
-    body = f"Din begäran om avbokning av {adr.activity} har blivit godkänd. mvh /Team13",
-    log.info(f"About to send SMS to {sms_target}: {body}")
-
-    if sms_target is None:
-        log.warning(f"No phone_number set for {adr.member}")
-    elif sms_client():
-        log.info(f"Sending SMS to {sms_target}")
-        sms_client().messages.create(
-            body=body,
-            from_=settings.SMS_FROM_NUMBER,
-            to=sms_target)
-    else:
-        log.warning("SMS is disabled")
+    _queue_sms(f'adr-approved:{adr.id}:sms', adr.member,
+               f"Din begäran om avbokning av {adr.activity} har blivit godkänd. mvh /Team13")
 
 def adr_rejected(adr):
     log.info(f"ADR {adr} has been rejected,")
 
     if settings.DEFAULT_FROM_EMAIL:
         recipients = [adr.member.user.email, adr.approver.user.email]
-        log.info(f"Sending email to {recipients}")
-        send_mass_mail('Avbokning ej godkänd',
+        outbox.enqueue_email(
+            f'adr-rejected:{adr.id}:email',
+            'Avbokning ej godkänd',
             strip_lines(f'''Hej {adr.member.fullname},
 
             Din önskan om avbokning från {adr.activity}
@@ -86,30 +79,18 @@ def adr_rejected(adr):
 
             mvh
             /Team13 aktivitetswebb'''),
-            settings.DEFAULT_FROM_EMAIL,
             recipients)
 
-    sms_target = adr.member.phone_number
-    body = f"Hej! Din begäran om avbokning från {adr.activity} har tyvärr avvisats. mvh /Team13"
-    log.info(f"About to send SMS to {sms_target}: {body}")
+    _queue_sms(f'adr-rejected:{adr.id}:sms', adr.member,
+               f"Hej! Din begäran om avbokning från {adr.activity} har tyvärr avvisats. mvh /Team13")
 
-    if not sms_target:
-        log.warning(f"No phone_number set for {adr.member}")
-    elif sms_client():
-        log.info(f"Sending SMS to {sms_target}")
-        sms_client().messages.create(
-            body=body,
-            from_=settings.SMS_FROM_NUMBER,
-            to=sms_target)
-    else:
-        log.warning("SMS is disabled")
 
-
-def notify_upcoming_activity(activity):
+def notify_upcoming_activity(activity, lead_days=1):
+    '''queues reminders for the assignee of activity, returns the queued messages'''
     if activity.assigned is None:
         # TODO: Notify event coordinator/responsible with summary in this case?
         log.warning(f"Activity '{activity}' is not assigned, cannot notify")
-        return
+        return []
 
     log.info(f"Notifying {activity.assigned} that they are assigned to {activity}, which occurs soon.")
 
@@ -120,25 +101,29 @@ def notify_upcoming_activity(activity):
 
         mvh /Team13''')
 
+    key = f'reminder:{activity.id}:{activity.assigned_id}:{lead_days}'
+    queued = []
+
     if settings.DEFAULT_FROM_EMAIL:
-        send_mail(f"Påminnelse om {activity}",
+        queued.append(outbox.enqueue_email(f'{key}:email',
+            f"Påminnelse om {activity}",
             message,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[activity.assigned.user.email])
+            [activity.assigned.user.email]))
 
-    sms_target = activity.assigned.phone_number
-    log.info(f"About to send SMS to {sms_target}: {message}")
+    queued.append(_queue_sms(f'{key}:sms', activity.assigned, message))
 
-    if not sms_target:
-        log.warning(f"No phone_number set for {activity.member}")
-    elif sms_client():
-        log.info(f"Sending SMS to {sms_target}")
-        sms_client().messages.create(
-            body=message,
-            from_=settings.SMS_FROM_NUMBER,
-            to=sms_target)
+    return [m for m in queued if m is not None]
+
+
+def sms_reply_handled(message, member, activity, result):
+    '''answers a member's SMS reply about activity'''
+    if result == 'confirmed':
+        body = f"Tack! Du har bekräftat {activity} den {activity.date}. mvh /Team13"
     else:
-        log.warning("SMS is disabled")
+        body = f"Din begäran om avbokning från {activity} har tagits emot. mvh /Team13"
+
+    if sms.enabled():
+        outbox.enqueue_sms(f'sms-reply:{message.id}', message.from_number, body)
 
 
 def send_verification_email(member):
@@ -146,8 +131,10 @@ def send_verification_email(member):
 
     if settings.DEFAULT_FROM_EMAIL:
         log.info(f"Sending verification link to {member.email}:\n{link}")
-        send_mail(subject='Team13 email verification',
-            message=strip_lines(f'''Hej {member.fullname},
+        outbox.enqueue_email(
+            f'verify-email:{member.id}:{member.email_verification_code}',
+            'Team13 email verification',
+            strip_lines(f'''Hej {member.fullname},
 
             Klicka på länken för att verifiera din emailadress:
 
@@ -155,7 +142,6 @@ def send_verification_email(member):
 
             mvh
             /Team13'''),
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[member.email])
+            [member.email])
     else:
         log.info(f"Email disabled, verification link for {member.email}:\n{link}")
\ No newline at end of file
@@ -2,13 +2,23 @@ import logging
 import calendar
 import locale
 import datetime
+import time
 import openpyxl
 
-from django.core.exceptions import PermissionDenied
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.db import transaction
+from django.db.models import Q, Prefetch
+from app import conditional, refdata
 from app.models import Event, EventType, Activity, ActivityType, Member
 
 logger = logging.getLogger(__name__)
 
+# importDataFromExcel's default, evaluated on each call
+CURRENT_YEAR = object()
+
 class ExcelSheet:
     '''Defines structure for excel sheet, used both on import and export''' 
 
@@ -24,11 +34,6 @@ class ExcelSheet:
             self.cols[t] = c        
             c += 1
 
-    def createHeader(self, row = 1):
-        for t, c in self.cols.items():
-            ws.cell(row, c).value = t
-            ws.column_dimensions[chr(64+c)].best_fit = True
-
 class ExcelRow:
     def __init__(self, sheet, row):
         self.sheet = sheet
@@ -83,201 +88,322 @@ class ExcelRow:
 
 
 
-def importDataFromExcel(file, year=datetime.date.today().year):
-    wb = openpyxl.load_workbook(file, data_only=True, read_only=True)
-    sheet = wb._sheets[0]
+class ImportRecord:
+    '''an activity parsed from one sheet row, with its event resolved by name'''
 
-    locale.setlocale(locale.LC_ALL, 'sv_SE')
+    def __init__(self, row_number, event_type, event_name, date,
+                 activity_type, activity, coordinator):
+        self.row_number = row_number
+        self.event_type = event_type
+        self.event_name = event_name
+        self.date = date
+        self.activity_type = activity_type
+        self.activity = activity
+        self.coordinator = coordinator
+
+    @property
+    def event_key(self):
+        return (self.event_name, self.date, self.event_type)
+
+
+class ExcelImportException(Exception):
+    '''raised when a sheet has invalid rows, nothing is imported then'''
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('\n'.join(f'Row {n}: {e}' for n, e in errors))
+
+
+def parseExcelSheet(sheet, year):
+    '''
+    First import phase, parses and validates all rows without touching the
+    database. Returns (records, errors) where errors are (row, message).
+    '''
+    es = ExcelSheet(sheet)
+    records = []
+    errors = []
 
-    events = {}
-    eventTypes = {}
-    activityTypes = {}
     et_name = None
     date = None
     event_name = None
     n = 0
-    a = 0
 
-    try:
-        es = ExcelSheet(sheet)
-
-        for cells in sheet.rows:
-            row = ExcelRow(es, cells)
-            n += 1
-            if n <= 2:
+    for cells in sheet.rows:
+        row = ExcelRow(es, cells)
+        n += 1
+        if n <= 2:
+            continue
+
+        if row.event.value is None and et_name is None:
+            continue
+
+        et_name = row.event_type.value or et_name
+        date = row.date.value or date
+
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+
+        if not isinstance(date, datetime.date):
+            errors.append((n, f"Invalid date '{date}'"))
+            continue
+
+        (_, week, weekday) = date.isocalendar()
+        if year is not None:
+            date = datetime.date.fromisocalendar(year, week, weekday)
+
+        if any(et_name.startswith(t) for t in ['Träning', 'Arbetsdag', 'Gokartskola']):
+            event_name = f"{et_name} {calendar.day_name[weekday - 1]} vecka {week}"
+        else:
+            event_name = row.event.value or event_name
+
+        at_name = row.activity.value
+        if at_name is None or at_name == '':
+            logger.info(f"Skipping row {n} as 'uppgift' is empty")
+            continue
+
+        activity = Activity(
+            name=f"{at_name} {calendar.day_name[date.weekday()]}",
+            earliest_bookable_date=row.bookable_date.value,
+            start_time=row.start_time.value,
+            end_time=row.end_time.value)
+
+        try:
+            activity.full_clean(exclude=['event', 'type'])
+        except ValidationError as e:
+            errors.append((n, '; '.join(f'{k}: {v}' for k, v in e.message_dict.items())))
+            continue
+
+        records.append(ImportRecord(n, et_name, event_name, date, at_name,
+                                    activity, row.coordinator.value))
+
+    return records, errors
+
+
+def _getOrCreateByName(model, names):
+    '''returns {name: instance}, bulk creating the missing ones'''
+    existing = {o.name: o for o in model.objects.filter(name__in=names)}
+    missing = [model(name=name) for name in names if name not in existing]
+    if missing:
+        model.objects.bulk_create(missing)
+        # SQLite doesn't return ids from bulk inserts, so fetch them again
+        existing.update((o.name, o) for o in model.objects.filter(name__in=[m.name for m in missing]))
+    return existing
+
+
+def _findCoordinators(names):
+    '''returns {fullname: Member} for "first last" names in one query'''
+    q = Q()
+    for name in names:
+        first, _, last = name.partition(' ')
+        q |= Q(user__first_name=first, user__last_name=last)
+
+    if not q:
+        return {}
+
+    return {m.fullname: m for m in Member.objects.filter(q).select_related('user')}
+
+
+def writeImportRecords(records):
+    '''
+    Second import phase, resolves types and events with a few IN queries
+    and bulk creates everything. Must run inside a transaction.
+    '''
+    event_types = _getOrCreateByName(EventType, {r.event_type for r in records})
+    activity_types = _getOrCreateByName(ActivityType, {r.activity_type for r in records})
+
+    # the first row of an event creates it, the coordinator is usually only
+    # given there
+    keys = {}
+    coordinator_names = {}
+    for r in records:
+        keys.setdefault(r.event_key, r)
+        if r.coordinator:
+            coordinator_names.setdefault(r.event_key, r.coordinator)
+
+    def existing_events():
+        return {(e.name, e.start_date, e.type.name if e.type else None): e for e in Event.objects
+                .filter(name__in={k[0] for k in keys}, start_date__in={k[1] for k in keys})
+                .select_related('type')}
+
+    events = existing_events()
+    new_keys = [k for k in keys if k not in events]
+    Event.objects.bulk_create([
+        Event(name=name, start_date=date, end_date=date, type=event_types[et_name])
+        for name, date, et_name in new_keys])
+
+    if new_keys:
+        events = existing_events()
+
+        coordinators = _findCoordinators({coordinator_names[k] for k in new_keys
+                                          if k in coordinator_names})
+        links = []
+        for k in new_keys:
+            coord = coordinator_names.get(k)
+            if coord is None:
                 continue
-
-            if row.event.value is None and et_name is None:
-                continue
-
-            et_name = row.event_type.value or et_name
-            et = eventTypes.get(et_name)
-            if et is None:
-                #logger.info(f"Event type {et_name}")
-                try:
-                    et = EventType.objects.get(name=et_name)
-                except EventType.DoesNotExist:
-                    et = EventType(name=et_name)
-                    et.save()
-                eventTypes[et_name] = et
-
-            date = row.date.value or date
-            if year is not None:
-                (_, week, weekday) = date.isocalendar()            
-                date = datetime.date.fromisocalendar(year, week, weekday)
+            if coord in coordinators:
+                links.append(Event.coordinators.through(
+                    event_id=events[k].id, member_id=coordinators[coord].id))
             else:
-                (_, week, weekday) = date.isocalendar()            
-
-            if any(et_name.startswith(t) for t in ['Träning', 'Arbetsdag', 'Gokartskola']):
-                event_name = f"{et_name} {calendar.day_name[weekday - 1]} vecka {week}"            
-            else:    
-                event_name = row.event.value or event_name
-
-            event = events.get((event_name, date))
-
-            if event is None:
-                #logger.info(f"Event {event_name} {date}")
-                try:
-                    event = Event.objects.get(name=event_name,
-                                              start_date=date, type=et)
-                except Event.DoesNotExist:
-                    event = Event(name=event_name, start_date=date,
-                                  end_date=date, type=et)
-                    event.save()
-
-                    coord = row.coordinator.value
-
-                    if coord is not None:
-                        if ' ' in coord:
-                            first, last = coord.split(' ', maxsplit=1)
-                        else:
-                            first = coord
-
-                        try:
-                            coordinator = Member.objects.get(
-                                user__first_name=first, user__last_name=last)
-                            event.coordinators.add(coordinator)
-                        except Member.DoesNotExist:
-                            print(
-                                f"Failed to find member {coord} to use as coordinator for {event_name}")
-
-                events[event_name] = event
-
-            at_name = row.activity.value
-            if at_name is None or at_name == '':
-                print(f"Skipping row {n} as 'uppgift' is empty")
-                continue
+                logger.warning(f"Failed to find member {coord} to use as coordinator for {k[0]}")
+        Event.coordinators.through.objects.bulk_create(links)
 
-            at = activityTypes.get(at_name)
-            if at is None:
-                #logger.info(f"Activity Type: {at_name}")
-                try:
-                    at = ActivityType.objects.get(name=at_name)
-                except ActivityType.DoesNotExist:
-                    at = ActivityType(name=at_name)
-                    at.save()
-                activityTypes[at_name] = at
+    for r in records:
+        r.activity.event = events[r.event_key]
+        r.activity.type = activity_types[r.activity_type]
 
-            ebd = row.bookable_date.value
+    Activity.objects.bulk_create([r.activity for r in records], batch_size=500)
 
-            # temphack
-            #if not row.event_type.value:
-            #    continue 
+    # bulk_create bypasses the signals maintaining the counters and caches
+    Event.refresh_activity_counters(
+        Event.objects.filter(id__in={e.id for e in events.values()}))
+    refdata.invalidate('event_types', 'activity_types')
+    conditional.changed('events', 'activities')
 
-            activity = Activity(
-                name=f"{at_name} {calendar.day_name[date.weekday()]}", event=event, type=at,
-                earliest_bookable_date=ebd)
+    return len(new_keys)
 
-            activity.start_time = row.start_time.value
-            activity.end_time = row.end_time.value
 
-            activity.full_clean()
-            activity.save()
+def importDataFromExcel(file, year=CURRENT_YEAR, dry_run=False):
+    '''
+    Imports a season schedule, either all rows or nothing. Rows are parsed
+    and validated first, then written in one transaction with bulk inserts.
+    Dates are moved to the same week and weekday of year, the current year
+    by default, None keeps them. Raises ExcelImportException listing all
+    invalid rows.
+    '''
+    if year is CURRENT_YEAR:
+        year = datetime.date.today().year
 
-            a += 1
+    locale.setlocale(locale.LC_ALL, 'sv_SE')
 
-        print(f'Imported {a} activities from {n} rows ...')
+    start = time.perf_counter()
+    wb = openpyxl.load_workbook(file, data_only=True, read_only=True)
+    sheet = wb._sheets[0]
 
-        print(f'''Database row count:
-            {EventType.objects.all().count()} event types
-            {ActivityType.objects.all().count()} activity types
-            {Event.objects.all().count()} events
-            {Activity.objects.all().count()} activities'''
-              .replace('    ', ' '))
+    records, errors = parseExcelSheet(sheet, year)
+    parsed = time.perf_counter()
+
+    if errors:
+        raise ExcelImportException(errors)
+
+    with transaction.atomic():
+        new_events = writeImportRecords(records)
+        if dry_run:
+            transaction.set_rollback(True)
+
+    done = time.perf_counter()
+
+    logger.info(f"{'Would import' if dry_run else 'Imported'} {len(records)} activities "
+                f"and {new_events} new events")
+    logger.info(f"Parsed in {parsed - start:.2f}s, wrote in {done - parsed:.2f}s, "
+                f"{len(records) / max(done - start, 1e-6):.0f} rows/s")
+
+    logger.info(f'''Database row count:
+        {EventType.objects.all().count()} event types
+        {ActivityType.objects.all().count()} activity types
+        {Event.objects.all().count()} events
+        {Activity.objects.all().count()} activities'''
+                .replace('    ', ' '))
+
+    return len(records)
+
+def _scheduleYear(ws, es, year, r, computed_font):
+    '''appends the rows for a year to a write-only sheet after row r using four queries,
+       returns the number of activities and the last row written'''
+
+    driver_types = ActivityType.objects.filter(name__startswith="Förare")
+    activities = Activity.objects \
+        .exclude(type__in=driver_types) \
+        .select_related('type') \
+        .order_by('type__id')
+
+    events = Event.objects \
+        .filter(start_date__year=year) \
+        .select_related('type') \
+        .prefetch_related(
+            Prefetch('coordinators', queryset=Member.objects.select_related('user')),
+            Prefetch('activities', queryset=activities, to_attr='exported_activities'))
+
+    def cell(value, number_format=None, font=None):
+        c = WriteOnlyCell(ws, value=value)
+        if number_format:
+            c.number_format = number_format
+        if font:
+            c.font = font
+        return c
 
-    except:
-        print(f"Error on row {n}")
-        raise   
+    cols = es.cols
+    n = 0
 
-def exportScheduleToExcel(filename, year):
-    wb = openpyxl.Workbook(iso_dates=True)
-    ws = wb._sheets[0]
+    for event in events:
+        logger.debug(f'{event.start_date}: {event.name}')
 
-    driver_type = ActivityType.objects.get(name__startswith="Förare")
+        for i, a in enumerate(event.exported_activities or [None]):
+            r += 1
+            row = [None] * len(cols)
+
+            if i == 0:
+                date = f'{get_column_letter(cols["Datum"] + 1)}{r}'
+                row[cols['Aktivitet']] = event.name
+                row[cols['Typ']] = event.type.name if event.type else None
+                row[cols['Datum']] = cell(event.start_date, 'YYYY-MM-DD')
+                row[cols['Vecka']] = cell(f'=ISOWEEKNUM({date})', font=computed_font)
+                row[cols['Dag']] = cell(f'={date}', 'ddd', computed_font)
+                row[cols['Koordinator']] = ", ".join(
+                    c.get_fullname() for c in event.coordinators.all())
+
+            if a is not None:
+                row[cols['Start']] = cell(a.start_time, 'hh:mm')
+                row[cols['Slut']] = cell(a.end_time, 'hh:mm')
+                row[cols['Publ. datum']] = a.earliest_bookable_date
+
+                if a.type:
+                    row[cols['Uppgift']] = a.type.name
+                    for j, t in enumerate([a.type.fee_reimbursed,
+                                           a.type.food_included, a.type.rental_kart]):
+                        row[cols['Ersättning'] + j] = 'Ja' if t else 'Nej'
+                n += 1
+
+            ws.append(row)
+
+    return n, r
+
+
+def exportScheduleToExcel(file, years):
+    '''
+    Writes the schedule for one or more years to file (path or file object)
+    in the same layout as importDataFromExcel reads. Uses a write-only
+    workbook and fetches one year at a time, so memory use stays bounded.
+    Returns the number of activities exported.
+    '''
+    if isinstance(years, int):
+        years = [years]
+
+    wb = openpyxl.Workbook(write_only=True, iso_dates=True)
+    ws = wb.create_sheet()
 
     es = ExcelSheet(ws)
-    es.createHeader()
 
-    cols = es.cols
-
-    ws.column_dimensions['A'].width = 35
-    ws.column_dimensions['F'].width = 25
-    for c in ['B','C','D','E','L']:
-        ws.column_dimensions[c].width = 10
-    for c in ['G','H']:
-        ws.column_dimensions[c].width = 7
-    for c in ['I','J','K']:
-        ws.column_dimensions[c].width = 4
+    for c, width in [('A', 35), ('F', 25)] + \
+            [(c, 10) for c in 'BCDEL'] + [(c, 7) for c in 'GH'] + [(c, 4) for c in 'IJK']:
+        ws.column_dimensions[c].width = width
 
     header_font = openpyxl.styles.Font(bold=True)
     computed_font = openpyxl.styles.Font(italic=True)
 
-    for cell in ws["1:1"]:
-        cell.font = header_font
-
-    r = 3
-    for event in Event.objects.filter(start_date__year=year):
-        print(f'{event.start_date}: {event.name}')
-
-        ws.cell(r, 1).value = event.name
-        ws.cell(r, cols['Typ']).value = event.type.name if event.type else ''
-
-        datecell = ws.cell(r, cols['Datum'])
-        datecell.value = event.start_date
-        datecell.number_format = 'YYYY-MM-DD'
-
-        weekcell = ws.cell(r, cols['Vecka'])
-        weekcell.value = f'=ISOWEEKNUM({datecell.coordinate})' 
-        weekcell.data_type = 'f'
-
-        daycell = ws.cell(r, cols['Dag'])
-        daycell.value = f'={datecell.coordinate}' 
-        daycell.number_format = 'ddd'
-
-        for c in [weekcell, daycell]:
-            c.font = computed_font
-
-        ws.cell(r, cols['Koordinator']).value = ", ".join(
-            c.get_fullname() for c in event.coordinators.all())
-
-        for a in event.activities.exclude(type__in=[driver_type]).order_by('type__id'):
-            col = [a.start_time, a.end_time]
-            for i, t in enumerate(col):
-                ws.cell(r, cols['Start'] + i).value = t
-                ws.cell(r, cols['Start'] + i).number_format = 'hh:mm'
-
-            ws.cell(r, cols['Publ. datum']).value = a.earliest_bookable_date
-
-            if a.type:
-                ws.cell(r, cols['Uppgift']).value = a.type.name
-                for i, t in enumerate([ a.type.fee_reimbursed,
-                                   a.type.food_included, a.type.rental_kart]):
-                    ws.cell(r, cols['Ersättning'] + i).value = 'Ja' if t else 'Nej' 
-
-            r += 1
+    header = []
+    for t in es.cols:
+        c = WriteOnlyCell(ws, value=t)
+        c.font = header_font
+        header.append(c)
 
+    ws.append(header)
+    ws.append([])
 
-    with open(filename, 'wb') as file:
-        wb.save(file)
+    n, r = 0, 2
+    for year in years:
+        count, r = _scheduleYear(ws, es, year, r, computed_font)
+        n += count
 
-    print(f"Exported {r-2} activities to: {filename}")
+    wb.save(file)
+    return n
@@ -0,0 +1,122 @@
+"""
+Processing of inbound SMS stored by the ReceiveSMS webhook.
+
+Members can answer a reminder with e.g. "JA" to confirm their next activity
+or "NEJ"/"AVBOKA" to ask to be delisted from it. Messages are handled in
+batches: senders and their next activities are looked up with one query
+each per batch, then every message is applied in its own transaction.
+"""
+
+import datetime
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
+from app import conditional, events
+from app.models import Activity, ActivityDelistRequest, InboundSMS, Member
+
+log = logging.getLogger(__name__)
+
+CONFIRM_WORDS = {'JA', 'OK', 'BEKRÄFTA', 'BEKRÄFTAR'}
+DELIST_WORDS = {'NEJ', 'AVBOKA', 'AVBOKNING', 'STRYK'}
+
+
+def parse_reply(body):
+    '''returns 'confirm', 'delist' or None for an SMS reply'''
+    words = body.strip().upper().split()
+    if not words:
+        return None
+
+    word = words[0].strip('.,!')
+    if word in CONFIRM_WORDS:
+        return 'confirm'
+    if word in DELIST_WORDS:
+        return 'delist'
+    return None
+
+
+def _members_by_number(numbers):
+    members = {}
+    for member in Member.objects \
+            .filter(phone_number__in=numbers) \
+            .select_related('user') \
+            .order_by('id'):
+        members.setdefault(member.phone_number, member)
+    return members
+
+
+def _next_activities(members):
+    '''the next upcoming activity each member is booked on'''
+    activities = {}
+    for activity in Activity.objects \
+            .filter(assigned__in=members, event__end_date__gte=datetime.date.today()) \
+            .select_related('event') \
+            .order_by('event__start_date', 'start_time', 'id'):
+        activities.setdefault(activity.assigned_id, activity)
+    return activities
+
+
+def _apply(message, member, activity):
+    if member is None:
+        return InboundSMS.UNKNOWN_SENDER
+
+    action = parse_reply(message.body)
+    if action is None:
+        return InboundSMS.NOT_UNDERSTOOD
+
+    if activity is None:
+        return InboundSMS.NO_ACTIVITY
+
+    if action == 'confirm':
+        Activity.objects.filter(id=activity.id).update(confirmed=True, modified=timezone.now())
+        conditional.changed('activities')
+        result = InboundSMS.CONFIRMED
+    else:
+        reason = f'Via SMS: {message.body}'
+        adr, created = ActivityDelistRequest.objects.get_or_create(
+            member=member, activity=activity, defaults={'reason': reason})
+        if not created and adr.approved is not None:
+            # one request per member and activity, reopen the answered one
+            adr.approved, adr.approver, adr.reject_reason = None, None, ''
+            adr.reason = reason
+            adr.save()
+        result = InboundSMS.DELIST_REQUESTED
+
+    events.sms_reply_handled(message, member, activity, result)
+    return result
+
+
+def process_batch(batch_size=100):
+    '''handles up to batch_size unprocessed messages, returns the number handled'''
+    messages = list(InboundSMS.objects
+                    .filter(processed=None)
+                    .order_by('id')[:batch_size])
+    if not messages:
+        return 0
+
+    members = _members_by_number({m.from_number for m in messages})
+    activities = _next_activities(list(members.values()))
+
+    for message in messages:
+        member = members.get(message.from_number)
+        activity = activities.get(member.id) if member else None
+
+        try:
+            with transaction.atomic():
+                message.result = _apply(message, member, activity)
+                message.error = ''
+        except Exception as e:
+            log.exception(f"Failed to process SMS {message.message_sid}")
+            message.result = InboundSMS.ERROR
+            message.error = f"{type(e).__name__}: {e}"
+
+        message.member = member
+        message.activity = activity if message.result in [
+            InboundSMS.CONFIRMED, InboundSMS.DELIST_REQUESTED] else None
+        message.processed = datetime.datetime.now()
+        message.save(update_fields=['result', 'error', 'member', 'activity', 'processed'])
+
+        log.info(f"SMS {message.message_sid} from {message.from_number}: {message.result}")
+
+    return len(messages)
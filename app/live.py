@@ -0,0 +1,258 @@
+"""
+Live activity updates, these wake the long-polls of api_sync.ChangeList.
+
+Activity and delist request signals publish a small message per change,
+once the transaction has committed, to the viewers of the event
+('event:<id>'), of the season ('season:<year>') and of everything ('all').
+Viewers subscribed in the same process get it right away without any query.
+A subscription can filter what it receives, api_sync only lets members see
+their own delist requests.
+
+Changes made by other worker processes are picked up by one relay thread
+per process: it watches the shared 'activities' version token (see
+app.conditional) and when it changes loads the rows modified since its last
+look, with one query for all viewers of the process, and publishes what was
+not already published here. Deletions in other processes are not relayed,
+clients catch up on those through /api/changes when they reconnect.
+"""
+
+import datetime
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from app import caching
+from app.models import Activity, ActivityDelistRequest
+
+log = logging.getLogger(__name__)
+
+# seconds between the relay's checks of the shared version token
+RELAY_INTERVAL = 2.0
+
+# rows are looked up this far before the relay's last look, like api_sync.OVERLAP
+OVERLAP = datetime.timedelta(seconds=10)
+
+# messages a slow viewer may fall behind before it must reload
+QUEUE_SIZE = 200
+
+# published (kind, id, modified) keys remembered to skip relayed duplicates
+RECENT_SIZE = 5000
+
+
+class Subscription:
+    def __init__(self, channels, accepts=None):
+        self.channels = channels
+        self.accepts = accepts
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.overflowed = False
+
+    def get(self, timeout):
+        '''the next message, None on timeout, raises Overflow if messages were lost'''
+        try:
+            message = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if message is OVERFLOW:
+            raise Overflow()
+        return message
+
+
+class Overflow(Exception):
+    '''a subscriber fell too far behind, it must reload'''
+
+
+OVERFLOW = object()
+
+
+class Broker:
+    def __init__(self):
+        self._subscriptions = defaultdict(set)
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+
+    def subscribe(self, *channels, accepts=None):
+        '''subscribes to channels, accepts(message) may reject messages'''
+        subscription = Subscription(channels, accepts)
+        with self._lock:
+            for channel in channels:
+                self._subscriptions[channel].add(subscription)
+        start_relay()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscriptions[channel].discard(subscription)
+                if not self._subscriptions[channel]:
+                    del self._subscriptions[channel]
+
+    def subscribers(self):
+        with self._lock:
+            return sum(len(s) for s in self._subscriptions.values())
+
+    def publish(self, channels, message, key=None):
+        '''sends message to the subscribers of channels, once per key'''
+        with self._lock:
+            if key is not None:
+                if key in self._recent:
+                    return
+                self._recent[key] = True
+                while len(self._recent) > RECENT_SIZE:
+                    self._recent.popitem(last=False)
+
+            subscriptions = set()
+            for channel in channels:
+                subscriptions |= self._subscriptions.get(channel, set())
+
+        for subscription in subscriptions:
+            if subscription.overflowed:
+                continue
+            if subscription.accepts is not None and not subscription.accepts(message):
+                continue
+            try:
+                subscription.queue.put_nowait(message)
+            except queue.Full:
+                subscription.overflowed = True
+                # make room for the marker, the viewer reloads anyway
+                subscription.queue.get_nowait()
+                subscription.queue.put_nowait(OVERFLOW)
+
+
+broker = Broker()
+
+
+##############################################################################
+# messages
+
+def _channels(event_id, start_date):
+    return [f'event:{event_id}', f'season:{start_date.year}', 'all']
+
+
+def activity_message(activity):
+    message = {
+        'kind': 'activity',
+        'id': activity.id,
+        'event': activity.event_id,
+        'assigned': activity.assigned_id,
+        'cancelled': activity.cancelled,
+        'bookable': activity.bookable,
+        'modified': activity.modified.isoformat(),
+    }
+    key = ('activity', activity.id, message['modified'])
+    return _channels(activity.event_id, activity.event.start_date), message, key
+
+
+def delist_request_message(adr):
+    activity = adr.activity
+    message = {
+        'kind': 'delist_request',
+        'id': adr.id,
+        'member': adr.member_id,
+        'activity': adr.activity_id,
+        'assigned': activity.assigned_id,
+        'event': activity.event_id,
+        'approved': adr.approved,
+        'modified': adr.modified.isoformat(),
+    }
+    key = ('delist_request', adr.id, message['modified'])
+    return _channels(activity.event_id, activity.event.start_date), message, key
+
+
+def deleted_message(kind, object_id, event_id, start_date, **fields):
+    message = dict(fields, kind=kind, id=object_id, event=event_id, deleted=True)
+    return _channels(event_id, start_date), message, (kind, object_id, 'deleted')
+
+
+def _publish_on_commit(channels, message, key):
+    transaction.on_commit(lambda: broker.publish(channels, message, key))
+
+
+@receiver(post_save, sender=Activity)
+def _activity_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _publish_on_commit(*activity_message(instance))
+
+
+@receiver(post_delete, sender=Activity)
+def _activity_deleted(sender, instance, **kwargs):
+    _publish_on_commit(*deleted_message('activity', instance.id, instance.event_id,
+                                        instance.event.start_date))
+
+
+@receiver(post_save, sender=ActivityDelistRequest)
+def _adr_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _publish_on_commit(*delist_request_message(instance))
+
+
+@receiver(post_delete, sender=ActivityDelistRequest)
+def _adr_deleted(sender, instance, **kwargs):
+    activity = instance.activity
+    _publish_on_commit(*deleted_message('delist_request', instance.id, activity.event_id,
+                                        activity.event.start_date, member=instance.member_id,
+                                        assigned=activity.assigned_id))
+
+
+##############################################################################
+# relay of changes committed by other processes
+
+def relay_changes(since):
+    '''publishes activities and delist requests changed since, returns the next since'''
+    now = timezone.now()
+    since -= OVERLAP
+
+    for activity in Activity.objects \
+            .filter(modified__gte=since) \
+            .select_related('event'):
+        broker.publish(*activity_message(activity))
+
+    for adr in ActivityDelistRequest.objects \
+            .filter(modified__gte=since) \
+            .select_related('activity__event'):
+        broker.publish(*delist_request_message(adr))
+
+    return now
+
+
+def _relay():
+    version, since = None, None
+
+    while True:
+        time.sleep(RELAY_INTERVAL)
+
+        try:
+            current = caching.version('data:activities')
+            if not broker.subscribers() or version is None:
+                # nobody to relay to, start over from now
+                version, since = current, timezone.now()
+            elif current != version:
+                version = current
+                since = relay_changes(since)
+        except Exception:
+            log.exception("Failed to relay activity changes")
+        finally:
+            close_old_connections()
+
+
+_relay_thread = None
+_relay_lock = threading.Lock()
+
+
+def start_relay():
+    global _relay_thread
+
+    if not getattr(settings, 'LIVE_RELAY', True):
+        return
+
+    with _relay_lock:
+        if _relay_thread is None or not _relay_thread.is_alive():
+            _relay_thread = threading.Thread(target=_relay, name='live-relay', daemon=True)
+            _relay_thread.start()
@@ -0,0 +1,93 @@
+"""
+Bulk email delivery over a persistent SMTP connection.
+
+Django's send_mail() opens and closes a connection per call. Mailer keeps one
+connection open for as long as it is used, e.g. a whole outbox or reminder
+run, and reconnects once if the server dropped it. deliver_many() reports
+the outcome per message so callers can retry just the failures. Sends go
+through the 'smtp' circuit breaker, so a dead server fails fast.
+"""
+
+import logging
+import smtplib
+import socket
+
+from django.core.mail import get_connection
+
+from app.breaker import breaker
+
+log = logging.getLogger(__name__)
+
+# errors after which the connection is reopened and the message retried once
+RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout)
+
+
+class Mailer:
+    '''sends EmailMessages over one connection, reconnecting when it is lost'''
+
+    def __init__(self, connection=None):
+        self.connection = connection or get_connection()
+        self.connects = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        try:
+            self.connection.open()
+            self.connects += 1
+        except Exception as e:
+            log.warning(f"Failed to connect to mail server: {e}")
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception as e:
+            log.warning(f"Failed to close mail connection: {e}")
+
+    def reconnect(self):
+        log.info("Reconnecting to mail server")
+        self.close()
+        self.open()
+
+    def _send(self, message):
+        breaker('smtp').call(self._send_now, message)
+
+    def _send_now(self, message):
+        if self.connects == 0:
+            self.open()
+
+        message.connection = self.connection
+        if self.connection.send_messages([message]) != 1:
+            raise smtplib.SMTPException(f"Message to {message.to} was not sent")
+
+    def deliver_many(self, messages):
+        '''sends messages, returns a list with None or the error for each'''
+        errors = []
+
+        for message in messages:
+            try:
+                self._send(message)
+            except RECONNECT_ERRORS:
+                self.reconnect()
+                try:
+                    self._send(message)
+                except Exception as e:
+                    errors.append(e)
+                    continue
+            except Exception as e:
+                errors.append(e)
+                continue
+
+            errors.append(None)
+
+        return errors
+
+
+def deliver_many(messages, connection=None):
+    '''sends messages over one connection, returns a list with None or the error for each'''
+    with Mailer(connection) as mailer:
+        return mailer.deliver_many(messages)
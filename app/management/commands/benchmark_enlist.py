@@ -0,0 +1,101 @@
+import collections
+import datetime
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test.utils import setup_databases, teardown_databases
+
+from app import booking
+from app.models import Activity, Event, Member
+
+
+class Command(BaseCommand):
+    help = 'Fires concurrent enlistments at one event on a throwaway copy of the ' \
+           'configured database engine and reports throughput and conflicts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=300, help="Number of competing members")
+        parser.add_argument('--activities', type=int, default=20, help="Number of activities in the event")
+        parser.add_argument('--threads', type=int, default=32, help="Concurrent workers")
+        parser.add_argument('--attempts', type=int, default=3,
+                            help="Activities each member tries to book")
+
+    def handle(self, *args, **options):
+        # never the real database: creating the benchmark users queues a
+        # new-user mail to the managers for each of them, among other things
+        with tempfile.TemporaryDirectory() as tmp:
+            if connection.vendor == 'sqlite':
+                # a file, not the default in-memory database, so that threads
+                # compete for the database like web workers do
+                connection.settings_dict['TEST']['NAME'] = os.path.join(tmp, 'benchmark.sqlite3')
+
+            old_config = setup_databases(verbosity=0, interactive=False, aliases=['default'])
+            try:
+                self.benchmark(options)
+            finally:
+                connections.close_all()
+                teardown_databases(old_config, verbosity=0)
+
+    def benchmark(self, options):
+        tag = uuid.uuid4().hex[:8]
+        self.stdout.write(f"Database: {connection.vendor} ({connection.settings_dict['NAME']})")
+
+        today = datetime.date.today()
+        event = Event.objects.create(name=f'benchmark {tag}', start_date=today, end_date=today)
+        activity_ids = [
+            Activity.objects.create(name=f'Task {i}', event=event).id
+            for i in range(options['activities'])]
+
+        users = [User.objects.create(username=f'{tag}-{i}@benchmark.invalid',
+                                     email=f'{tag}-{i}@benchmark.invalid')
+                 for i in range(options['members'])]
+
+        members = list(Member.objects.filter(user__in=users))
+        self.stdout.write(f"Created {len(members)} members competing for {len(activity_ids)} activities")
+
+        self.run(members, activity_ids, options)
+
+        assigned = Activity.objects.filter(event=event).exclude(assigned=None)
+        double = assigned.values('assigned').distinct().count() != assigned.count()
+        self.stdout.write(f"Assigned: {assigned.count()}/{len(activity_ids)}, "
+                          f"double bookings: {'YES' if double else 'none'}")
+
+    def run(self, members, activity_ids, options):
+        results = collections.Counter()
+        lock = threading.Lock()
+
+        def attempt(args):
+            member, offset = args
+            try:
+                for i in range(options['attempts']):
+                    activity_id = activity_ids[(offset + i) % len(activity_ids)]
+                    try:
+                        status = booking.enlist(activity_id, member).status
+                    except Exception as e:
+                        status = f'error: {type(e).__name__}'
+                    with lock:
+                        results[status] += 1
+            finally:
+                connections.close_all()
+
+        work = [(m, i) for i, m in enumerate(members)]
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+            list(pool.map(attempt, work))
+        elapsed = time.perf_counter() - start
+
+        total = sum(results.values())
+        self.stdout.write(f"{total} attempts in {elapsed:.2f}s "
+                          f"({total / elapsed:.0f} attempts/s) using {options['threads']} threads")
+
+        for status, count in results.most_common():
+            self.stdout.write(f"  {status:20} {count}")
@@ -4,14 +4,17 @@ from django.core.management.base import BaseCommand, CommandError
 from app.excel import exportScheduleToExcel
 
 class Command(BaseCommand):
-    help = "Exports a year's schedule to an MS Excel file"
+    help = "Exports one or more years' schedules to an MS Excel file"
 
     def add_arguments(self, parser):
         parser.add_argument('--file', type=str, help="Excel file path")
-        parser.add_argument('--year', type=int, help="Year of data")
+        parser.add_argument('--year', type=int, action='append',
+                            help="Year of data, may be given more than once")
 
     def handle(self, *args, **options):
-        year = options['year'] or datetime.date.today().year
-        outfile = options['file'] or f'Aktivitetslista T13 {year}.xlsx'
+        years = options['year'] or [datetime.date.today().year]
+        name = '-'.join(str(y) for y in years)
+        outfile = options['file'] or f'Aktivitetslista T13 {name}.xlsx'
 
-        exportScheduleToExcel(outfile, year)
+        n = exportScheduleToExcel(outfile, years)
+        self.stdout.write(f"Exported {n} activities to: {outfile}")
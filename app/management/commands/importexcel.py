@@ -1,5 +1,5 @@
 from django.core.management.base import BaseCommand, CommandError
-from app.excel import importDataFromExcel
+from app.excel import importDataFromExcel, ExcelImportException
 
 class Command(BaseCommand):
     help = 'Imports an excelfile'
@@ -7,7 +7,14 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('file', type=str, help="Excel file path")
         parser.add_argument('--year', type=int, help="Year of data")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Parse, validate and write in a transaction that is rolled back")
 
     def handle(self, *args, **options):
         with open(options['file'], 'rb') as file:
-            importDataFromExcel(file, options['year'])
\ No newline at end of file
+            try:
+                n = importDataFromExcel(file, options['year'], dry_run=options['dry_run'])
+            except ExcelImportException as e:
+                raise CommandError(f"Nothing imported, invalid rows:\n{e}")
+
+        self.stdout.write(f"{'Would import' if options['dry_run'] else 'Imported'} {n} activities")
@@ -1,53 +1,68 @@
 import datetime, logging
 
 from django.core.management.base import BaseCommand
-from django.conf import settings
+from django.db import transaction
+from django.test.utils import override_settings
 
-from app.events import notify_upcoming_activity
-from app.models import Event, Activity
+from app import outbox, sms
+from app.reminders import due_reminders, send_reminders
 
 log = logging.getLogger(__name__)
 
+
 class Command(BaseCommand):
-    help = 'Notify users assigned to activitites that occur in x days '
+    help = 'Notify users assigned to activitites that occur in x days, ' \
+           'reminders already sent for the same lead time are skipped'
 
     def add_arguments(self, parser):
-        parser.add_argument('days', type=str, help="days to notify")
+        parser.add_argument('days', type=int, nargs='+', help="days to notify, e.g. 7 1")
         parser.add_argument('--send', help="Test-only", action='store_true')
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Send through local stand-in email/SMS backends, roll back "
+                                 "and report throughput")
+        parser.add_argument('--sms-latency', type=float, default=100,
+                            help="Simulated SMS latency in ms for --dry-run")
+        parser.add_argument('--sms-rate', type=float, default=None,
+                            help="Simulated provider rate limit in SMS/s for --dry-run")
+        parser.add_argument('--threads', type=int, default=outbox.SMS_WORKERS,
+                            help="Concurrent SMS sends")
 
     def handle(self, *args, **options):
-        date = datetime.date.today() \
-            + datetime.timedelta(days=int(options['days']))
-
-        events = Event.objects.filter(
-            start_date__year=date.year,
-            start_date__month=date.month,
-            start_date__day=date.day)
+        days = options['days']
 
-        activities = Activity.objects \
-            .filter(event__in=[e.id for e in events]) \
-            .select_related('assigned', 'assigned__user')
+        if options['dry_run']:
+            self.dry_run(days, options)
+            return
 
-        self.stdout.write(f"Found {len(activities)} activities that occur on {date}")
+        due = due_reminders(days)
+        self.stdout.write(f"Found {len(due)} activities to remind about {days} day(s) ahead")
 
         if not options['send']:
-            for a in activities:
-                self.stdout.write("  " + a.name)
+            for a, d in due:
+                self.stdout.write(f"  {d} d: {a.name}")
 
             self.stdout.write("Not sending anything, need --send arg")
             return
 
-        err = False
-        for a in activities:
-            try:
-                notify_upcoming_activity(a)
-            except:
-                err = True
-                self.stderr.write(f"ERROR: Failed to notify for {a}", exc_info=True)
+        run = send_reminders(days, sms_workers=options['threads'])
+        self.stdout.write(str(run))
 
-        if err:
-            self.stderr.write("FAILURE (-ISH, maybe)")
+        if run.failed:
+            self.stderr.write("FAILURE (-ISH, will be retried by run_outbox)")
         else:
             self.stdout.write("SUCCESS")
 
+    def dry_run(self, days, options):
+        backend = sms.FakeBackend(latency=options['sms_latency'] / 1000,
+                                  rate=options['sms_rate'])
+
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                               DEFAULT_FROM_EMAIL='dry-run@localhost'), \
+                sms.use_backend(backend), \
+                transaction.atomic():
+            run = send_reminders(days, sms_workers=options['threads'])
+            transaction.set_rollback(True)
 
+        self.stdout.write(f"Dry run with {options['threads']} SMS thread(s) and "
+                          f"{options['sms_latency']:.0f} ms simulated SMS latency:")
+        self.stdout.write(str(run))
@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from app import inbox
+
+
+class Command(BaseCommand):
+    help = 'Processes received SMS, e.g. members confirming or delisting by replying to reminders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="Messages handled per batch")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep polling for new messages instead of exiting when done")
+        parser.add_argument('--interval', type=float, default=10,
+                            help="Seconds to sleep between polls with --loop")
+
+    def handle(self, *args, **options):
+        total = 0
+        start = time.perf_counter()
+
+        while True:
+            handled = inbox.process_batch(options['batch_size'])
+            total += handled
+
+            if handled:
+                self.stdout.write(f"Processed {handled} message(s)")
+                continue
+
+            if not options['loop']:
+                break
+
+            connection.close()
+            time.sleep(options['interval'])
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"Done: {total} message(s) in {elapsed:.2f}s")
@@ -0,0 +1,61 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from app import notifications
+from app.models import Activity, Member, MemberSeason
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the materialized per-member season ledger (MemberSeason)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--year', type=int, action='append',
+                            help="Year(s) to rebuild, default is all years with events")
+
+    def handle(self, *args, **options):
+        years = options['year'] or [d.year for d in
+                                    Activity.objects.dates('event__start_date', 'year')]
+
+        current_year = datetime.date.today().year
+        biases = dict(Member.objects
+                      .exclude(min_signup_bias=0)
+                      .values_list('id', 'min_signup_bias'))
+
+        for year in years:
+            activities = Activity.objects.filter(event__start_date__year=year)
+            aggregates = MemberSeason.weight_aggregates()
+
+            # weight counts both for the assigned member and the one it was booked for
+            figures = {}
+            for field, qs in [('assigned', activities),
+                              ('assigned_for_proxy', activities.exclude(assigned_for_proxy=F('assigned')))]:
+                rows = qs.exclude(**{field: None}) \
+                    .order_by() \
+                    .values(field) \
+                    .annotate(**aggregates)
+
+                for row in rows:
+                    f = figures.setdefault(row[field], dict.fromkeys(aggregates, 0))
+                    for k in aggregates:
+                        f[k] += row[k] or 0
+
+            seasons = [
+                MemberSeason(member_id=member_id, year=year,
+                             bias=biases.get(member_id, 0) if year == current_year else 0,
+                             **f)
+                for member_id, f in figures.items()]
+
+            with transaction.atomic():
+                previous = MemberSeason.objects.filter(year=year)
+                member_ids = set(previous.values_list('member_id', flat=True)) | set(figures)
+                previous.delete()
+                MemberSeason.objects.bulk_create(seasons)
+
+            # bulk_create sends no post_save, the cached /api/isloggedin
+            # payloads of these members must be dropped here
+            notifications.invalidate_members(member_ids)
+
+            self.stdout.write(f"{year}: rebuilt ledger for {len(seasons)} member(s)")
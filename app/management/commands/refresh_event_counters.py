@@ -0,0 +1,22 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from app.models import Event
+
+
+class Command(BaseCommand):
+    help = 'Recomputes activity counters on events, run nightly so activities ' \
+           'whose earliest bookable date has passed are counted as available'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="Refresh all events, not only current and upcoming ones")
+
+    def handle(self, *args, **options):
+        events = Event.objects.all()
+        if not options['all']:
+            events = events.filter(end_date__gte=datetime.date.today())
+
+        count = Event.refresh_activity_counters(events)
+        self.stdout.write(f"Refreshed activity counters on {count} event(s)")
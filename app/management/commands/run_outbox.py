@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from app import outbox
+from app.mail import Mailer
+
+
+class Command(BaseCommand):
+    help = 'Delivers queued email and SMS from the outbox, retrying failures with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help="Messages claimed and sent per batch")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep polling for new messages instead of exiting when done")
+        parser.add_argument('--interval', type=float, default=10,
+                            help="Seconds to sleep between polls with --loop")
+
+    def handle(self, *args, **options):
+        total_sent = total_failed = 0
+        start = time.perf_counter()
+
+        # one SMTP connection for the whole run, reopened if the server drops it
+        with Mailer() as mailer:
+            while True:
+                sent, failed = outbox.process(options['batch_size'], mailer)
+                total_sent += sent
+                total_failed += failed
+
+                if sent or failed:
+                    self.stdout.write(f"Sent {sent}, failed {failed}")
+                    continue
+
+                if not options['loop']:
+                    break
+
+                connection.close()
+                time.sleep(options['interval'])
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"Done: {total_sent} sent, {total_failed} failed in {elapsed:.2f}s")
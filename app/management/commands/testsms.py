@@ -1,7 +1,6 @@
 from django.core.management.base import BaseCommand
-from django.conf import settings
 
-from app.events import sms_client
+from app import sms
 
 class Command(BaseCommand):
     help = 'Sends a test SMS'
@@ -13,7 +12,5 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         sms_target = options['to']
         msg = options.get('msg') or 'Test!'
-        sms_client().messages.create(
-            body=f"{msg} /Team13",
-            from_=settings.SMS_FROM_NUMBER,
-            to=sms_target)
+        sid = sms.send(sms_target, f"{msg} /Team13")
+        self.stdout.write(f"Sent {sid}")
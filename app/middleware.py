@@ -1,9 +1,51 @@
+from django.utils.functional import SimpleLazyObject
+
+from app.models import Member
+
+
+def get_member(request):
+    '''the authenticated user's Member, loaded once per request, None if anonymous.
+
+    Evaluated lazily on first use, so it sees users authenticated by DRF
+    (e.g. tokens) too. The already loaded user is attached to the member
+    and vice versa, so request.member.user and request.user.member are free.
+    '''
+    if not hasattr(request, '_cached_member'):
+        user = request.user
+        member = None
+
+        if user.is_authenticated:
+            user = getattr(user, '_wrapped', user)
+            member = Member.objects.filter(user_id=user.id).first()
+            if member is not None:
+                Member.user.field.set_cached_value(member, user)
+                Member.user.field.remote_field.set_cached_value(user, member)
+
+        request._cached_member = member
+
+    return request._cached_member
+
+
+def member_middleware(get_response):
+    '''adds request.member, test it for truthiness since it is a lazy object'''
+
+    def middleware(request):
+        request.member = SimpleLazyObject(lambda: get_member(request))
+        return get_response(request)
+
+    return middleware
+
+
 def disable_api_cache_middleware(get_response):
+    '''API responses without an ETag must not be cached, those with one are revalidated'''
 
     def middleware(request):
         response = get_response(request)
         if request.path_info.startswith('/api/') and response.get('Cache-Control') is None:
-            response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+            if response.has_header('ETag'):
+                response['Cache-Control'] = 'private, no-cache'
+            else:
+                response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
         return response
 
-    return middleware
\ No newline at end of file
+    return middleware
@@ -0,0 +1,75 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:36
+
+import datetime
+
+from django.db import migrations, models
+from django.db.models import F, Q, Sum
+import django.db.models.deletion
+
+
+def fill_ledger(apps, schema_editor):
+    '''like the rebuild_ledger command, with the models of this migration'''
+    Activity = apps.get_model('app', 'Activity')
+    ActivityDelistRequest = apps.get_model('app', 'ActivityDelistRequest')
+    Member = apps.get_model('app', 'Member')
+    MemberSeason = apps.get_model('app', 'MemberSeason')
+
+    current_year = datetime.date.today().year
+    biases = dict(Member.objects
+                  .exclude(min_signup_bias=0)
+                  .values_list('id', 'min_signup_bias'))
+    pending_adr = ActivityDelistRequest.objects.filter(approved=None).values('activity')
+    aggregates = {
+        'completed_weight': Sum('weight', filter=Q(completed=True)),
+        'booked_weight': Sum('weight', filter=~Q(id__in=pending_adr)),
+        'pending_adr_weight': Sum('weight', filter=Q(id__in=pending_adr)),
+    }
+
+    for year in [d.year for d in Activity.objects.dates('event__start_date', 'year')]:
+        activities = Activity.objects.filter(event__start_date__year=year)
+
+        # weight counts both for the assigned member and the one it was booked for
+        figures = {}
+        for field, qs in [('assigned', activities),
+                          ('assigned_for_proxy', activities.exclude(assigned_for_proxy=F('assigned')))]:
+            for row in qs.exclude(**{field: None}).order_by().values(field).annotate(**aggregates):
+                f = figures.setdefault(row[field], dict.fromkeys(aggregates, 0))
+                for k in aggregates:
+                    f[k] += row[k] or 0
+
+        MemberSeason.objects.bulk_create([
+            MemberSeason(member_id=member_id, year=year,
+                         bias=biases.get(member_id, 0) if year == current_year else 0,
+                         **f)
+            for member_id, f in figures.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0045_merge_20200726_1353'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MemberSeason',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField(verbose_name='År')),
+                ('completed_weight', models.IntegerField(default=0, verbose_name='Utfört')),
+                ('booked_weight', models.IntegerField(default=0, verbose_name='Bokat')),
+                ('pending_adr_weight', models.IntegerField(default=0, verbose_name='Under avbokning')),
+                ('bias', models.IntegerField(default=0, verbose_name='Justering')),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='seasons', to='app.Member')),
+            ],
+            options={
+                'verbose_name': 'Säsongssammanställning',
+                'verbose_name_plural': 'Säsongssammanställningar',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='memberseason',
+            constraint=models.UniqueConstraint(fields=('member', 'year'), name='member_season_per_year'),
+        ),
+        migrations.RunPython(fill_ledger, migrations.RunPython.noop),
+    ]
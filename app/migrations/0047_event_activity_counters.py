@@ -0,0 +1,51 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:39
+
+import datetime
+
+from django.db import migrations, models
+from django.db.models import Q, OuterRef, Subquery
+
+
+class SubqueryCount(Subquery):
+    template = "(SELECT COUNT(*) FROM (%(subquery)s) _count)"
+    output_field = models.IntegerField()
+
+
+def count_activities(apps, schema_editor):
+    Activity = apps.get_model('app', 'Activity')
+    Event = apps.get_model('app', 'Event')
+
+    today = datetime.date.today()
+    activities = Activity.objects.filter(event=OuterRef('pk')).values('id')
+    available = Q(assigned=None) & (Q(earliest_bookable_date__lte=today) | Q(earliest_bookable_date=None))
+
+    Event.objects.update(
+        activities_total=SubqueryCount(activities),
+        activities_assigned=SubqueryCount(activities.exclude(assigned=None)),
+        activities_available=SubqueryCount(activities.filter(available)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0046_memberseason'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='activities_assigned',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Bokade uppgifter'),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='activities_available',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Lediga uppgifter'),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='activities_total',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Uppgifter'),
+        ),
+        migrations.RunPython(count_activities, migrations.RunPython.noop),
+    ]
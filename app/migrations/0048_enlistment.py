@@ -0,0 +1,50 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:40
+
+from django.db import migrations, models
+from django.db.models import Min
+import django.db.models.deletion
+
+
+def create_enlistments(apps, schema_editor):
+    Activity = apps.get_model('app', 'Activity')
+    Enlistment = apps.get_model('app', 'Enlistment')
+
+    # existing double bookings keep only their first activity as enlistment
+    first_bookings = Activity.objects \
+        .exclude(assigned=None) \
+        .order_by() \
+        .values('event', 'assigned') \
+        .annotate(activity=Min('id'))
+
+    Enlistment.objects.bulk_create([
+        Enlistment(event_id=b['event'], member_id=b['assigned'], activity_id=b['activity'])
+        for b in first_bookings])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0047_event_activity_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Enlistment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('activity', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='enlistment', to='app.Activity')),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='enlistments', to='app.Event')),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='enlistments', to='app.Member')),
+            ],
+            options={
+                'verbose_name': 'Bokning',
+                'verbose_name_plural': 'Bokningar',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='enlistment',
+            constraint=models.UniqueConstraint(fields=('event', 'member'), name='one_enlistment_per_event'),
+        ),
+        migrations.RunPython(create_enlistments, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:48
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0048_enlistment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('email', 'E-post'), ('sms', 'SMS')], max_length=8)),
+                ('idempotency_key', models.CharField(max_length=128, unique=True)),
+                ('sender', models.CharField(blank=True, max_length=128)),
+                ('recipients', models.TextField(help_text='En mottagare per rad')),
+                ('subject', models.CharField(blank=True, max_length=256)),
+                ('body', models.TextField()),
+                ('status', models.CharField(choices=[('pending', 'Väntar'), ('sent', 'Skickat'), ('failed', 'Misslyckat')], default='pending', max_length=8)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=datetime.datetime.now)),
+                ('lock', models.CharField(blank=True, editable=False, max_length=32)),
+                ('last_error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('sent', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Utgående meddelande',
+                'verbose_name_plural': 'Utgående meddelanden',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='outboxmessage',
+            index=models.Index(fields=['status', 'next_attempt'], name='outbox_due'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0049_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReminderSent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lead_days', models.PositiveSmallIntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('activity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reminders', to='app.Activity')),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reminders', to='app.Member')),
+            ],
+            options={
+                'verbose_name': 'Skickad påminnelse',
+                'verbose_name_plural': 'Skickade påminnelser',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='remindersent',
+            constraint=models.UniqueConstraint(fields=('activity', 'member', 'lead_days'), name='one_reminder_per_lead_time'),
+        ),
+    ]
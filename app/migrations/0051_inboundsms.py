@@ -0,0 +1,39 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0050_remindersent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboundSMS',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_sid', models.CharField(max_length=64, unique=True)),
+                ('from_number', models.CharField(max_length=20)),
+                ('to_number', models.CharField(blank=True, max_length=20)),
+                ('body', models.TextField(blank=True)),
+                ('payload', models.TextField(blank=True, help_text='Hela anropet från Twilio som JSON')),
+                ('received', models.DateTimeField(auto_now_add=True)),
+                ('processed', models.DateTimeField(blank=True, null=True)),
+                ('result', models.CharField(blank=True, choices=[('confirmed', 'Bekräftad'), ('delist_requested', 'Avbokning begärd'), ('unknown_sender', 'Okänd avsändare'), ('no_activity', 'Ingen kommande uppgift'), ('not_understood', 'Ej förstått'), ('error', 'Fel')], max_length=20)),
+                ('error', models.TextField(blank=True)),
+                ('activity', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='inbound_sms', to='app.Activity')),
+                ('member', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='inbound_sms', to='app.Member')),
+            ],
+            options={
+                'verbose_name': 'Inkommande SMS',
+                'verbose_name_plural': 'Inkommande SMS',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='inboundsms',
+            index=models.Index(fields=['processed'], name='app_inbound_process_0c1054_idx'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0051_inboundsms'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table', models.CharField(choices=[('events', 'Evenemang'), ('activities', 'Uppgift'), ('delist_requests', 'Avbokning')], max_length=20)),
+                ('object_id', models.IntegerField()),
+                ('deleted', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Borttagen rad',
+                'verbose_name_plural': 'Borttagna rader',
+            },
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='activitydelistrequest',
+            name='modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['modified'], name='app_activit_modifie_451c0b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activitydelistrequest',
+            index=models.Index(fields=['modified'], name='app_activit_modifie_0c5320_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['modified'], name='app_event_modifie_5ceb06_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tombstone',
+            index=models.Index(fields=['deleted'], name='app_tombsto_deleted_1cb4c0_idx'),
+        ),
+    ]
@@ -4,7 +4,7 @@ Definition of models.
 
 from django.db import models
 from django.contrib.auth.models import User
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.core.exceptions import ObjectDoesNotExist
 from django.dispatch import receiver
 from django.utils import timezone
@@ -16,7 +16,7 @@ import logging
 import datetime
 
 from app import events
-from django.db.models import Q
+from django.db.models import Q, Sum, IntegerField, OuterRef, Subquery
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +25,12 @@ class RuleViolationException(BaseException):
     '''thrown when a model change violates rules set by the club'''
     pass
 
+
+class SubqueryCount(Subquery):
+    '''COUNT(*) of a correlated subquery, usable in annotate() and update()'''
+    template = "(SELECT COUNT(*) FROM (%(subquery)s) _count)"
+    output_field = IntegerField()
+
 # Create your models here, these will be tables in the SQL database.
 
 class LicenseType(models.Model):
@@ -115,21 +121,29 @@ class Member(models.Model):
             .filter(Q(assigned=self) | Q(assigned_for_proxy=self)) \
             .filter(event__start_date__year=current_year)
 
+    def season(self, year=None):
+        '''returns the MemberSeason ledger row for year (default: current)'''
+        year = year or datetime.date.today().year
+        cached = getattr(self, 'current_seasons', None)
+        if cached is not None:
+            for season in cached:
+                if season.year == year:
+                    return season
+
+        try:
+            return MemberSeason.objects.get(member=self, year=year)
+        except MemberSeason.DoesNotExist:
+            # reads don't write, the row is stored by the signals or rebuild_ledger
+            return MemberSeason.compute(self.id, year)
+
     @property
     def completed_weight(self):
-        return self.year_activities \
-            .filter(completed=True) \
-            .aggregate(models.Sum('weight')) \
-            .get('weight__sum', 0) or 0
+        return self.season().completed_weight
 
     @property
     def booked_weight(self):
-        booked_weight = self.year_activities \
-            .exclude((~Q(delist_requests__member=None)) & Q(delist_requests__approved=None)) \
-            .aggregate(booked_weight=models.Sum('weight')) \
-            .get('booked_weight', 0) or 0
-
-        return booked_weight + self.min_signup_bias
+        season = self.season()
+        return season.booked_weight + season.bias
 
     def task_summary(self):
         '''returns completed/booked activities for this year'''
@@ -163,6 +177,10 @@ def member_saved(sender, instance, created, **kwargs):
         events.new_user_created(instance)
         return
 
+    MemberSeason.objects \
+        .filter(member=instance, year=datetime.date.today().year) \
+        .update(bias=instance.min_signup_bias)
+
     if 'email' in kwargs:
         instance.user.username = instance.user.email = instance.email
         instance.email_verified = False
@@ -265,7 +283,8 @@ class Event(models.Model):
         indexes = [
             models.Index(fields=('start_date', 'end_date')),
             models.Index(fields=('type',)),
-            models.Index(fields=('cancelled',))
+            models.Index(fields=('cancelled',)),
+            models.Index(fields=('modified',)),
         ]
         
     name = models.CharField(max_length=40)
@@ -286,6 +305,16 @@ class Event(models.Model):
     modified = models.DateTimeField(auto_now=True)
     cancelled = models.BooleanField(default=False, verbose_name='Inställd')
 
+    # maintained from Activity signals, see refresh_activity_counters()
+    activities_total = models.IntegerField(
+        default=0, editable=False, verbose_name='Uppgifter')
+    activities_assigned = models.IntegerField(
+        default=0, editable=False, verbose_name='Bokade uppgifter')
+    activities_available = models.IntegerField(
+        default=0, editable=False, verbose_name='Lediga uppgifter')
+
+    COUNTER_FIELDS = ['activities_total', 'activities_assigned', 'activities_available']
+
     def date(self):
         if self.start_date == self.end_date:
             return str(self.start_date)
@@ -296,9 +325,7 @@ class Event(models.Model):
     date = property(date)
 
     def activities_count(self):
-        if not hasattr(self, '_activities_count'):
-            self._activities_count = self.activities.count()
-        return self._activities_count
+        return self.activities_total
 
     activities_count.short_description = 'Uppgifter'
     activities_count = property(activities_count)
@@ -309,38 +336,44 @@ class Event(models.Model):
         return Q(assigned=None) & (Q(earliest_bookable_date__lte=today) | Q(earliest_bookable_date=None))
 
     def activities_available_count(self):
-        if not hasattr(self, '_activities_available_count'):
-            self._activities_available_count = self.activities.filter(self.activities_available_count_query()).count()
-        return self._activities_available_count
+        return self.activities_available
 
     activities_available_count.short_description = 'Lediga uppgifter'
     activities_available_count = property(activities_available_count)
 
     def has_bookable_activities(self):
-        if not hasattr(self, '_has_bookable_activities'):
-            if self.end_date < datetime.date.today():
-                self._has_bookable_activities = False
-            else:
-                self._has_bookable_activities = self.activities_available_count > 0
-        return self._has_bookable_activities
+        if self.end_date < datetime.date.today():
+            return False
+        return self.activities_available_count > 0
 
     has_bookable_activities.boolean = True  
     has_bookable_activities = property(has_bookable_activities)
 
+    @classmethod
+    def refresh_activity_counters(cls, events):
+        '''recomputes the activity counters of events in one UPDATE statement'''
+        activities = Activity.objects.filter(event=OuterRef('pk')).values('id')
+
+        return events.update(
+            modified=timezone.now(),
+            activities_total=SubqueryCount(activities),
+            activities_assigned=SubqueryCount(activities.exclude(assigned=None)),
+            activities_available=SubqueryCount(
+                activities.filter(cls.activities_available_count_query())))
+
     def __str__(self):
         return self.name
 
     def save(self, *args, **kwargs):
         ''' On save, update timestamps '''
-        try:
-            del self._activities_count
-            del self._activities_available_count
-            del self._has_bookable_activities
-        except:
-            pass
-
         if not self.id:
             self.created = timezone.now()
+        elif 'update_fields' not in kwargs and not self._state.adding:
+            # counters are maintained by Activity signals, never overwrite them
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in self.COUNTER_FIELDS]
+
         self.modified = timezone.now()
         return super(Event, self).save(*args, **kwargs)
 
@@ -396,6 +429,9 @@ class Activity(models.Model):
 
     earliest_bookable_date = models.DateField(null=True, blank=True)
 
+    # also set by the queryset.update() calls changing activities, see /api/changes
+    modified = models.DateTimeField(auto_now=True)
+
     @property
     def date(self):
         return self.event.start_date
@@ -408,6 +444,8 @@ class Activity(models.Model):
 
     @property
     def active_delist_request(self):
+        if 'delist_requests' in getattr(self, '_prefetched_objects_cache', {}):
+            return next((adr for adr in self.delist_requests.all() if adr.approved is None), None)
         try:
             return self.delist_requests.get(approved=None)
         except ActivityDelistRequest.DoesNotExist:
@@ -416,6 +454,16 @@ class Activity(models.Model):
     def can_member_enlist(self, member:Member):
         return not self.event.activities.filter(assigned=member).exists()
 
+    def snapshot(self):
+        '''returns the values that derived data (ledger, event counters) depends on'''
+        return {
+            'assigned_id': self.assigned_id,
+            'assigned_for_proxy_id': self.assigned_for_proxy_id,
+            'event_id': self.event_id,
+            'event__start_date': self.event.start_date,
+            'earliest_bookable_date': self.earliest_bookable_date,
+        }
+
     class Meta:
         ordering = ['start_time', 'end_time', 'name']
         verbose_name = 'Uppgift'
@@ -425,7 +473,8 @@ class Activity(models.Model):
             models.Index(fields=['event']),
             models.Index(fields=['event', 'assigned']),
             models.Index(fields=['assigned_for_proxy']),
-            models.Index(fields=['earliest_bookable_date'])
+            models.Index(fields=['earliest_bookable_date']),
+            models.Index(fields=['modified']),
         ]
 
     def __str__(self):
@@ -453,6 +502,7 @@ class ActivityDelistRequest(models.Model):
     approver = models.ForeignKey(Member, on_delete=models.SET_NULL,
                                  blank=True, null=True, related_name='approvers')
     reject_reason = models.TextField(blank=True)
+    modified = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.member}: {self.activity.name} ({self.activity.event.start_date})"
@@ -467,8 +517,36 @@ class ActivityDelistRequest(models.Model):
             models.Index(fields=['activity']),
             models.Index(fields=['member', 'activity']),
             models.Index(fields=['approver']),
+            models.Index(fields=['modified']),
+        ]
+
+
+class Enlistment(models.Model):
+    '''A member's self-service booking of an activity, see app.booking.
+
+    The unique constraint guarantees that concurrent enlistments cannot give
+    a member more than one activity per event. The Activity signals below
+    keep rows in step with assignments made elsewhere (admin, API updates),
+    but only enlist() refuses a second activity: when staff deliberately
+    assign a member twice in an event, only the first assignment has a row.
+    Code assigning with queryset.update() must keep the rows itself.
+    '''
+
+    class Meta:
+        verbose_name = 'Bokning'
+        verbose_name_plural = 'Bokningar'
+        constraints = [
+            models.UniqueConstraint(fields=['event', 'member'], name='one_enlistment_per_event')
         ]
 
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='enlistments')
+    member = models.ForeignKey(Member, on_delete=models.CASCADE, related_name='enlistments')
+    activity = models.OneToOneField(Activity, on_delete=models.CASCADE, related_name='enlistment')
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.member_id} - {self.activity_id}"
+
 
 @receiver(post_save, sender=ActivityDelistRequest)
 def save_activity_delist_request(sender, instance, created, **kwargs):
@@ -486,6 +564,175 @@ def save_activity_delist_request(sender, instance, created, **kwargs):
         events.adr_rejected(instance)
 
 
+class MemberSeason(models.Model):
+    '''Materialized booking figures for a member during one year.
+
+    Rows are refreshed from the Activity/ActivityDelistRequest signals below
+    so reading a member's season status is a single indexed lookup. Use the
+    'rebuild_ledger' management command to recompute everything after bulk
+    changes that bypass signals.
+    '''
+
+    class Meta:
+        verbose_name = 'Säsongssammanställning'
+        verbose_name_plural = 'Säsongssammanställningar'
+        constraints = [
+            models.UniqueConstraint(fields=['member', 'year'], name='member_season_per_year')
+        ]
+
+    member = models.ForeignKey(Member, on_delete=models.CASCADE, related_name='seasons')
+    year = models.PositiveSmallIntegerField(verbose_name='År')
+
+    completed_weight = models.IntegerField(default=0, verbose_name='Utfört')
+    booked_weight = models.IntegerField(default=0, verbose_name='Bokat')
+    pending_adr_weight = models.IntegerField(default=0, verbose_name='Under avbokning')
+    bias = models.IntegerField(default=0, verbose_name='Justering')
+
+    def __str__(self):
+        return f"{self.member_id} {self.year}: {self.completed_weight}/{self.booked_weight + self.bias}"
+
+    @staticmethod
+    def weight_aggregates():
+        '''returns aggregates for completed/booked/pending ADR weight of activities'''
+        pending_adr = ActivityDelistRequest.objects \
+            .filter(approved=None) \
+            .values('activity')
+
+        return {
+            'completed_weight': Sum('weight', filter=Q(completed=True)),
+            'booked_weight': Sum('weight', filter=~Q(id__in=pending_adr)),
+            'pending_adr_weight': Sum('weight', filter=Q(id__in=pending_adr)),
+        }
+
+    @classmethod
+    def figures(cls, activities):
+        '''aggregates the season figures for an activity queryset'''
+        figures = activities.aggregate(**cls.weight_aggregates())
+        return {k: v or 0 for k, v in figures.items()}
+
+    @classmethod
+    def compute(cls, member_id, year):
+        '''returns an unsaved row with the current figures for a member and year'''
+        return cls(member_id=member_id, year=year, **cls._defaults(member_id, year))
+
+    @classmethod
+    def refresh(cls, member_id, year):
+        '''recomputes and stores the figures for a member and year'''
+        season, _ = cls.objects.update_or_create(
+            member_id=member_id, year=year, defaults=cls._defaults(member_id, year))
+        return season
+
+    @classmethod
+    def _defaults(cls, member_id, year):
+        activities = Activity.objects \
+            .filter(Q(assigned=member_id) | Q(assigned_for_proxy=member_id)) \
+            .filter(event__start_date__year=year)
+
+        defaults = cls.figures(activities)
+
+        if year == datetime.date.today().year:
+            defaults['bias'] = Member.objects \
+                .filter(id=member_id) \
+                .values_list('min_signup_bias', flat=True) \
+                .first() or 0
+
+        return defaults
+
+    @classmethod
+    def refresh_many(cls, keys):
+        '''refreshes a set of (member_id, year) pairs, ignoring unassigned'''
+        for member_id, year in set(keys):
+            if member_id is not None and year is not None:
+                cls.refresh(member_id, year)
+
+
+def _activity_snapshot(activity_id):
+    '''returns the stored values of an activity that derived data depends on'''
+    return Activity.objects \
+        .filter(id=activity_id) \
+        .values('assigned_id', 'assigned_for_proxy_id', 'event_id',
+                'event__start_date', 'earliest_bookable_date') \
+        .first()
+
+
+def _season_keys(snapshot):
+    '''returns (member_id, year) pairs affected by an activity snapshot'''
+    if snapshot is None:
+        return []
+
+    year = snapshot['event__start_date'].year
+    return [(snapshot['assigned_id'], year),
+            (snapshot['assigned_for_proxy_id'], year)]
+
+
+@receiver(pre_save, sender=Activity)
+def activity_pre_save(sender, instance, raw=False, **kwargs):
+    instance._previous = None if raw or instance.pk is None \
+        else _activity_snapshot(instance.pk)
+
+
+@receiver(post_save, sender=Activity)
+def activity_post_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    previous = getattr(instance, '_previous', None)
+    current = instance.snapshot()
+
+    MemberSeason.refresh_many(_season_keys(previous) + _season_keys(current))
+
+    if previous is None:
+        assignment_changed = current['assigned_id'] is not None
+    else:
+        assignment_changed = any(previous[k] != current[k] for k in ['assigned_id', 'event_id'])
+    if assignment_changed:
+        _sync_enlistment(instance)
+
+    if created or previous is None or any(previous[k] != current[k] for k in
+            ['assigned_id', 'event_id', 'earliest_bookable_date']):
+        event_ids = {current['event_id'], previous and previous['event_id']}
+        Event.refresh_activity_counters(Event.objects.filter(id__in=event_ids))
+
+
+def _sync_enlistment(activity):
+    '''matches the activity's Enlistment row to its current assignment'''
+    Enlistment.objects \
+        .filter(activity=activity) \
+        .exclude(member=activity.assigned_id, event=activity.event_id) \
+        .delete()
+
+    if activity.assigned_id is None:
+        return
+
+    if not Enlistment.objects \
+            .filter(Q(activity=activity) |
+                    Q(event=activity.event_id, member=activity.assigned_id)) \
+            .exists():
+        Enlistment.objects.create(event_id=activity.event_id,
+                                  member_id=activity.assigned_id, activity=activity)
+
+
+@receiver(post_delete, sender=Activity)
+def activity_post_delete(sender, instance, **kwargs):
+    events = Event.objects.filter(id=instance.event_id)
+    if Event.refresh_activity_counters(events) == 0:
+        # event is being deleted too, rebuild_ledger takes care of the rest
+        return
+
+    year = events.values_list('start_date', flat=True).get().year
+    MemberSeason.refresh_many([(instance.assigned_id, year),
+                               (instance.assigned_for_proxy_id, year)])
+
+
+@receiver(post_save, sender=ActivityDelistRequest)
+@receiver(post_delete, sender=ActivityDelistRequest)
+def adr_season_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    MemberSeason.refresh_many(_season_keys(_activity_snapshot(instance.activity_id)))
+
+
 class FAQ(models.Model):
     question = models.CharField(max_length=256)
     answer = models.TextField()
@@ -518,3 +765,169 @@ class InfoText(models.Model):
 
     def __str__(self):
         return self.key
+
+
+class OutboxMessage(models.Model):
+    '''An email or SMS waiting to be delivered by the 'run_outbox' command.
+
+    Messages are written in the same transaction as the change that caused
+    them and sent afterwards, so requests never wait on SMTP or Twilio and
+    nothing is lost while a provider is down. The idempotency key makes
+    enqueueing the same notification twice a no-op.
+    '''
+
+    EMAIL = 'email'
+    SMS = 'sms'
+    KIND_CHOICES = [(EMAIL, 'E-post'), (SMS, 'SMS')]
+
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Väntar'), (SENT, 'Skickat'), (FAILED, 'Misslyckat')]
+
+    class Meta:
+        verbose_name = 'Utgående meddelande'
+        verbose_name_plural = 'Utgående meddelanden'
+        indexes = [
+            models.Index(fields=['status', 'next_attempt'], name='outbox_due')
+        ]
+
+    kind = models.CharField(max_length=8, choices=KIND_CHOICES)
+    idempotency_key = models.CharField(max_length=128, unique=True)
+    sender = models.CharField(max_length=128, blank=True)
+    recipients = models.TextField(help_text='En mottagare per rad')
+    subject = models.CharField(max_length=256, blank=True)
+    body = models.TextField()
+
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=datetime.datetime.now)
+    lock = models.CharField(max_length=32, blank=True, editable=False)
+    last_error = models.TextField(blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.kind} {self.idempotency_key} ({self.status})"
+
+    @property
+    def recipient_list(self):
+        return [r for r in self.recipients.split('\n') if r]
+
+
+class ReminderSent(models.Model):
+    '''Records that a member was reminded about an activity, lead_days before it.
+
+    Lets the reminder command be rerun without notifying anyone twice.
+    '''
+
+    class Meta:
+        verbose_name = 'Skickad påminnelse'
+        verbose_name_plural = 'Skickade påminnelser'
+        constraints = [
+            models.UniqueConstraint(fields=['activity', 'member', 'lead_days'],
+                                    name='one_reminder_per_lead_time')
+        ]
+
+    activity = models.ForeignKey(Activity, on_delete=models.CASCADE, related_name='reminders')
+    member = models.ForeignKey(Member, on_delete=models.CASCADE, related_name='reminders')
+    lead_days = models.PositiveSmallIntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.activity_id} - {self.member_id} ({self.lead_days} d)"
+
+
+class InboundSMS(models.Model):
+    '''An SMS received from Twilio, stored as is by the webhook.
+
+    The webhook only records the message so that it can answer Twilio right
+    away, the 'process_inbox' command interprets replies later.
+    '''
+
+    CONFIRMED = 'confirmed'
+    DELIST_REQUESTED = 'delist_requested'
+    UNKNOWN_SENDER = 'unknown_sender'
+    NO_ACTIVITY = 'no_activity'
+    NOT_UNDERSTOOD = 'not_understood'
+    ERROR = 'error'
+    RESULT_CHOICES = [
+        (CONFIRMED, 'Bekräftad'),
+        (DELIST_REQUESTED, 'Avbokning begärd'),
+        (UNKNOWN_SENDER, 'Okänd avsändare'),
+        (NO_ACTIVITY, 'Ingen kommande uppgift'),
+        (NOT_UNDERSTOOD, 'Ej förstått'),
+        (ERROR, 'Fel'),
+    ]
+
+    class Meta:
+        verbose_name = 'Inkommande SMS'
+        verbose_name_plural = 'Inkommande SMS'
+        indexes = [
+            models.Index(fields=['processed'])
+        ]
+
+    message_sid = models.CharField(max_length=64, unique=True)
+    from_number = models.CharField(max_length=20)
+    to_number = models.CharField(max_length=20, blank=True)
+    body = models.TextField(blank=True)
+    payload = models.TextField(blank=True, help_text='Hela anropet från Twilio som JSON')
+    received = models.DateTimeField(auto_now_add=True)
+
+    processed = models.DateTimeField(null=True, blank=True)
+    member = models.ForeignKey(Member, on_delete=models.SET_NULL, null=True, blank=True,
+                               related_name='inbound_sms')
+    activity = models.ForeignKey(Activity, on_delete=models.SET_NULL, null=True, blank=True,
+                                 related_name='inbound_sms')
+    result = models.CharField(max_length=20, choices=RESULT_CHOICES, blank=True)
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"{self.from_number}: {self.body[:40]}"
+
+
+class Tombstone(models.Model):
+    '''Records a deleted event, activity or delist request for /api/changes'''
+
+    EVENT = 'events'
+    ACTIVITY = 'activities'
+    DELIST_REQUEST = 'delist_requests'
+    TABLE_CHOICES = [
+        (EVENT, 'Evenemang'),
+        (ACTIVITY, 'Uppgift'),
+        (DELIST_REQUEST, 'Avbokning'),
+    ]
+
+    class Meta:
+        verbose_name = 'Borttagen rad'
+        verbose_name_plural = 'Borttagna rader'
+        indexes = [
+            models.Index(fields=['deleted'])
+        ]
+
+    # older cursors can't be served by /api/changes, clients must reload
+    RETENTION = datetime.timedelta(days=90)
+
+    table = models.CharField(max_length=20, choices=TABLE_CHOICES)
+    object_id = models.IntegerField()
+    deleted = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.table} {self.object_id}"
+
+
+_tombstone_tables = {
+    Event: Tombstone.EVENT,
+    Activity: Tombstone.ACTIVITY,
+    ActivityDelistRequest: Tombstone.DELIST_REQUEST,
+}
+
+
+@receiver(post_delete, sender=Event)
+@receiver(post_delete, sender=Activity)
+@receiver(post_delete, sender=ActivityDelistRequest)
+def record_tombstone(sender, instance, **kwargs):
+    now = timezone.now()
+    Tombstone.objects.filter(deleted__lt=now - Tombstone.RETENTION).delete()
+    Tombstone.objects.create(table=_tombstone_tables[sender], object_id=instance.id)
@@ -1,10 +1,23 @@
+import datetime
+import hashlib
+import json
+
 from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import OuterRef, Subquery
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
 from rest_framework import serializers as drf_serializers
+from rest_framework.utils.encoders import JSONEncoder
 
-from app import models, serializers
+from app import caching, models, serializers
+from app.models import SubqueryCount
 
 app_config = apps.get_app_config('app')
 
+CACHE_TIMEOUT = 60 * 15
+
 
 class Notification():
     def __init__(self, message: str, link: str):
@@ -12,6 +25,32 @@ class Notification():
         self.link = link
 
 
+def notification_members():
+    '''members annotated with all NotificationData needs, in one query'''
+    season = models.MemberSeason.objects \
+        .filter(member=OuterRef('pk'), year=datetime.date.today().year)
+
+    pending_adrs = models.ActivityDelistRequest.objects \
+        .filter(approved=None) \
+        .values('id')
+
+    proxies = models.Member.proxy.through.objects \
+        .filter(to_member=OuterRef('pk')) \
+        .values('id')
+
+    return models.Member.objects \
+        .select_related('user') \
+        .prefetch_related('license_set', 'driver_set') \
+        .annotate(_completed_weight=Subquery(season.values('completed_weight')),
+                  _booked_weight=Subquery(season.values('booked_weight')),
+                  _bias=Subquery(season.values('bias')),
+                  _proxies_count=SubqueryCount(proxies),
+                  _my_delist_requests=SubqueryCount(
+                      pending_adrs.filter(member=OuterRef('pk'))),
+                  _unanswered_delist_requests=SubqueryCount(
+                      pending_adrs.exclude(member=OuterRef('pk'))))
+
+
 class NotificationData():
     def __init__(self, member: models.Member):
         self.isLoggedIn = member is not None
@@ -30,7 +69,10 @@ class NotificationData():
         self.fullname = member.fullname
 
         self.hasMemberCard = member.membercard_number != None and member.membercard_number != ''
-        self.hasProxies = member.proxies.all().exists()
+        if hasattr(member, '_proxies_count'):
+            self.hasProxies = member._proxies_count > 0
+        else:
+            self.hasProxies = member.proxies.all().exists()
 
         self.count_badges()
         self.compute_notifications()
@@ -39,18 +81,35 @@ class NotificationData():
         self.driver_set = member.driver_set
 
     def count_badges(self):
+        if getattr(self.member, '_booked_weight', None) is not None:
+            # already fetched by notification_members(), saves a ledger lookup
+            season = models.MemberSeason(
+                member=self.member, year=datetime.date.today().year,
+                completed_weight=self.member._completed_weight,
+                booked_weight=self.member._booked_weight,
+                bias=self.member._bias)
+        else:
+            season = self.member.season()
+
+        self.member.current_seasons = [season]
+
         self.completedWeight = self.member.completed_weight
         self.bookedWeight = self.member.booked_weight
 
-        self.myDelistRequests = models.ActivityDelistRequest.objects.filter(
-            member=self.member, approved=None).count()
+        if hasattr(self.member, '_my_delist_requests'):
+            self.myDelistRequests = self.member._my_delist_requests
+        else:
+            self.myDelistRequests = models.ActivityDelistRequest.objects.filter(
+                member=self.member, approved=None).count()
 
-        if self.isStaff:
+        if not self.isStaff:
+            self.unansweredDelistRequests = None
+        elif hasattr(self.member, '_unanswered_delist_requests'):
+            self.unansweredDelistRequests = self.member._unanswered_delist_requests
+        else:
             self.unansweredDelistRequests = models.ActivityDelistRequest.objects \
                 .filter(approved=None) \
                 .exclude(member=self.member).count()
-        else:
-            self.unansweredDelistRequests = None
 
     def compute_notifications(self):
         self.notifications = []
@@ -104,3 +163,68 @@ class NotificationDataSerializer(drf_serializers.Serializer):
 
     myDelistRequests = drf_serializers.IntegerField(required=False)
     unansweredDelistRequests = drf_serializers.IntegerField(required=False)
+
+
+##############################################################################
+# per-user cache of the serialized payload, see api_user.IsLoggedIn
+
+def cached_payload(user):
+    '''returns (etag, payload) for a logged in user, computing it on cache miss'''
+    key = f'notifications:{user.id}'
+    # staff also see the global count of unanswered delist requests
+    version = caching.version('notifications:adr') if user.is_staff else 0
+
+    cached = cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1:]
+
+    member = notification_members().get(user=user)
+    payload = NotificationDataSerializer(NotificationData(member)).data
+    body = json.dumps(payload, cls=JSONEncoder, sort_keys=True).encode()
+    etag = hashlib.md5(body).hexdigest()
+
+    cache.set(key, (version, etag, payload), CACHE_TIMEOUT)
+    return etag, payload
+
+
+def invalidate_users(user_ids):
+    cache.delete_many([f'notifications:{i}' for i in user_ids])
+
+
+def invalidate_members(member_ids):
+    member_ids = [i for i in member_ids if i is not None]
+    if member_ids:
+        invalidate_users(models.Member.objects
+                         .filter(id__in=member_ids)
+                         .values_list('user_id', flat=True))
+
+
+@receiver(post_save, sender=User)
+def _user_changed(sender, instance, **kwargs):
+    invalidate_users([instance.id])
+
+
+@receiver(post_save, sender=models.Member)
+def _member_changed(sender, instance, **kwargs):
+    invalidate_users([instance.user_id])
+
+
+@receiver(post_save, sender=models.MemberSeason)
+@receiver(post_save, sender=models.License)
+@receiver(post_delete, sender=models.License)
+@receiver(post_save, sender=models.Driver)
+@receiver(post_delete, sender=models.Driver)
+def _member_data_changed(sender, instance, **kwargs):
+    invalidate_members([instance.member_id])
+
+
+@receiver(post_save, sender=models.ActivityDelistRequest)
+@receiver(post_delete, sender=models.ActivityDelistRequest)
+def _adr_changed(sender, instance, **kwargs):
+    invalidate_members([instance.member_id])
+    caching.bump('notifications:adr')
+
+
+@receiver(m2m_changed, sender=models.Member.proxy.through)
+def _proxies_changed(sender, instance, pk_set, **kwargs):
+    invalidate_members([instance.id] + list(pk_set or []))
@@ -0,0 +1,184 @@
+"""
+Transactional outbox for outgoing email and SMS.
+
+app.events enqueues notifications here instead of talking to SMTP or Twilio
+inside requests and signal handlers. Rows are inserted in the caller's
+transaction, so a notification exists exactly when the change behind it was
+committed. The 'run_outbox' command drains due messages in batches, retrying
+failures with exponential backoff until MAX_ATTEMPTS.
+"""
+
+import datetime
+import logging
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.db import IntegrityError, transaction
+
+from app import models, sms
+from app.mail import Mailer
+
+log = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = datetime.timedelta(seconds=30)
+BACKOFF_MAX = datetime.timedelta(hours=6)
+
+# how long a worker may hold a claimed batch before others may retry it
+LEASE = datetime.timedelta(minutes=5)
+
+# concurrent SMS requests, SMS sends are independent HTTP calls
+SMS_WORKERS = 8
+
+
+def _enqueue(kind, key, recipients, body, subject='', sender=''):
+    try:
+        with transaction.atomic():
+            message = models.OutboxMessage.objects.create(
+                kind=kind, idempotency_key=key, sender=sender or '',
+                recipients='\n'.join(recipients), subject=subject, body=body)
+    except IntegrityError:
+        log.info(f"Outbox message {key} already queued")
+        return None
+
+    log.info(f"Queued {kind} {key} to {', '.join(recipients)}")
+    return message
+
+
+def enqueue_email(key, subject, body, recipients, sender=None):
+    '''queues an email, returns None if key has been queued before'''
+    recipients = [r for r in recipients if r]
+    if not recipients:
+        log.info(f"No recipients for email {key}")
+        return None
+
+    return _enqueue(models.OutboxMessage.EMAIL, key, recipients, body,
+                    subject=subject, sender=sender or settings.DEFAULT_FROM_EMAIL)
+
+
+def enqueue_sms(key, to, body):
+    '''queues an SMS, returns None if key has been queued before'''
+    return _enqueue(models.OutboxMessage.SMS, key, [to], body,
+                    sender=settings.SMS_FROM_NUMBER)
+
+
+def backoff(attempts):
+    '''delay before retrying a message that has failed attempts times'''
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+
+
+def claim(batch_size, now=None, ids=None):
+    '''leases up to batch_size due messages to this worker and returns them,
+       optionally only among the given message ids'''
+    now = now or datetime.datetime.now()
+    token = uuid.uuid4().hex
+
+    due = models.OutboxMessage.objects \
+        .filter(status=models.OutboxMessage.PENDING, next_attempt__lte=now)
+    if ids is not None:
+        due = due.filter(id__in=ids)
+
+    due = due \
+        .order_by('next_attempt', 'id') \
+        .values_list('id', flat=True)[:batch_size]
+
+    # conditional update, so concurrent workers never claim the same row
+    models.OutboxMessage.objects \
+        .filter(id__in=list(due), status=models.OutboxMessage.PENDING,
+                next_attempt__lte=now) \
+        .update(lock=token, next_attempt=now + LEASE)
+
+    return list(models.OutboxMessage.objects
+                .filter(lock=token, status=models.OutboxMessage.PENDING)
+                .order_by('id'))
+
+
+def _email(message):
+    return EmailMessage(message.subject, message.body,
+                        message.sender or settings.DEFAULT_FROM_EMAIL,
+                        message.recipient_list)
+
+
+def _send(message):
+    if message.kind == models.OutboxMessage.SMS:
+        sms.send(message.recipient_list[0], message.body, message.sender)
+    else:
+        raise ValueError(f"Unknown message kind '{message.kind}'")
+
+
+def _attempt(message):
+    try:
+        _send(message)
+    except Exception as e:
+        return e
+
+    return None
+
+
+def _record(message, error):
+    now = datetime.datetime.now()
+
+    if error is None:
+        models.OutboxMessage.objects \
+            .filter(id=message.id) \
+            .update(status=models.OutboxMessage.SENT, sent=now, lock='',
+                    attempts=message.attempts + 1, last_error='')
+        return
+
+    message.attempts += 1
+    message.last_error = f"{type(error).__name__}: {error}"
+    message.lock = ''
+
+    if message.attempts >= MAX_ATTEMPTS:
+        message.status = models.OutboxMessage.FAILED
+        log.error(f"Giving up on {message}: {message.last_error}")
+    else:
+        message.next_attempt = now + backoff(message.attempts)
+        log.warning(f"Failed to send {message}, retrying at "
+                    f"{message.next_attempt}: {message.last_error}")
+
+    message.save(update_fields=['attempts', 'last_error', 'lock',
+                                'status', 'next_attempt'])
+
+
+def deliver(messages, sms_workers=SMS_WORKERS, mailer=None):
+    '''sends claimed messages, returns (sent, failed)
+
+    Emails go over the mailer's connection, pass one Mailer to keep it open
+    across batches. SMS are sent by a bounded thread pool while the emails
+    go out. Results are stored from this thread only.
+    '''
+    emails = [m for m in messages if m.kind == models.OutboxMessage.EMAIL]
+    others = [m for m in messages if m.kind != models.OutboxMessage.EMAIL]
+    results = []
+
+    with ThreadPoolExecutor(max_workers=max(1, sms_workers)) as pool:
+        futures = [(m, pool.submit(_attempt, m)) for m in others]
+
+        if emails:
+            batch_mailer = mailer or Mailer()
+            try:
+                results += zip(emails, batch_mailer.deliver_many([_email(m) for m in emails]))
+            finally:
+                if mailer is None:
+                    batch_mailer.close()
+
+        results += [(m, f.result()) for m, f in futures]
+
+    for message, error in results:
+        _record(message, error)
+
+    failed = sum(1 for _, error in results if error is not None)
+    return len(results) - failed, failed
+
+
+def process(batch_size=50, mailer=None):
+    '''delivers one batch of due messages, returns (sent, failed)'''
+    messages = claim(batch_size)
+    if not messages:
+        return 0, 0
+
+    return deliver(messages, mailer=mailer)
@@ -0,0 +1,155 @@
+"""
+Cache of small, nearly static reference tables (event/activity/license types,
+car classes, FAQ and info texts).
+
+Each table is serialized once per version and kept both in the shared cache
+and in process memory. The current version of a table is a token in the
+shared cache that the signal handlers below replace on every change, so all
+worker processes notice an update when they next check the token, at most
+CHECK_INTERVAL seconds later. The process that made the change sees it at
+once. Used by the list endpoints in api_core and by RefDataField for nested
+representations.
+"""
+
+import hashlib
+import json
+import threading
+import time
+
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from rest_framework.utils.encoders import JSONEncoder
+
+from app import caching, models, serializers
+
+# seconds a process trusts its copy before checking the shared version token
+CHECK_INTERVAL = 1.0
+
+
+def _tables():
+    return {
+        'event_types': (models.EventType.objects.prefetch_related('attachments__uploader'),
+                        serializers.EventTypeSerializer),
+        'activity_types': (models.ActivityType.objects.prefetch_related('attachments__uploader'),
+                           serializers.ActivityTypeSerializer),
+        'license_types': (models.LicenseType.objects.all(), serializers.LicenseTypeSerializer),
+        'car_classes': (models.CarClass.objects.all(), serializers.CarClassSerializer),
+        'faq': (models.FAQ.objects.all(), serializers.FAQSerializer),
+        'info_texts': (models.InfoText.objects.all(), serializers.InfoTextSerializer),
+    }
+
+
+TABLES = ['event_types', 'activity_types', 'license_types', 'car_classes', 'faq', 'info_texts']
+
+
+class Entry:
+    '''one serialized version of a table'''
+
+    def __init__(self, version, etag, data):
+        self.version = version
+        self.etag = etag
+        self.data = data
+        self.by_pk = {row.get('id', row.get('key')): row for row in data}
+        self.checked = time.monotonic()
+
+
+_local = {}
+_lock = threading.Lock()
+
+
+def _build(name):
+    queryset, serializer_class = _tables()[name]
+    body = json.dumps(serializer_class(queryset, many=True).data, cls=JSONEncoder)
+    return hashlib.md5(body.encode()).hexdigest(), json.loads(body)
+
+
+def get(name) -> Entry:
+    '''returns the current Entry for a reference table'''
+    entry = _local.get(name)
+    if entry is not None and time.monotonic() - entry.checked < CHECK_INTERVAL:
+        return entry
+
+    version = caching.version(f'refdata:{name}')
+    if entry is not None and entry.version == version:
+        entry.checked = time.monotonic()
+        return entry
+
+    with _lock:
+        data_key = f'refdata:{name}:{version}'
+        cached = cache.get(data_key)
+        if cached is None:
+            cached = _build(name)
+            cache.set(data_key, cached, None)
+
+        entry = Entry(version, *cached)
+        _local[name] = entry
+
+    return entry
+
+
+def lookup(name, pk):
+    '''returns the serialized row with primary key pk, or None'''
+    row = get(name).by_pk.get(pk)
+    if row is None:
+        # the row may be newer than our copy, check the shared version now
+        _local.pop(name, None)
+        row = get(name).by_pk.get(pk)
+    return row
+
+
+def invalidate(*names):
+    for name in names:
+        caching.bump(f'refdata:{name}')
+        _local.pop(name, None)
+
+
+def invalidate_all():
+    invalidate(*TABLES)
+
+
+##############################################################################
+# signal handlers, registered from ActivityListAppConfig.ready()
+
+@receiver(post_save, sender=models.EventType)
+@receiver(post_delete, sender=models.EventType)
+@receiver(m2m_changed, sender=models.EventType.attachments.through)
+def _event_types_changed(sender, **kwargs):
+    invalidate('event_types')
+
+
+@receiver(post_save, sender=models.ActivityType)
+@receiver(post_delete, sender=models.ActivityType)
+@receiver(m2m_changed, sender=models.ActivityType.attachments.through)
+def _activity_types_changed(sender, **kwargs):
+    invalidate('activity_types')
+
+
+@receiver(post_save, sender=models.Attachment)
+@receiver(post_delete, sender=models.Attachment)
+def _attachment_changed(sender, **kwargs):
+    invalidate('event_types', 'activity_types')
+
+
+@receiver(post_save, sender=models.LicenseType)
+@receiver(post_delete, sender=models.LicenseType)
+def _license_types_changed(sender, **kwargs):
+    invalidate('license_types')
+
+
+@receiver(post_save, sender=models.CarClass)
+@receiver(post_delete, sender=models.CarClass)
+def _car_classes_changed(sender, **kwargs):
+    invalidate('car_classes')
+
+
+@receiver(post_save, sender=models.FAQ)
+@receiver(post_delete, sender=models.FAQ)
+def _faq_changed(sender, **kwargs):
+    invalidate('faq')
+
+
+@receiver(post_save, sender=models.InfoText)
+@receiver(post_delete, sender=models.InfoText)
+def _info_texts_changed(sender, **kwargs):
+    invalidate('info_texts')
@@ -0,0 +1,91 @@
+"""
+Reminders to members about activities they are booked on.
+
+One run handles several lead times (e.g. 7 and 1 days before), finds the due
+activities with a single indexed date query and records each reminder in
+ReminderSent, so running the command again the same day sends nothing new.
+Reminders are queued in the outbox and delivered right away, emails over one
+Mailer connection for the whole run and SMS through the outbox thread pool.
+"""
+
+import datetime
+import logging
+import time
+
+from django.db import transaction
+
+from app import events, outbox
+from app.mail import Mailer
+from app.models import Activity, ReminderSent
+
+log = logging.getLogger(__name__)
+
+
+class ReminderRun:
+    '''counts and timing of a reminder run'''
+
+    def __init__(self):
+        self.reminders = 0
+        self.messages = 0
+        self.sent = 0
+        self.failed = 0
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        return self.messages / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return f"{self.reminders} reminder(s), {self.sent}/{self.messages} message(s) sent, " \
+               f"{self.failed} failed in {self.elapsed:.2f}s ({self.rate:.0f} messages/s)"
+
+
+def due_reminders(lead_days, today=None):
+    '''returns [(activity, lead_days)] for booked activities not yet reminded about'''
+    today = today or datetime.date.today()
+    dates = {today + datetime.timedelta(days=d): d for d in lead_days}
+
+    activities = list(Activity.objects
+                      .filter(event__start_date__in=list(dates), assigned__isnull=False)
+                      .select_related('event', 'assigned__user'))
+
+    sent = set(ReminderSent.objects
+               .filter(activity__in=[a.id for a in activities], lead_days__in=list(dates.values()))
+               .values_list('activity_id', 'member_id', 'lead_days'))
+
+    due = [(a, dates[a.event.start_date]) for a in activities]
+    return [(a, d) for a, d in due if (a.id, a.assigned_id, d) not in sent]
+
+
+def send_reminders(lead_days, today=None, batch_size=200, sms_workers=outbox.SMS_WORKERS):
+    '''queues and delivers reminders for all lead times, returns a ReminderRun'''
+    run = ReminderRun()
+    start = time.perf_counter()
+
+    due = due_reminders(lead_days, today)
+
+    with transaction.atomic():
+        ids = []
+        for activity, days in due:
+            ids += [m.id for m in events.notify_upcoming_activity(activity, days)]
+
+        ReminderSent.objects.bulk_create(
+            [ReminderSent(activity=a, member_id=a.assigned_id, lead_days=d) for a, d in due],
+            ignore_conflicts=True)
+
+    run.reminders = len(due)
+    run.messages = len(ids)
+
+    with Mailer() as mailer:
+        while True:
+            messages = outbox.claim(batch_size, ids=ids)
+            if not messages:
+                break
+
+            sent, failed = outbox.deliver(messages, sms_workers, mailer)
+            run.sent += sent
+            run.failed += failed
+
+    run.elapsed = time.perf_counter() - start
+    log.info(f"Reminders for {lead_days} day(s): {run}")
+    return run
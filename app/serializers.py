@@ -1,9 +1,35 @@
 from datetime import datetime, date
 from django.contrib.auth.models import User
+from django.db.models import Prefetch, prefetch_related_objects
 from rest_framework import serializers
-from app import models
+from app import models, refdata
 from app.models import Attachment, Member, Event, EventType, Activity, \
-    ActivityType, ActivityDelistRequest
+    ActivityType, ActivityDelistRequest, Enlistment, ReminderSent, InboundSMS
+
+# bookkeeping tables that should never show up as nested API fields
+INTERNAL_MODELS = (Enlistment, ReminderSent, InboundSMS)
+
+
+def model_fields(model, exclude=()):
+    '''field and relation names of model, without excluded and internal relations'''
+    return [f.name for f in model._meta.get_fields()
+            if f.name not in exclude and f.related_model not in INTERNAL_MODELS]
+
+
+class RefDataField(serializers.Field):
+    '''read-only nested representation of a reference table row, served from app.refdata'''
+
+    def __init__(self, table, fields=None, **kwargs):
+        self.table = table
+        self.fields = fields
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, pk):
+        row = refdata.lookup(self.table, pk)
+        if row is not None and self.fields is not None:
+            row = {f: row[f] for f in self.fields}
+        return row
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -106,7 +132,7 @@ class EventTypeBriefSerializer(serializers.ModelSerializer):
 
 
 class EventPublicSerializer(serializers.ModelSerializer):
-    type = EventTypeBriefSerializer()
+    type = RefDataField('event_types', fields=['id', 'name'], source='type_id')
 
     class Meta:
         model = Event
@@ -114,25 +140,25 @@ class EventPublicSerializer(serializers.ModelSerializer):
 
 
 class EventSerializer(serializers.ModelSerializer):
-    type = EventTypeSerializer()
+    type = RefDataField('event_types', source='type_id')
     coordinators = MemberSerializer(many=True)
     current_user_assigned = serializers.BooleanField(required=False)
 
     class Meta:
         model = Event
-        fields = [x.name for x in Event._meta.get_fields()] + \
+        fields = model_fields(Event) + \
             ['has_bookable_activities', 'activities_count',
              'activities_available_count', 'current_user_assigned']
 
 
 class EventListSerializer(serializers.ModelSerializer):
-    type = EventTypeBriefSerializer()
+    type = RefDataField('event_types', fields=['id', 'name'], source='type_id')
     current_user_assigned = serializers.BooleanField(required=False)
     has_bookable_activities = serializers.BooleanField(required=False)
 
     class Meta:
         model = Event
-        fields = [x.name for x in Event._meta.get_fields() if x.name not in ['coordinators']] + \
+        fields = model_fields(Event, exclude=['coordinators']) + \
             ['has_bookable_activities', 'current_user_assigned']
 
 
@@ -152,7 +178,7 @@ class ActivityDelistRequestSerializer(serializers.ModelSerializer):
 
 class EventActivitySerializer(serializers.ModelSerializer):
     '''serializer used when fetching tasks for an event'''
-    type = ActivityTypeSerializer(required=False)
+    type = RefDataField('activity_types', source='type_id')
     assigned = MemberSerializer(required=False)
     start_time = serializers.TimeField(format="%H:%M")
     end_time = serializers.TimeField(format="%H:%M")
@@ -161,7 +187,7 @@ class EventActivitySerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Activity
-        fields = [x.name for x in Activity._meta.get_fields()] + \
+        fields = model_fields(Activity) + \
             ['bookable',  'active_delist_request']
 
 
@@ -170,6 +196,59 @@ class ActivitySerializer(EventActivitySerializer):
     event = EventListSerializer(required=False)
 
 
+class ActivityNormalizedSerializer(serializers.ModelSerializer):
+    '''activity with related objects as ids, see normalized_activities()'''
+    start_time = serializers.TimeField(format="%H:%M")
+    end_time = serializers.TimeField(format="%H:%M")
+    bookable = serializers.BooleanField()
+    active_delist_request = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Activity
+        fields = model_fields(Activity) + ['bookable', 'active_delist_request']
+
+    def get_active_delist_request(self, activity):
+        adr = self.context['active_delist_requests'].get(activity.id)
+        return adr.id if adr else None
+
+
+def normalized_activities(activities, context):
+    '''
+    returns (rows, included) for activities, rows reference types, events,
+    assigned members and active delist requests by id, included has each
+    of them serialized once. A fixed number of queries for any number of rows.
+    '''
+    prefetch_related_objects(activities, 'attachments', 'delist_requests')
+    delist_requests = {adr.activity_id: adr for a in activities
+                       for adr in a.delist_requests.all() if adr.approved is None}
+
+    rows = ActivityNormalizedSerializer(activities, many=True, context=dict(
+        context, active_delist_requests=delist_requests)).data
+
+    type_ids = sorted({a.type_id for a in activities if a.type_id is not None})
+    event_ids = {a.event_id for a in activities}
+    member_ids = {a.assigned_id for a in activities if a.assigned_id is not None}
+
+    included = {
+        'activity_types': [refdata.lookup('activity_types', i) for i in type_ids],
+        'events': EventListSerializer(
+            Event.objects
+            .filter(id__in=event_ids)
+            .prefetch_related('attachments', Prefetch(
+                'activities', queryset=Activity.objects.only('id', 'event'))),
+            many=True, context=context).data,
+        'members': MemberSerializer(
+            Member.objects
+            .filter(id__in=member_ids)
+            .select_related('user')
+            .prefetch_related('license_set', 'driver_set'),
+            many=True, context=context).data,
+        'delist_requests': ActivityDelistRequestSerializer(
+            delist_requests.values(), many=True, context=context).data,
+    }
+    return rows, included
+
+
 class ActivityTypeBriefSerializer(EventActivitySerializer):
     class Meta:
         model = Activity
@@ -179,8 +258,8 @@ class ActivityTypeBriefSerializer(EventActivitySerializer):
 class EventListADRSerializer(serializers.ModelSerializer):
     class Meta:
         model = Event
-        fields = [x.name for x in Event._meta.get_fields() if x.name not in [
-            'type', 'attachments', 'coordinators', 'activities']]
+        fields = model_fields(Event, exclude=[
+            'type', 'attachments', 'coordinators', 'activities'])
 
 
 class ActivityADRSerializer(EventActivitySerializer):
@@ -190,7 +269,7 @@ class ActivityADRSerializer(EventActivitySerializer):
 
     class Meta:
         model = Activity
-        fields = [x.name for x in Activity._meta.get_fields() if x.name != 'attachments']
+        fields = model_fields(Activity, exclude=['attachments'])
 
 
 class ActivityDelistRequestDeepSerializer(ActivityDelistRequestSerializer):
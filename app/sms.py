@@ -0,0 +1,168 @@
+"""
+SMS dispatch through a pluggable backend.
+
+settings.SMS_BACKEND names the backend class, TwilioBackend by default. It
+shares one Twilio client per process whose HTTP session keeps connections
+alive, limits the send rate to settings.SMS_RATE_LIMIT messages per second
+and gives up on requests after settings.SMS_TIMEOUT seconds. Sends go
+through the 'sms' circuit breaker. FakeBackend records messages in memory
+for tests and benchmarks.
+"""
+
+import abc
+import contextlib
+import logging
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client as TwilioClient
+
+from app.breaker import breaker
+
+log = logging.getLogger(__name__)
+
+
+class SMSDisabled(Exception):
+    pass
+
+
+class RateLimiter:
+    '''blocks callers so that at most rate calls per second get through, thread safe'''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class SMSBackend(abc.ABC):
+    '''base class for SMS backends'''
+
+    rate = None
+
+    def __init__(self):
+        self.limiter = RateLimiter(self.rate)
+
+    @property
+    def enabled(self):
+        return True
+
+    @abc.abstractmethod
+    def send(self, to, body, sender):
+        '''sends one message, returns the provider's message id'''
+
+
+class TwilioBackend(SMSBackend):
+    def __init__(self):
+        self.rate = settings.SMS_RATE_LIMIT
+        super().__init__()
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(settings.TWILIO_ACCOUNT_SID)
+
+    @property
+    def client(self):
+        '''the shared Twilio REST client, None if Twilio is not configured'''
+        if self._client is None and self.enabled:
+            with self._lock:
+                if self._client is None:
+                    http_client = TwilioHttpClient(pool_connections=True,
+                                                   timeout=settings.SMS_TIMEOUT)
+                    self._client = TwilioClient(settings.TWILIO_ACCOUNT_SID,
+                                                settings.TWILIO_AUTH_TOKEN,
+                                                http_client=http_client)
+        return self._client
+
+    def send(self, to, body, sender):
+        return self.client.messages.create(body=body, from_=sender, to=to).sid
+
+
+class FakeBackend(SMSBackend):
+    '''keeps sent messages in memory, optionally taking latency seconds per message'''
+
+    def __init__(self, latency=0.0, rate=None):
+        self.rate = rate
+        super().__init__()
+        self.latency = latency
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, to, body, sender):
+        if self.latency:
+            time.sleep(self.latency)
+
+        sid = uuid.uuid4().hex
+        with self._lock:
+            self.sent.append({'sid': sid, 'to': to, 'body': body, 'from': sender})
+        return sid
+
+
+_backends = {}
+_override = None
+
+
+def get_backend():
+    '''returns the process wide instance of the configured backend'''
+    if _override is not None:
+        return _override
+
+    path = settings.SMS_BACKEND
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
+
+
+@contextlib.contextmanager
+def use_backend(backend):
+    '''temporarily routes all SMS through backend, e.g. a FakeBackend'''
+    global _override
+    previous, _override = _override, backend
+    try:
+        yield backend
+    finally:
+        _override = previous
+
+
+def enabled():
+    return get_backend().enabled
+
+
+def twilio_client():
+    '''the shared Twilio client for other Twilio APIs such as Verify'''
+    path = 'app.sms.TwilioBackend'
+    if path not in _backends:
+        _backends[path] = TwilioBackend()
+    return _backends[path].client
+
+
+def send(to, body, sender=None):
+    '''sends an SMS, waiting for the backend's rate limit, returns the message id'''
+    backend = get_backend()
+    if not backend.enabled:
+        raise SMSDisabled("SMS is disabled")
+
+    backend.limiter.acquire()
+    sid = breaker('sms').call(
+        backend.send, to, body, sender or settings.SMS_FROM_NUMBER)
+    log.info(f"Sent SMS {sid} to {to}")
+    return sid
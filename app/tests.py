@@ -3,8 +3,12 @@ This file demonstrates writing tests using the unittest module. These will pass
 when you run "manage.py test".
 """
 
+import datetime
+import io
+import json
+
 import django
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 
 # TODO: Configure your database in settings.py and sync before running tests.
 
@@ -30,3 +34,1251 @@ class AppViewTest(TestCase):
         #print(response.content)
         self.assertContains(response, 'Django webbplatsadministration', 1, 200)
 
+
+
+class MemberSeasonTest(TestCase):
+    """Tests for the materialized member season ledger."""
+
+    def setUp(self):
+        from app.models import Activity, Event, Member
+        from django.contrib.auth.models import User
+
+        today = datetime.date.today()
+        self.member = User.objects.create(username='a@b.se', email='a@b.se').member
+        self.event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        self.activities = [
+            Activity.objects.create(name=f'Task {i}', event=self.event, weight=i)
+            for i in range(1, 4)]
+
+    def test_follows_bookings(self):
+        from app.models import ActivityDelistRequest, MemberSeason
+        from django.core.management import call_command
+
+        a1, a2, a3 = self.activities
+        for a in self.activities:
+            a.assigned = self.member
+            a.save()
+
+        a1.completed = True
+        a1.save()
+        ActivityDelistRequest.objects.create(member=self.member, activity=a3)
+
+        season = MemberSeason.objects.get(member=self.member)
+        self.assertEqual((season.completed_weight, season.booked_weight, season.pending_adr_weight),
+                         (1, 3, 3))
+
+        a2.assigned = None
+        a2.save()
+        self.assertEqual(self.member.booked_weight, 1)
+
+        MemberSeason.objects.update(booked_weight=100)
+        call_command('rebuild_ledger', stdout=io.StringIO())
+        self.assertEqual(self.member.booked_weight, 1)
+        self.assertEqual(self.member.task_summary, '1/1')
+
+    def test_read_does_not_write(self):
+        from app.models import MemberSeason
+
+        for a in self.activities:
+            a.assigned = self.member
+            a.save()
+        MemberSeason.objects.all().delete()
+
+        self.assertEqual(self.member.booked_weight, 6)
+        self.assertFalse(MemberSeason.objects.exists())
+
+    def test_rebuild_invalidates_notifications(self):
+        from app.models import Activity
+        from django.core.cache import cache
+        from django.core.management import call_command
+
+        cache.clear()
+        self.client.force_login(self.member.user)
+        self.assertEqual(self.client.get('/api/isloggedin').json()['bookedWeight'], 0)
+
+        # bypasses the signals, like a bulk change would
+        Activity.objects.update(assigned=self.member)
+        call_command('rebuild_ledger', stdout=io.StringIO())
+        self.assertEqual(self.client.get('/api/isloggedin').json()['bookedWeight'], 6)
+
+
+class IsLoggedInTest(TestCase):
+    """Tests for the cached /api/isloggedin payload."""
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from django.core.cache import cache
+
+        cache.clear()
+        self.user = User.objects.create(username='a@b.se', email='a@b.se', first_name='A')
+        self.client.force_login(self.user)
+
+    def test_cached_with_etag(self):
+        response = self.client.get('/api/isloggedin')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['isLoggedIn'])
+        etag = response['ETag']
+
+        response = self.client.get('/api/isloggedin', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        member = self.user.member
+        member.email_verified = True
+        member.save()
+
+        response = self.client.get('/api/isloggedin', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class EventCountersTest(TestCase):
+    """Tests for the denormalized activity counters on Event."""
+
+    def test_counters(self):
+        from app.models import Activity, Event
+        from django.contrib.auth.models import User
+
+        today = datetime.date.today()
+        member = User.objects.create(username='a@b.se', email='a@b.se').member
+        event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        later = Activity.objects.create(name='Later', event=event,
+                                        earliest_bookable_date=today + datetime.timedelta(days=1))
+        now = Activity.objects.create(name='Now', event=event)
+
+        event.refresh_from_db()
+        self.assertEqual((event.activities_total, event.activities_assigned, event.activities_available),
+                         (2, 0, 1))
+
+        now.assigned = member
+        now.save()
+        event.save()  # a stale instance must not overwrite the counters
+        event.refresh_from_db()
+        self.assertEqual((event.activities_total, event.activities_assigned, event.activities_available),
+                         (2, 1, 0))
+        self.assertFalse(event.has_bookable_activities)
+
+        later.delete()
+        event.refresh_from_db()
+        self.assertEqual(event.activities_count, 1)
+
+
+class EnlistTest(TestCase):
+    """Tests for the enlistment service."""
+
+    def setUp(self):
+        from app.models import Activity, Event
+        from django.contrib.auth.models import User
+
+        today = datetime.date.today()
+        self.alice = User.objects.create(username='alice@b.se', email='alice@b.se').member
+        self.bob = User.objects.create(username='bob@b.se', email='bob@b.se').member
+        self.event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        self.a1 = Activity.objects.create(name='Task 1', event=self.event)
+        self.a2 = Activity.objects.create(name='Task 2', event=self.event)
+
+    def test_enlist(self):
+        from app.booking import enlist, EnlistResult
+        from app.models import ActivityDelistRequest
+
+        self.assertTrue(enlist(self.a1.id, self.alice).enlisted)
+        self.assertEqual(enlist(self.a1.id, self.alice).status, EnlistResult.ALREADY_ENLISTED)
+        self.assertEqual(enlist(self.a1.id, self.bob).status, EnlistResult.TAKEN)
+        self.assertEqual(enlist(self.a2.id, self.alice).status, EnlistResult.EVENT_LIMIT)
+
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.activities_assigned, 1)
+        self.assertEqual(self.alice.booked_weight, 1)
+
+        ActivityDelistRequest.objects.create(member=self.alice, activity=self.a1)
+        self.assertTrue(enlist(self.a1.id, self.bob).enlisted)
+        self.assertFalse(ActivityDelistRequest.objects.exists())
+        self.assertEqual(self.alice.booked_weight, 0)
+        self.assertTrue(enlist(self.a2.id, self.alice).enlisted)
+
+    def test_taken_names_holder(self):
+        from app.booking import enlist
+
+        enlist(self.a1.id, self.alice)
+        self.alice.user.first_name, self.alice.user.last_name = 'Alice', 'Ek'
+        self.alice.user.save()
+        self.bob.email_verified = self.bob.phone_verified = True
+        self.bob.save()
+
+        self.client.force_login(self.bob.user)
+        response = self.client.post(f'/api/activity_enlist/{self.a1.id}')
+        self.assertEqual(response.status_code, 403)
+        self.assertIn('Alice Ek', response.content.decode())
+
+    def test_assignments_outside_enlist(self):
+        from app.models import Enlistment
+
+        self.a1.assigned = self.alice
+        self.a1.save()
+        self.assertEqual(list(Enlistment.objects.values_list('member', 'activity')),
+                         [(self.alice.id, self.a1.id)])
+
+        # a deliberate double booking by staff is kept, without a second row
+        self.a2.assigned = self.alice
+        self.a2.save()
+        self.assertEqual(Enlistment.objects.count(), 1)
+
+        self.a1.assigned = self.bob
+        self.a1.save()
+        self.assertEqual(set(Enlistment.objects.values_list('member', 'activity')),
+                         {(self.bob.id, self.a1.id)})
+
+        self.a1.assigned = None
+        self.a1.save()
+        self.assertFalse(Enlistment.objects.filter(activity=self.a1).exists())
+
+
+class DoubleBookedTest(TestCase):
+    """Tests for the double booking report."""
+
+    def test_report(self):
+        from app.models import Activity, Event
+        from django.contrib.auth.models import User
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+
+        today = datetime.date.today()
+        staff = User.objects.create(username='s@b.se', email='s@b.se', is_staff=True)
+        user = User.objects.create(username='a@b.se', email='a@b.se',
+                                   first_name='Anna', last_name='Andersson')
+        event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        for name, comment in [('1', 'Lördag'), ('2', 'Lördag'), ('3', 'Söndag'), ('4', '')]:
+            Activity.objects.create(name=name, event=event, comment=comment,
+                                    assigned=user.member)
+
+        self.client.force_login(staff)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/api/members/double_booked/?year={today.year}')
+        self.assertEqual(response.status_code, 200)
+
+        results = response.json()['results']
+        self.assertEqual([r['activity_name'] for r in results], ['1', '2'])
+        self.assertEqual(results[0]['assigned_fullname'], 'Anna Andersson')
+        self.assertEqual(results[0]['event_name'], 'Race')
+        self.assertEqual(len([q for q in queries if 'app_activity' in q['sql']]), 2)  # count + page
+
+        response = self.client.get('/api/members/double_booked/?year=abc')
+        self.assertEqual(response.status_code, 400)
+
+
+class CompletionsTest(TestCase):
+    """Tests for the completions list."""
+
+    def test_keyset_and_stream(self):
+        from app.models import Activity, Event
+        from django.contrib.auth.models import User
+
+        today = datetime.date.today()
+        staff = User.objects.create(username='s@b.se', email='s@b.se', is_staff=True)
+        member = User.objects.create(username='a@b.se', email='a@b.se', first_name='A').member
+        for d in range(3):
+            day = today - datetime.timedelta(days=d)
+            if day.year != today.year:
+                continue
+            event = Event.objects.create(name=f'Day {d}', start_date=day, end_date=day)
+            for t in [None, datetime.time(8), datetime.time(12)]:
+                Activity.objects.create(name=f'{d} {t}', event=event, start_time=t, assigned=member)
+        expected = Activity.objects.count()
+
+        self.client.force_login(staff)
+        names, url = [], '/api/members/completions/?cursor=&page_size=2'
+        while url:
+            page = self.client.get(url).json()
+            names += [r['activity_name'] for r in page['results']]
+            url = page['next']
+
+        self.assertEqual(len(names), expected)
+        self.assertEqual(names[:3], ['0 None', '0 08:00:00', '0 12:00:00'])
+
+        response = self.client.get('/api/members/completions/?stream=1')
+        streamed = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([r['activity_name'] for r in streamed], names)
+
+        response = self.client.get('/api/members/completions/?page=1&page_size=2')
+        self.assertEqual(response.json()['count'], expected)
+
+        # page numbers stay the default, the frontend reads count
+        response = self.client.get('/api/members/completions/?filter=A')
+        self.assertEqual(response.json()['count'], expected)
+
+
+class BulkCompletionTest(TestCase):
+    """Tests for marking many activities as completed at once."""
+
+    def test_bulk(self):
+        from app.models import Activity, Event
+        from django.contrib.auth.models import User
+
+        today = datetime.date.today()
+        staff = User.objects.create(username='s@b.se', email='s@b.se', is_staff=True)
+        member = User.objects.create(username='a@b.se', email='a@b.se').member
+        event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        a1 = Activity.objects.create(name='1', event=event, assigned=member, weight=2)
+        a2 = Activity.objects.create(name='2', event=event, assigned=member)
+        a3 = Activity.objects.create(name='3', event=event)
+
+        self.client.force_login(staff)
+        response = self.client.post('/api/members/set_completed', content_type='application/json', data=[
+            {'activity_id': a1.id, 'completed': True},
+            {'activity_id': a2.id, 'completed': False},
+            {'activity_id': a3.id, 'completed': True}])
+
+        self.assertEqual([r['ok'] for r in response.json()], [True, True, False])
+        self.assertEqual(list(Activity.objects.order_by('id').values_list('completed', flat=True)),
+                         [True, False, None])
+        self.assertEqual(member.completed_weight, 2)
+
+
+class EventCsvTest(TestCase):
+    """Tests for the CSV roster exports."""
+
+    def test_rosters(self):
+        from app.models import Activity, ActivityType, Event, License, LicenseType
+        from django.contrib.auth.models import User
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+
+        today = datetime.date.today()
+        staff = User.objects.create(username='s@b.se', email='s@b.se', is_staff=True)
+        flag = ActivityType.objects.create(name='Flaggvakt')
+        lt = LicenseType.objects.create(name='Funktionär', start_level='A', end_level='C')
+        for i in range(2):
+            event = Event.objects.create(name=f'Race {i}', start_date=today, end_date=today)
+            for j in range(3):
+                user = User.objects.create(username=f'{i}{j}@b.se', email=f'{i}{j}@b.se',
+                                           first_name='Åsa', last_name=str(j))
+                License.objects.create(type=lt, member=user.member, level='B')
+                Activity.objects.create(name=f'Uppgift {j}', event=event, type=flag,
+                                        assigned=user.member)
+
+        self.client.force_login(staff)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/api/events/{event.id}/csv')
+            content = b''.join(response.streaming_content).decode('windows-1252')
+        self.assertEqual(len([q for q in queries if 'app_license"' in q['sql']]), 1)
+        self.assertIn('Uppgift 2;Flaggvakt;None - None;Åsa 2;tel:;12@b.se;B;\r\n', content)
+
+        response = self.client.get(f'/api/events/csv?from={today}&to={today}')
+        content = b''.join(response.streaming_content).decode('windows-1252')
+        self.assertEqual(content.count('Beskrivning;'), 2)
+
+        for query in ['from=2024-13-01', 'from=yesterday', f'from={today}&to=']:
+            response = self.client.get(f'/api/events/csv?{query}')
+            self.assertEqual(response.status_code, 400)
+
+
+class ExcelImportTest(TestCase):
+    """Tests for the two-phase Excel schedule import."""
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        self.staff = User.objects.create(username='s@b.se', email='s@b.se',
+                                         first_name='Sam', last_name='Staff').member
+
+    def workbook(self, rows):
+        import openpyxl
+        from app.excel import ExcelSheet
+
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        cols = ExcelSheet(ws).cols
+        ws.append(list(cols))
+        ws.append(['-'])
+        for values in rows:
+            row = [None] * len(cols)
+            for header, value in values.items():
+                row[cols[header]] = value
+            ws.append(row)
+
+        file = io.BytesIO()
+        wb.save(file)
+        file.seek(0)
+        return file
+
+    def race(self, **first):
+        # like the season sheet, event columns only on the event's first row
+        return [dict({'Aktivitet': 'Race', 'Typ': 'Tävling', 'Datum': datetime.datetime(2020, 5, 2),
+                      'Uppgift': 'Flaggvakt', 'Start': datetime.time(8),
+                      'Koordinator': 'Sam Staff'}, **first),
+                {'Uppgift': 'Depå'},
+                {'Uppgift': 'Flaggvakt', 'Start': datetime.time(12)}]
+
+    def run_import(self, rows, **kwargs):
+        from unittest import mock
+        from app.excel import importDataFromExcel
+
+        with mock.patch('app.excel.locale.setlocale'):
+            return importDataFromExcel(self.workbook(rows), **kwargs)
+
+    def test_import(self):
+        from app.models import Activity, ActivityType, Event
+
+        self.assertEqual(self.run_import(self.race(), year=None), 3)
+
+        event = Event.objects.get()
+        self.assertEqual((event.name, event.start_date, event.type.name),
+                         ('Race', datetime.date(2020, 5, 2), 'Tävling'))
+        self.assertEqual(list(event.coordinators.all()), [self.staff])
+        self.assertEqual(event.activities_total, 3)
+        self.assertEqual(Activity.objects.filter(type__name='Flaggvakt').count(), 2)
+        self.assertEqual(ActivityType.objects.count(), 2)
+
+    def test_dates_moved_to_year(self):
+        from app.models import Event
+
+        self.run_import(self.race(), year=2021)
+        # same week and weekday
+        self.assertEqual(Event.objects.get().start_date, datetime.date(2021, 5, 8))
+
+    def test_invalid_rows_import_nothing(self):
+        from app.excel import ExcelImportException
+        from app.models import Activity, Event
+
+        rows = self.race() + [{'Aktivitet': 'Other', 'Datum': 'x', 'Uppgift': 'Depå'},
+                              {'Uppgift': 'Depå', 'Start': 'kl 8'}]
+        with self.assertRaises(ExcelImportException) as e:
+            self.run_import(rows, year=None)
+
+        self.assertEqual([n for n, _ in e.exception.errors], [6, 7])
+        self.assertFalse(Event.objects.exists())
+        self.assertFalse(Activity.objects.exists())
+
+    def test_dry_run(self):
+        from app.models import Activity, Event
+
+        self.assertEqual(self.run_import(self.race(), year=None, dry_run=True), 3)
+        self.assertFalse(Event.objects.exists())
+        self.assertFalse(Activity.objects.exists())
+
+
+class ExcelExportTest(TestCase):
+    """Tests for the Excel schedule export."""
+
+    def test_export_roundtrip(self):
+        from app.models import Activity, ActivityType, Event
+        from django.contrib.auth.models import User
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+        import openpyxl
+
+        staff = User.objects.create(username='s@b.se', email='s@b.se', is_staff=True)
+        flag = ActivityType.objects.create(name='Flaggvakt', fee_reimbursed=True)
+        driver = ActivityType.objects.create(name='Förare')
+        for i in range(3):
+            day = datetime.date(2020, 5, i + 1)
+            event = Event.objects.create(name=f'Race {i}', start_date=day, end_date=day)
+            event.coordinators.add(staff.member)
+            for j in range(2):
+                Activity.objects.create(name=f'Uppgift {j}', event=event, type=flag,
+                                        start_time=datetime.time(8 + j))
+            Activity.objects.create(name='Förare', event=event, type=driver)
+
+        self.client.force_login(staff)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/app/excel_export/?year=2020')
+            content = b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len([q for q in queries if 'app_' in q['sql']]), 5)
+
+        rows = list(openpyxl.load_workbook(io.BytesIO(content)).active.values)
+        self.assertEqual(rows[0][0], 'Aktivitet')
+        self.assertEqual(len(rows), 2 + 3 * 2)
+        self.assertEqual(rows[2][:2], ('Race 0', None))
+        self.assertEqual(rows[2][5], 'Flaggvakt')
+        self.assertEqual(rows[2][8], 'Ja')
+        self.assertEqual(rows[3][0], None)
+
+        self.client.logout()
+        self.assertEqual(self.client.get('/app/excel_export/').status_code, 302)
+
+
+class PractiseExportTest(TestCase):
+    """Tests for the practise session export."""
+
+    def test_pivot(self):
+        from app.models import Activity, ActivityType, Event, EventType
+        from app.management.commands import export_practise_to_excel as export
+        from django.contrib.auth.models import User
+
+        practise = EventType.objects.create(name=export.PRACTISE_EVENT_TYPE)
+        flag = ActivityType.objects.create(name=export.FLAG_MARSHAL_TYPE)
+        pit = ActivityType.objects.create(name=export.PIT_GUIDE_TYPE)
+        user = User.objects.create(username='a@b.se', email='a@b.se',
+                                   first_name='Åsa', last_name='Ek')
+
+        for day in [2, 9]:
+            date = datetime.date(2020, 6, day)
+            event = Event.objects.create(name='Träning', type=practise,
+                                         start_date=date, end_date=date)
+            for hour in [18, 19]:
+                for t in [flag, flag, pit]:
+                    Activity.objects.create(name=t.name, event=event, type=t,
+                                            start_time=datetime.time(hour),
+                                            end_time=datetime.time(hour + 1),
+                                            assigned=user.member if t == pit else None)
+
+        with self.assertNumQueries(1):
+            rows = export.practiseSessionRows(2020)
+
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0], [datetime.date(2020, 6, 2), '18:00:00 - 19:00:00', ', ', 'Åsa Ek'])
+        self.assertEqual(rows[3][:2], [datetime.date(2020, 6, 9), '19:00:00 - 20:00:00'])
+
+        export.exportPractiseSessions(io.BytesIO(), 2020)
+
+
+class OutboxTest(TestCase):
+    """Tests for queued email/SMS delivery."""
+
+    def setUp(self):
+        from app.models import Activity, Event
+        from django.contrib.auth.models import User
+
+        today = datetime.date.today()
+        self.user = User.objects.create(username='a@b.se', email='a@b.se')
+        self.approver = User.objects.create(username='c@b.se', email='c@b.se')
+        self.event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        self.activity = Activity.objects.create(name='Flagga', event=self.event,
+                                                assigned=self.user.member)
+
+    def test_adr_rejected_is_queued_and_delivered(self):
+        from app.models import ActivityDelistRequest, OutboxMessage
+        from django.core import mail
+        from django.core.management import call_command
+        from django.test import override_settings
+
+        with override_settings(DEFAULT_FROM_EMAIL='noreply@b.se'):
+            adr = ActivityDelistRequest.objects.create(
+                member=self.user.member, activity=self.activity)
+            adr.approved = False
+            adr.approver = self.approver.member
+            adr.save()
+            adr.save()
+
+        self.assertEqual(len(mail.outbox), 0)
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.recipient_list, ['a@b.se', 'c@b.se'])
+
+        call_command('run_outbox', stdout=io.StringIO())
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['a@b.se', 'c@b.se'])
+        self.assertEqual(OutboxMessage.objects.get().status, OutboxMessage.SENT)
+
+    def test_retry_with_backoff(self):
+        from app import outbox, sms
+        from app.models import OutboxMessage
+        from django.test import override_settings
+
+        outbox.enqueue_sms('test:1', '+46700000000', 'Hej')
+        self.assertIsNone(outbox.enqueue_sms('test:1', '+46700000000', 'Hej'))
+
+        with override_settings(TWILIO_ACCOUNT_SID=''):
+            self.assertEqual(outbox.process(), (0, 1))
+            self.assertEqual(outbox.process(), (0, 0))
+
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.status, message.attempts), (OutboxMessage.PENDING, 1))
+        self.assertGreater(message.next_attempt, datetime.datetime.now())
+
+        OutboxMessage.objects.update(next_attempt=datetime.datetime.now())
+        with sms.use_backend(sms.FakeBackend()) as backend:
+            self.assertEqual(outbox.process(), (1, 0))
+
+        self.assertEqual(backend.sent[0]['to'], '+46700000000')
+
+
+class ReminderTest(TestCase):
+    """Tests for the deduplicated reminder run."""
+
+    def test_reminders_once_per_lead_time(self):
+        from app import reminders
+        from app.models import Activity, Event, ReminderSent
+        from django.contrib.auth.models import User
+        from django.core import mail
+        from django.core.management import call_command
+        from django.test import override_settings
+
+        today = datetime.date.today()
+        for days in [1, 2, 7]:
+            date = today + datetime.timedelta(days=days)
+            event = Event.objects.create(name=f'Race {days}', start_date=date, end_date=date)
+            for i in range(3):
+                user = User.objects.create(username=f'{days}{i}@b.se', email=f'{days}{i}@b.se')
+                user.member.phone_number = f'+4670000000{i}'
+                user.member.save()
+                Activity.objects.create(name=f'Uppgift {i}', event=event, assigned=user.member)
+            Activity.objects.create(name='Ledig', event=event)
+
+        with override_settings(DEFAULT_FROM_EMAIL='noreply@b.se'):
+            run = reminders.send_reminders([7, 1])
+            self.assertEqual((run.reminders, run.sent, run.failed), (6, 6, 0))
+            self.assertEqual(reminders.send_reminders([7, 1]).reminders, 0)
+
+            # SMS go to the stand-in client, everything is rolled back
+            out = io.StringIO()
+            call_command('notifynextdayevents', '2', '7', '--dry-run', '--sms-latency', '0', stdout=out)
+            self.assertIn('3 reminder(s), 6/6 message(s) sent', out.getvalue())
+
+            self.assertEqual(reminders.send_reminders([2]).reminders, 3)
+
+        self.assertEqual(len(mail.outbox), 9 + 3)
+        self.assertEqual(ReminderSent.objects.count(), 9)
+
+
+class MailerTest(TestCase):
+    """Tests for bulk mail over a persistent connection."""
+
+    def test_one_connection_and_reconnect(self):
+        import smtplib
+        from app import outbox
+        from app.mail import Mailer
+        from app.models import OutboxMessage
+        from django.core.mail.backends.locmem import EmailBackend
+
+        class Backend(EmailBackend):
+            opened = 0
+            drop_at = {120}
+            count = 0
+
+            def open(self):
+                Backend.opened += 1
+
+            def send_messages(self, messages):
+                Backend.count += 1
+                if Backend.count in Backend.drop_at:
+                    raise smtplib.SMTPServerDisconnected('gone')
+                return super().send_messages(messages)
+
+        for i in range(300):
+            outbox.enqueue_email(f'announcement:{i}', 'Säsongsstart', 'Hej!', [f'{i}@b.se'])
+
+        with Mailer(Backend()) as mailer:
+            while outbox.process(50, mailer) != (0, 0):
+                pass
+
+        self.assertEqual(Backend.opened, 2)
+        self.assertEqual(OutboxMessage.objects.filter(status=OutboxMessage.SENT).count(), 300)
+
+
+class SMSTest(TestCase):
+    """Tests for the SMS dispatcher."""
+
+    def test_rate_limit(self):
+        import time
+        from app import sms
+
+        limiter = sms.RateLimiter(50)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 5 / 50)
+
+        with sms.use_backend(sms.FakeBackend(rate=1000)) as backend:
+            sms.send('+46700000000', 'Hej', sender='Team13')
+        self.assertEqual(backend.sent[0]['from'], 'Team13')
+
+    def test_shared_twilio_client(self):
+        from app import sms
+        from django.test import override_settings
+
+        with override_settings(TWILIO_ACCOUNT_SID='AC123', TWILIO_AUTH_TOKEN='token'):
+            self.assertIs(sms.twilio_client(), sms.twilio_client())
+        sms._backends.clear()
+
+        with override_settings(TWILIO_ACCOUNT_SID=''), self.assertRaises(sms.SMSDisabled):
+            sms.send('+46700000000', 'Hej')
+
+
+class CircuitBreakerTest(TestCase):
+    """Tests for circuit breakers around external providers."""
+
+    def test_open_half_open_closed(self):
+        import time
+        from app.breaker import CircuitBreaker, CircuitOpen
+
+        calls = []
+
+        def provider(ok):
+            calls.append(ok)
+            if not ok:
+                raise ConnectionError('down')
+            return 'ok'
+
+        b = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.05)
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                b.call(provider, False)
+        self.assertEqual(b.state, b.OPEN)
+
+        with self.assertRaises(CircuitOpen):
+            b.call(provider, True)
+        self.assertEqual(len(calls), 2)
+
+        time.sleep(0.06)
+        with self.assertRaises(ConnectionError):
+            b.call(provider, False)
+        self.assertEqual(b.state, b.OPEN)
+
+        time.sleep(0.06)
+        self.assertEqual(b.call(provider, True), 'ok')
+        self.assertEqual(b.stats()['state'], b.CLOSED)
+        self.assertEqual((b.counters['open'], b.counters['half_open'], b.counters['closed']),
+                         (2, 2, 1))
+
+    def test_client_errors_ignored(self):
+        import time
+        from app import breaker
+        from app.breaker import CircuitBreaker
+
+        class ProviderError(Exception):
+            def __init__(self, status):
+                self.status = status
+
+        def provider(status):
+            raise ProviderError(status)
+
+        b = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.05,
+                           is_failure=breaker.not_client_error)
+        for status in [500, 400, 500]:
+            with self.assertRaises(ProviderError):
+                b.call(provider, status)
+        self.assertEqual(b.state, b.OPEN)
+
+        # a rejected probe neither closes nor reopens the breaker
+        time.sleep(0.06)
+        with self.assertRaises(ProviderError):
+            b.call(provider, 404)
+        self.assertEqual(b.state, b.HALF_OPEN)
+        self.assertEqual(b.counters['failures'], 2)
+
+        # whichever caller comes first, the classifier is the breaker's own
+        try:
+            self.assertIs(breaker.breaker('sms').is_failure, breaker.not_client_error)
+        finally:
+            breaker._breakers.clear()
+
+    def test_verify_fails_fast_when_open(self):
+        import time
+        from unittest import mock
+        from app import breaker
+        from django.contrib.auth.models import User
+
+        user = User.objects.create(username='a@b.se', email='a@b.se')
+        user.member.phone_number = '+46700000000'
+        user.member.save()
+        self.client.force_login(user)
+
+        b = breaker.breaker('twilio_verify')
+        b.opened_at, b.state = time.monotonic(), b.OPEN
+        try:
+            with mock.patch('app.sms.twilio_client') as client:
+                response = self.client.post('/api/verify/phone/send')
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('Retry-After', response)
+            client.assert_not_called()
+        finally:
+            breaker._breakers.clear()
+
+class InboundSMSTest(TestCase):
+    """Tests for the SMS webhook and inbox processing."""
+
+    def test_receive_and_process(self):
+        from app import inbox
+        from app.models import Activity, ActivityDelistRequest, Event, InboundSMS
+        from django.contrib.auth.models import User
+        from django.test import override_settings
+
+        today = datetime.date.today()
+        event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        numbers = ['+46700000001', '+46700000002']
+        for i, number in enumerate(numbers):
+            user = User.objects.create(username=f'{i}@b.se', email=f'{i}@b.se')
+            user.member.phone_number = number
+            user.member.save()
+            Activity.objects.create(name=f'Uppgift {i}', event=event, assigned=user.member)
+
+        def post(sid, from_, body, account='AC1'):
+            return self.client.post('/api/sms', {
+                'AccountSid': account, 'MessageSid': sid,
+                'From': from_, 'To': '+46766000000', 'Body': body})
+
+        with override_settings(TWILIO_ACCOUNT_SID='AC1'):
+            self.assertEqual(post('SM0', numbers[0], 'Ja', account='AC2').status_code, 403)
+
+            with self.assertNumQueries(1):
+                response = post('SM1', numbers[0], 'Ja!')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'<Response>', response.content)
+
+            post('SM1', numbers[0], 'Ja!')
+            post('SM2', numbers[1], 'Avboka, är sjuk')
+            post('SM3', '+46711111111', 'Ja')
+            post('SM4', numbers[1], 'Hallå?')
+
+        self.assertEqual(InboundSMS.objects.filter(processed=None).count(), 4)
+        self.assertEqual(inbox.process_batch(), 4)
+        self.assertEqual(inbox.process_batch(), 0)
+
+        results = dict(InboundSMS.objects.values_list('message_sid', 'result'))
+        self.assertEqual(results, {'SM1': 'confirmed', 'SM2': 'delist_requested',
+                                   'SM3': 'unknown_sender', 'SM4': 'not_understood'})
+        self.assertTrue(Activity.objects.get(name='Uppgift 0').confirmed)
+        self.assertEqual(ActivityDelistRequest.objects.get().reason, 'Via SMS: Avboka, är sjuk')
+
+        # a rejected request is reopened, not duplicated
+        ActivityDelistRequest.objects.update(approved=False, reject_reason='Nej')
+        with override_settings(TWILIO_ACCOUNT_SID='AC1'):
+            post('SM5', numbers[1], 'Nej')
+        inbox.process_batch()
+        self.assertEqual(InboundSMS.objects.get(message_sid='SM5').result, 'delist_requested')
+        adr = ActivityDelistRequest.objects.get()
+        self.assertEqual((adr.approved, adr.reason), (None, 'Via SMS: Nej'))
+
+
+class RequestMemberTest(TestCase):
+    """Tests for request.member."""
+
+    def test_member_loaded_once(self):
+        from app.models import Activity, Event
+        from django.contrib.auth.models import User
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+
+        today = datetime.date.today()
+        user = User.objects.create(username='a@b.se', email='a@b.se')
+        event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        Activity.objects.create(name='Flagga', event=event, assigned=user.member)
+        self.client.force_login(user)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/activity_my')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len([q for q in queries if 'FROM "app_member"' in q['sql']]), 1)
+        self.assertNotIn('enlistment', response.json()['results'][0])
+
+        response = self.client.get(f'/api/events/{event.id}')
+        self.assertEqual(response.json()['results'][0]['current_user_assigned'], 1)
+
+    def test_anonymous(self):
+        from app.middleware import get_member
+        from django.contrib.auth.models import AnonymousUser
+        from django.test import RequestFactory
+
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        self.assertIsNone(get_member(request))
+
+
+class RefDataTest(TestCase):
+    """Tests for the reference-data cache."""
+
+    def setUp(self):
+        from app import refdata
+        refdata.invalidate_all()
+
+    def test_list_served_from_memory(self):
+        from app.models import ActivityType
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+
+        ActivityType.objects.create(name='Flagga')
+        self.client.get('/api/activity_type')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/activity_type')
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(response.json()['results'][0]['name'], 'Flagga')
+
+        etag = response['ETag']
+        response = self.client.get('/api/activity_type', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # a header merely containing the tag doesn't match it
+        response = self.client.get('/api/activity_type', HTTP_IF_NONE_MATCH=f'"x{etag}"')
+        self.assertEqual(response.status_code, 200)
+
+        ActivityType.objects.create(name='Depå')
+        response = self.client.get('/api/activity_type', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 2)
+
+    def test_nested_type(self):
+        from app.models import Activity, ActivityType, Event
+
+        today = datetime.date.today()
+        event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        flag = ActivityType.objects.create(name='Flagga')
+        Activity.objects.create(name='Flagga 1', event=event, type=flag)
+
+        response = self.client.get(f'/api/event_activities/{event.id}')
+        self.assertEqual(response.json()['results'][0]['type']['name'], 'Flagga')
+
+        flag.name = 'Flaggvakt'
+        flag.save()
+        response = self.client.get(f'/api/event_activities/{event.id}')
+        self.assertEqual(response.json()['results'][0]['type']['name'], 'Flaggvakt')
+
+    def test_infotext(self):
+        from app.models import InfoText
+
+        InfoText.objects.create(key='welcome', content='Hej')
+        self.assertEqual(self.client.get('/api/infotext/welcome').json()['content'], 'Hej')
+        self.assertEqual(self.client.get('/api/infotext/missing').status_code, 404)
+
+
+class CachingTest(TestCase):
+    """Tests for the shared cache backends and versioned keys."""
+
+    def test_sqlite_cache_shared(self):
+        import tempfile
+        from app.caching import SQLiteCache
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = f'{tmp}/cache.sqlite3'
+            one, other = SQLiteCache(path, {}), SQLiteCache(path, {})
+
+            one.set('refdata:a', {'x': 1})
+            self.assertEqual(other.get('refdata:a'), {'x': 1})
+            self.assertFalse(other.add('refdata:a', 2))
+            self.assertTrue(other.add('refdata:b', 2))
+            self.assertEqual(one.incr('refdata:b', 3), 5)
+            with self.assertRaises(ValueError):
+                one.incr('refdata:missing')
+
+            one.set('refdata:c', 1, 0)
+            self.assertIsNone(other.get('refdata:c'))
+            other.delete('refdata:a')
+            self.assertIsNone(one.get('refdata:a'))
+
+    def test_versioned_keys_and_stats(self):
+        from app import caching
+        from django.core.cache import cache
+
+        caching.reset_stats()
+        key = caching.versioned_key('events', 2026, 1)
+        cache.set(key, 'page')
+        self.assertEqual(cache.get(caching.versioned_key('events', 2026, 1)), 'page')
+
+        caching.bump('events')
+        self.assertIsNone(cache.get(caching.versioned_key('events', 2026, 1)))
+
+        stats = caching.stats()['events']
+        self.assertEqual(stats['invalidations'], 1)
+        self.assertEqual(stats['sets'], 3)  # version token, page, new version token
+        self.assertEqual(stats['hits'], 4)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hit_rate'], 0.667)
+
+
+class ConditionalGetTest(TestCase):
+    """Tests for ETags on the read API."""
+
+    def test_event_list_not_modified(self):
+        from app.models import Activity, Event
+        from django.contrib.auth.models import User
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+
+        today = datetime.date.today()
+        user = User.objects.create(username='a@b.se', email='a@b.se')
+        event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        self.client.force_login(user)
+
+        response = self.client.get('/api/events')
+        etag = response['ETag']
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/events', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse([q for q in queries if 'app_event' in q['sql']])
+
+        # a different year is a different resource
+        response = self.client.get('/api/events?year=2000', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        Activity.objects.create(name='Flagga', event=event)
+        response = self.client.get('/api/events', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_update_bypassing_signals(self):
+        from app import inbox
+        from app.models import Activity, Event, InboundSMS
+        from django.contrib.auth.models import User
+
+        today = datetime.date.today()
+        user = User.objects.create(username='a@b.se', email='a@b.se')
+        user.member.phone_number = '+46700000000'
+        user.member.save()
+        event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        Activity.objects.create(name='Flagga', event=event, assigned=user.member)
+        self.client.force_login(user)
+
+        etag = self.client.get('/api/activity_my')['ETag']
+        InboundSMS.objects.create(message_sid='SM1', from_number='+46700000000',
+                                  to_number='+46700000001', body='JA')
+        inbox.process_batch()
+
+        response = self.client.get('/api/activity_my', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['results'][0]['confirmed'])
+
+    def test_login_keeps_etag(self):
+        from django.contrib.auth.models import User
+
+        user = User.objects.create(username='a@b.se', email='a@b.se')
+        other = User.objects.create(username='c@d.se', email='c@d.se')
+        self.client.force_login(user)
+
+        etag = self.client.get('/api/activity_my')['ETag']
+        self.client.force_login(other)
+        self.client.force_login(user)
+        response = self.client.get('/api/activity_my', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+
+class PublicEventCacheTest(TestCase):
+    """Tests for the cached anonymous event list."""
+
+    def test_anonymous_list_cached(self):
+        from app.models import Activity, Event
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+
+        today = datetime.date.today()
+        event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        first = self.client.get('/api/events')
+        self.assertEqual(first['Cache-Control'], 'public, max-age=60')
+        self.assertIn('Cookie', first['Vary'])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/events')
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(response.content, first.content)
+        self.assertEqual(response['ETag'], first['ETag'])
+
+        Activity.objects.create(name='Flagga', event=event)
+        response = self.client.get('/api/events')
+        self.assertEqual(response.json()['results'][0]['activities_total'], 1)
+
+        other_year = self.client.get('/api/events?year=2000')
+        self.assertEqual(other_year.json()['results'], [])
+        self.assertNotEqual(other_year['ETag'], response['ETag'])
+
+    def test_member_changes_keep_list(self):
+        from app.models import Event
+        from django.contrib.auth.models import User
+
+        today = datetime.date.today()
+        user = User.objects.create(username='a@b.se', email='a@b.se')
+        event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        event.coordinators.add(user.member)
+
+        public = self.client.get('/api/events')['ETag']
+        self.client.force_login(user)
+        etag = self.client.get('/api/events')['ETag']
+        detail = self.client.get(f'/api/events/{event.id}')['ETag']
+        user.member.save()
+
+        # only the single event lists its coordinators
+        response = self.client.get('/api/events', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(f'/api/events/{event.id}', HTTP_IF_NONE_MATCH=detail)
+        self.assertEqual(response.status_code, 200)
+
+        self.client.logout()
+        response = self.client.get('/api/events', HTTP_IF_NONE_MATCH=public)
+        self.assertEqual(response.status_code, 304)
+
+
+class ChangeFeedTest(TestCase):
+    """Tests for /api/changes."""
+
+    def test_changes_since_cursor(self):
+        from app import booking
+        from app.models import Activity, Event
+        from django.contrib.auth.models import User
+
+        today = datetime.date.today()
+        user = User.objects.create(username='a@b.se', email='a@b.se')
+        event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        activity = Activity.objects.create(name='Flagga', event=event)
+        gone = Activity.objects.create(name='Depå', event=event)
+        self.client.force_login(user)
+
+        # rows older than the cursor and its overlap are not sent again
+        old = datetime.datetime.now() - datetime.timedelta(minutes=5)
+        Activity.objects.update(modified=old)
+        Event.objects.update(modified=old)
+
+        cursor = self.client.get('/api/changes').json()['cursor']
+        booking.enlist(activity.id, user.member)
+        gone_id = gone.id
+        gone.delete()
+
+        changes = self.client.get('/api/changes', {'since': cursor}).json()
+        self.assertEqual([a['id'] for a in changes['activities']], [activity.id])
+        self.assertEqual(changes['activities'][0]['assigned']['id'], user.member.id)
+        self.assertEqual(changes['events'][0]['activities_assigned'], 1)
+        self.assertEqual(changes['deleted']['activities'], [gone_id])
+
+        self.assertEqual(self.client.get('/api/changes', {'since': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/changes', {'since': '2000-01-01T00:00:00'}).status_code, 410)
+
+        # an offset is fine, cursors are compared as local times
+        from django.utils import timezone
+        since = timezone.make_aware(datetime.datetime.now()).isoformat()
+        self.assertEqual(self.client.get('/api/changes', {'since': since}).status_code, 200)
+
+    def test_queries_independent_of_rows(self):
+        from app.models import Activity, ActivityDelistRequest, Event, License, LicenseType
+        from django.contrib.auth.models import User
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+
+        today = datetime.date.today()
+        user = User.objects.create(username='s@b.se', email='s@b.se', is_staff=True)
+        self.client.force_login(user)
+        cursor = self.client.get('/api/changes').json()['cursor']
+        license_type = LicenseType.objects.create(name='Flagg')
+
+        def add_rows(n):
+            event = Event.objects.create(name=f'Race {n}', start_date=today, end_date=today)
+            for i in range(n):
+                member = User.objects.create(username=f'{n}-{i}@b.se', email=f'{n}-{i}@b.se').member
+                License.objects.create(member=member, type=license_type, level='B')
+                activity = Activity.objects.create(name=f'{i}', event=event, assigned=member)
+                ActivityDelistRequest.objects.create(member=member, activity=activity)
+
+            with CaptureQueriesContext(connection) as queries:
+                changes = self.client.get('/api/changes', {'since': cursor}).json()
+            self.assertIsNotNone(changes['activities'][0]['active_delist_request'])
+            return len(queries)
+
+        self.assertEqual(add_rows(2), add_rows(5))
+
+
+class LongPollTest(TransactionTestCase):
+    """Tests for long-polling /api/changes, commits are needed to publish."""
+
+    def test_wait_for_change(self):
+        import threading
+        import time
+        from unittest import mock
+        from app import live
+        from app.models import Activity, Event
+        from django.contrib.auth.models import User
+        from django.db import connection
+
+        today = datetime.date.today()
+        event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        Event.objects.update(modified=datetime.datetime.now() - datetime.timedelta(minutes=5))
+        self.client.force_login(User.objects.create(username='a@b.se', email='a@b.se'))
+        cursor = self.client.get('/api/changes').json()['cursor']
+
+        def enlist_later():
+            try:
+                for _ in range(100):
+                    if live.broker.subscribers():
+                        break
+                    time.sleep(0.05)
+                Activity.objects.create(name='Flagga', event=event)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=enlist_later)
+        thread.start()
+        started = time.monotonic()
+        changes = self.client.get('/api/changes', {'since': cursor, 'wait': 10}).json()
+        thread.join()
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual([a['name'] for a in changes['activities']], ['Flagga'])
+        self.assertEqual(live.broker.subscribers(), 0)
+
+        # nothing new, the overlap alone doesn't answer before the timeout
+        with mock.patch('app.api.api_sync.WAIT_SECONDS', 0.2):
+            started = time.monotonic()
+            changes = self.client.get('/api/changes', {'since': changes['cursor'], 'wait': 10}).json()
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual([a['name'] for a in changes['activities']], ['Flagga'])
+
+        for wait in ['x', '-1', 'nan']:
+            response = self.client.get('/api/changes', {'since': cursor, 'wait': wait})
+            self.assertEqual(response.status_code, 400)
+
+    def test_relay_changes_from_other_processes(self):
+        from app import live
+        from app.models import Activity, Event
+        from django.utils import timezone
+
+        today = datetime.date.today()
+        event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        activity = Activity.objects.create(name='Flagga', event=event)
+        subscription = live.broker.subscribe(f'event:{event.id}')
+
+        try:
+            # as if done by another process, no signals here
+            Activity.objects.filter(id=activity.id).update(cancelled=True, modified=timezone.now())
+            live.relay_changes(timezone.now())
+
+            message = subscription.get(0)
+            self.assertEqual((message['id'], message['cancelled']), (activity.id, True))
+            self.assertIsNone(subscription.get(0))
+        finally:
+            live.broker.unsubscribe(subscription)
+
+
+class NormalizedFormatTest(TestCase):
+    """Tests for ?format=normalized."""
+
+    def setUp(self):
+        from app import refdata
+        refdata.invalidate_all()
+
+    def test_event_activities_normalized(self):
+        from app.models import Activity, ActivityDelistRequest, ActivityType, Event
+        from django.contrib.auth.models import User
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+
+        today = datetime.date.today()
+        event = Event.objects.create(name='Race', start_date=today, end_date=today)
+        types = [ActivityType.objects.create(name=f'Typ {i}') for i in range(2)]
+        members = [User.objects.create(username=f'{i}@b.se', email=f'{i}@b.se').member
+                   for i in range(3)]
+        for i in range(10):
+            Activity.objects.create(name=f'Uppgift {i}', event=event, type=types[i % 2],
+                                    assigned=members[i % 3] if i < 6 else None)
+        adr = ActivityDelistRequest.objects.create(
+            member=members[0], activity=Activity.objects.get(name='Uppgift 0'))
+
+        url = f'/api/event_activities/{event.id}'
+        nested = self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'format': 'normalized'})
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(queries), 10)
+        self.assertLess(len(response.content), len(nested.content))
+
+        data = response.json()
+        self.assertEqual(len(data['results']), 10)
+        self.assertEqual(data['count'], 10)
+        first = data['results'][0]
+        self.assertEqual(first['type'], types[0].id)
+        self.assertEqual(first['assigned'], members[0].id)
+        self.assertEqual(first['active_delist_request'], adr.id)
+
+        included = data['included']
+        self.assertEqual([t['name'] for t in included['activity_types']], ['Typ 0', 'Typ 1'])
+        self.assertEqual(sorted(m['id'] for m in included['members']), [m.id for m in members])
+        self.assertEqual([e['id'] for e in included['events']], [event.id])
+        self.assertEqual([d['id'] for d in included['delist_requests']], [adr.id])
+
+        # nested rows are unchanged by default
+        self.assertEqual(nested.json()['results'][0]['type']['name'], 'Typ 0')
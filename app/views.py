@@ -4,11 +4,12 @@ Definition of views.
 
 import datetime
 import logging
+import tempfile
 
 from django.urls import path, re_path, include
 
 from django.shortcuts import render
-from django.http import HttpRequest
+from django.http import HttpRequest, FileResponse, HttpResponseBadRequest
 from django.contrib.auth import login, authenticate
 from django.contrib.auth import views as auth_views
 from django.shortcuts import render, redirect
@@ -16,7 +17,7 @@ from django.contrib.admin.views.decorators import staff_member_required
 from django.views.decorators.http import require_http_methods
 
 from app import forms
-from app.excel import importDataFromExcel
+from app.excel import importDataFromExcel, exportScheduleToExcel
 import app.excel
 
 logger = logging.getLogger(__name__)
@@ -156,6 +157,26 @@ def excelImport(request):
     )
 
 
+@staff_member_required
+@require_http_methods(['GET'])
+def excelExport(request):
+    '''downloads the schedule for ?year= (may be repeated) as an Excel file'''
+    try:
+        years = [int(y) for y in request.GET.getlist('year')] or \
+            [datetime.date.today().year]
+    except ValueError:
+        return HttpResponseBadRequest('Invalid year')
+
+    # spooled to disk past a few MB, so large exports don't stay in memory
+    file = tempfile.SpooledTemporaryFile(max_size=4 * 1024 * 1024)
+    exportScheduleToExcel(file, years)
+    file.seek(0)
+
+    name = '-'.join(str(y) for y in sorted(set(years)))
+    return FileResponse(file, as_attachment=True,
+                        filename=f'Aktivitetslista T13 {name}.xlsx')
+
+
 url_patterns = [
     path('', home, name='home'),
     path('contact/', contact, name='contact'),
@@ -180,5 +201,6 @@ url_patterns = [
     path('change_password/done/', MyPasswordChangeDoneView.as_view(),
          name="password_change_done"),
 
-    path('excel_import/', excelImport, name='excel_import')
+    path('excel_import/', excelImport, name='excel_import'),
+    path('excel_export/', excelExport, name='excel_export'),
 ]